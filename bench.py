@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""Offline benchmarks for pyketra; no N4 needed.
+
+    $ python3 bench.py                 # run everything, compare to the baseline
+    $ python3 bench.py parse colors    # only benchmarks whose names contain these
+    $ python3 bench.py --save          # record the results as the new baseline
+
+Each benchmark reports its best time over --rounds interleaved rounds and the
+peak memory allocated during one more run, traced by tracemalloc. Results
+are compared with bench_baseline.json; anything more than --tolerance times
+slower or bigger is flagged and the exit status is 1. Time differences under
+--noise-floor are never flagged, since they are within timer and scheduling
+noise. Times depend on the machine, so refresh the baseline with --save on
+the machine used for comparing.
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+from pyketra import (Ketra, Output, _iter_groups, cctKelvin_to_xyColor,
+                     cctKelvin_to_xyColor_fast)
+from pyketra.testing import make_groups
+
+logging.basicConfig(level=logging.ERROR)
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'bench_baseline.json')
+
+
+def bench_output_memory(count=10000):
+    """Returns the bytes allocated per Output when loading count groups,
+    including the controller's index entries for them."""
+    groups = make_groups(count)
+    ketra = Ketra('bench', '', 'Bench', noop_set_state=True)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    ketra._parse_json_db(groups)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / count
+
+
+def _loaded(count):
+    """Returns a Ketra with count synthetic outputs loaded."""
+    ketra = Ketra('bench', '', 'Bench', noop_set_state=True)
+    ketra._parse_json_db(make_groups(count))
+    return ketra
+
+
+# Each benchmark is a setup function; it returns the function to measure,
+# which must do the same work every time it is called on fresh setup.
+
+def setup_parse(count):
+    groups = make_groups(count)
+    return lambda: Ketra('bench', '', 'Bench', noop_set_state=True)._parse_json_db(groups)
+
+
+def setup_parse_stream(count):
+    body = json.dumps({'Content': make_groups(count)}).encode('utf-8')
+    chunks = [body[i:i + 65536] for i in range(0, len(body), 65536)]
+    return lambda: Ketra('bench', '', 'Bench', noop_set_state=True)._parse_json_db(
+        _iter_groups(chunks))
+
+
+def setup_register_duplicates(count, names=10):
+    """count groups sharing names distinct names, so nearly every one is
+    renumbered by register_id."""
+    groups = make_groups(count)
+    for i, group in enumerate(groups):
+        group['Name'] = 'Light %d' % (i % names)
+    return lambda: Ketra('bench', '', 'Bench', noop_set_state=True)._parse_json_db(groups)
+
+
+def setup_colors_lazy(count):
+    outputs = _loaded(count).outputs
+
+    def run():
+        for output in outputs:
+            output._rgb = output._hs = None
+        for output in outputs:
+            output.rgb
+            output.hs
+    return run
+
+
+def setup_colors_batch(count):
+    ketra = _loaded(count)
+
+    def run():
+        for output in ketra.outputs:
+            output._rgb = output._hs = None
+        ketra.precompute_colors()
+    return run
+
+
+def setup_setter_states(count):
+    output = _loaded(1).outputs[0]
+    values = [i / float(count) for i in range(count)]
+
+    def run():
+        for value in values:
+            Output._state_for_rgb((value, 1.0 - value, 0.5))
+            Output._state_for_hs((value * 360, value))
+            output._state_for_cct(2000 + value * 4000)
+    return run
+
+
+def setup_cct(count, convert):
+    kelvins = [1000 + i * 39000.0 / count for i in range(count)]
+    return lambda: [convert(kelvin) for kelvin in kelvins]
+
+
+BENCHMARKS = [
+    ('parse_100', lambda: setup_parse(100)),
+    ('parse_1k', lambda: setup_parse(1000)),
+    ('parse_10k', lambda: setup_parse(10000)),
+    ('parse_stream_10k', lambda: setup_parse_stream(10000)),
+    ('register_duplicates_10k', lambda: setup_register_duplicates(10000)),
+    ('colors_lazy_1k', lambda: setup_colors_lazy(1000)),
+    ('colors_batch_10k', lambda: setup_colors_batch(10000)),
+    ('setter_states_1k', lambda: setup_setter_states(1000)),
+    ('cct_to_xy_10k', lambda: setup_cct(10000, cctKelvin_to_xyColor)),
+    ('cct_to_xy_fast_10k', lambda: setup_cct(10000, cctKelvin_to_xyColor_fast)),
+]
+
+
+def _time(run):
+    gc.collect()
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+def measure(benchmarks, rounds, min_time=0.1):
+    """Returns {name: {'time': seconds, 'peak': bytes}} for the (name,
+    setup) pairs in benchmarks. They run in interleaved rounds, so a stretch
+    of noise from elsewhere on the machine slows one round of each rather
+    than every run of one. In each round a benchmark runs at least once and
+    until min_time seconds have been spent on it; its time is the best of
+    all its runs."""
+    best = {}
+    for _ in range(rounds):
+        for name, setup in benchmarks:
+            spent = 0.0
+            while spent < min_time or name not in best:
+                elapsed = _time(setup())
+                spent += elapsed
+                best[name] = min(best.get(name, elapsed), elapsed)
+    results = {}
+    for name, setup in benchmarks:
+        run = setup()
+        gc.collect()
+        tracemalloc.start()
+        run()
+        results[name] = {'time': best[name],
+                         'peak': tracemalloc.get_traced_memory()[1]}
+        tracemalloc.stop()
+    return results
+
+
+def compare(results, baseline, tolerance, noise_floor):
+    """Returns the report lines and whether anything regressed."""
+    lines = ['%-26s %10s %10s %8s %8s' % ('benchmark', 'ms', 'peak KiB', 'time', 'memory')]
+    regressed = False
+    for name, result in results.items():
+        old = baseline.get(name)
+        ratios = ('', '')
+        flag = ''
+        if old:
+            time_ratio = result['time'] / old['time']
+            peak_ratio = result['peak'] / float(old['peak'] or 1)
+            ratios = ('%.2fx' % time_ratio, '%.2fx' % peak_ratio)
+            slower = (time_ratio > tolerance and
+                      result['time'] - old['time'] > noise_floor)
+            if slower or peak_ratio > tolerance:
+                flag = '  REGRESSION'
+                regressed = True
+        lines.append('%-26s %10.2f %10.1f %8s %8s%s' % (
+            name, result['time'] * 1000, result['peak'] / 1024.0, ratios[0],
+            ratios[1], flag))
+    return lines, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('only', nargs='*',
+                        help='run only benchmarks whose names contain one of these')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    parser.add_argument('--noise-floor', type=float, default=0.002,
+                        help='seconds of slowdown never flagged (default 0.002)')
+    parser.add_argument('--save', action='store_true',
+                        help='write the results to the baseline file')
+    args = parser.parse_args(argv)
+
+    benchmarks = [(name, setup) for name, setup in BENCHMARKS
+                  if not args.only or any(part in name for part in args.only)]
+    results = measure(benchmarks, args.rounds)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    lines, regressed = compare(results, {} if args.save else baseline, args.tolerance,
+                               args.noise_floor)
+    print('\n'.join(lines))
+    print("memory per output: %.0f bytes" % bench_output_memory())
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print("saved baseline to %s" % args.baseline)
+        return 0
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
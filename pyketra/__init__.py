@@ -24,36 +24,116 @@ import logging
 import threading
 import time
 import base64
+import bisect
+import codecs
+import asyncio
+import contextlib
+import hashlib
+import os
+import random
 import re
 import json
+import selectors
 import socket
+import tempfile
+import weakref
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from math import log
 from urllib.parse import quote
 # from urllib import disable_warnings
 from colormath.color_objects import LabColor, xyYColor, sRGBColor, HSVColor
 from colormath.color_conversions import convert_color
+from colormath.chromatic_adaptation import apply_chromatic_adaptation
+import numpy
 import requests
 
 import ssl
-from urllib3.util.ssl_ import create_urllib3_context
+from urllib3.connection import HTTPConnection
 from urllib3.poolmanager import PoolManager
 from requests.adapters import HTTPAdapter
 
-ctx = create_urllib3_context()
-ctx.load_default_certs()
-ctx.options |= 0x4  # ssl.OP_LEGACY_SERVER_CONNECT
-print("ALLOW_LEGACY_SERVER_CONNECT")
-
 # urllib.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 _LOGGER = logging.getLogger(__name__)
 
+
+class KetraSSLContext(ssl.SSLContext):
+    """SSLContext for talking to one N4.
+
+    The N4 presents a self-signed certificate, so it is not verified (the
+    equivalent of verify=False), and legacy renegotiation is allowed.  New
+    connections offer the TLS session of an earlier connection to the same
+    N4, so they can resume it instead of doing a full handshake; the counters
+    handshakes and sessions_reused show how well that works."""
+
+    def __new__(cls):
+        return super(KetraSSLContext, cls).__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self):
+        super(KetraSSLContext, self).__init__()
+        self.check_hostname = False
+        self.verify_mode = ssl.CERT_NONE
+        self.options |= 0x4  # ssl.OP_LEGACY_SERVER_CONNECT
+        self.handshakes = 0
+        self.sessions_reused = 0
+        self._session = None
+        self._recent = deque(maxlen=8)  # weakrefs to recently opened connections
+
+    def _resumable_session(self):
+        """Returns the newest session we know of that can be resumed.  With
+        TLS 1.3 the ticket only arrives after the handshake, so look at the
+        recently opened connections first."""
+        for ref in reversed(self._recent):
+            conn = ref()
+            if conn is None:
+                continue
+            try:
+                session = conn.session
+            except (ValueError, AttributeError):
+                continue
+            if session is not None and (session.has_ticket or session.id):
+                self._session = session
+                break
+        return self._session
+
+    def _track(self, conn):
+        self.handshakes += 1
+        if conn.session_reused:
+            self.sessions_reused += 1
+        self._recent.append(weakref.ref(conn))
+        return conn
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if kwargs.get('session') is None:
+            kwargs['session'] = self._resumable_session()
+        return self._track(super(KetraSSLContext, self).wrap_socket(sock, *args, **kwargs))
+
+    def wrap_bio(self, incoming, outgoing, *args, **kwargs):
+        # Used by asyncio; the handshake has not happened yet when this
+        # returns, so resumption is counted when the next connection is made.
+        if kwargs.get('session') is None:
+            kwargs['session'] = self._resumable_session()
+        conn = super(KetraSSLContext, self).wrap_bio(incoming, outgoing, *args, **kwargs)
+        self._recent.append(weakref.ref(conn))
+        return conn
+
+
 class KetraHttpAdapter(HTTPAdapter):
-    """"Transport adapter" that allows us to connect to Ketra"""
+    """"Transport adapter" that allows us to connect to Ketra.
 
-    def init_poolmanager(self, connections, maxsize, block=False):
-        self.poolmanager = PoolManager(ssl_context=ctx)
+    Holds up to pool_maxsize kept-alive connections to the N4, all made with
+    ssl_context."""
 
-ketra_session = requests.Session()
+    def __init__(self, ssl_context=None, **kwargs):
+        self._ssl_context = ssl_context or KetraSSLContext()
+        super(KetraHttpAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        socket_options = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        self.poolmanager = PoolManager(num_pools=connections, maxsize=maxsize,
+                                       block=block, ssl_context=self._ssl_context,
+                                       socket_options=socket_options, **pool_kwargs)
 
 def xml_escape(s):
     """Escape XML meta characters '<' and '&'."""
@@ -112,50 +192,269 @@ def cctKelvin_to_rgbColor(kelvin):
 def cctKelvin_to_xyColor(kelvin):
     """Convert from a kelvin color temperature to an xy-encoded color."""
     [red, green, blue] = cctKelvin_to_rgbColor(kelvin)
-    _LOGGER.info("kelvin %s converts to %d,%d,%d", kelvin, red, green, blue)
+    _LOGGER.debug("kelvin %s converts to %d,%d,%d", kelvin, red, green, blue)
     srgb = sRGBColor(red, green, blue)
     xyY = convert_color(srgb, xyYColor)
     return [xyY.xyy_x, xyY.xyy_y]
 
 
+# The CCT range Ketra lamps support, and the spacing of the lookup table
+# used by cctKelvin_to_xyColor_fast.  6600K, where the formula above jumps
+# between branches, falls on a table entry.
+KETRA_CCT_MIN = 1400
+KETRA_CCT_MAX = 10000
+_CCT_TABLE_STEP = 10
+_cct_table = None
+
+
+def _get_cct_table():
+    """Returns the lookup table, building it on first use.  Entry i holds the
+    [x, y] just below its kelvin, at it, and just above it.  These differ only
+    where the formula is discontinuous; interpolating between the one-sided
+    values keeps each segment clear of the jump."""
+    global _cct_table
+    if _cct_table is None:
+        _cct_table = [(cctKelvin_to_xyColor(kelvin - 1e-6),
+                       cctKelvin_to_xyColor(kelvin),
+                       cctKelvin_to_xyColor(kelvin + 1e-6))
+                      for kelvin in range(KETRA_CCT_MIN, KETRA_CCT_MAX + 1,
+                                          _CCT_TABLE_STEP)]
+    return _cct_table
+
+
+def cctKelvin_to_xyColor_fast(kelvin):
+    """Like cctKelvin_to_xyColor, but interpolated from a precomputed table
+    (to within 1e-4), so it is cheap enough to call constantly.  kelvin is
+    clamped to the range Ketra lamps support."""
+    table = _get_cct_table()
+    kelvin = min(max(kelvin, KETRA_CCT_MIN), KETRA_CCT_MAX)
+    i, frac = divmod(kelvin - KETRA_CCT_MIN, _CCT_TABLE_STEP)
+    i = int(i)
+    if frac == 0:
+        return list(table[i][1])
+    frac /= _CCT_TABLE_STEP
+    [x0, y0], [x1, y1] = table[i][2], table[i + 1][0]
+    return [x0 + (x1 - x0) * frac, y0 + (y1 - y0) * frac]
+
+
+def _xyz_to_linear_srgb_matrix():
+    """Returns the matrix colormath applies to take an xyYColor's XYZ (which
+    is relative to d50) to linear sRGB: Bradford adaptation to sRGB's d65
+    white, then sRGB's xyz_to_rgb matrix."""
+    illuminant = xyYColor(0, 0, 0).illuminant
+    adaptation = numpy.array(
+        [apply_chromatic_adaptation(*column, orig_illum=illuminant,
+                                    targ_illum=sRGBColor.native_illuminant)
+         for column in numpy.eye(3)]).T
+    return numpy.dot(sRGBColor.conversion_matrices['xyz_to_rgb'], adaptation)
+
+_XYZ_TO_LINEAR_SRGB = _xyz_to_linear_srgb_matrix()
+
+
+def xy_to_rgb_hs(xs, ys):
+    """Converts sequences of x and y chromaticities (at Y=1) to sRGB and to
+    hue/saturation all at once with NumPy.
+
+    Returns (rgb, hs), arrays of shape (n, 3) and (n, 2). These match what
+    colormath's convert_color gives for xyYColor(x, y, 1) -> sRGBColor and
+    -> HSVColor to within 1e-9."""
+    x = numpy.asarray(xs, dtype=float)
+    y = numpy.asarray(ys, dtype=float)
+    nonzero = y != 0.0
+    safe_y = numpy.where(nonzero, y, 1.0)
+    xyz = numpy.stack([numpy.where(nonzero, x / safe_y, 0.0),
+                       numpy.where(nonzero, 1.0, 0.0),
+                       numpy.where(nonzero, (1.0 - x - y) / safe_y, 0.0)])
+    # colormath clamps negative (out of gamut) linear values to 0.
+    linear = numpy.maximum(numpy.dot(_XYZ_TO_LINEAR_SRGB, xyz), 0.0)
+    rgb = numpy.where(linear <= 0.0031308, linear * 12.92,
+                      1.055 * numpy.power(numpy.maximum(linear, 0.0031308), 1 / 2.4) - 0.055)
+
+    red, green, blue = rgb
+    var_max = rgb.max(axis=0)
+    var_min = rgb.min(axis=0)
+    delta = numpy.where(var_max == var_min, 1.0, var_max - var_min)
+    hue = numpy.select(
+        [var_max == var_min, var_max == red, var_max == green],
+        [0.0, (60.0 * ((green - blue) / delta) + 360) % 360.0,
+         60.0 * ((blue - red) / delta) + 120],
+        60.0 * ((red - green) / delta) + 240.0)
+    saturation = numpy.where(var_max == 0, 0.0,
+                             1.0 - var_min / numpy.where(var_max == 0, 1.0, var_max))
+    return rgb.T, numpy.stack([hue, saturation], axis=1)
+
+
+def xyColor_to_cctKelvin(x, y):
+    """Estimates the color temperature in kelvin of an xy chromaticity, using
+    McCamy's approximation (good near the Planckian locus). Returns None for
+    colors too far from the locus to have a meaningful one."""
+    if abs(0.1858 - y) < 1e-6:
+        return None
+    n = (x - 0.3320) / (0.1858 - y)
+    kelvin = ((449.0 * n + 3525.0) * n + 6823.3) * n + 5520.33
+    locus_x, locus_y = cctKelvin_to_xyColor_fast(kelvin)
+    if (x - locus_x) ** 2 + (y - locus_y) ** 2 > 0.05 ** 2:
+        return None
+    return kelvin
+
+
+N4_DISCOVERY_PORT = 4934       # UDP port N4s answer discovery broadcasts on
+DISCOVERY_CACHE_TTL = 24 * 3600  # seconds a discovery cache file stays valid
+
+
 def getMyIpAddress():
-    """Return local IP address, used for N4 device discovery."""
+    """Return local IP address, used for N4 device discovery.
+
+    This is the address of the interface holding the default route; without
+    one (e.g. an isolated lighting network), it falls back to the address
+    the host name resolves to, and finally to all interfaces ('')."""
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.connect(('8.8.8.8', 0))
-    outgoing_ip_address = s.getsockname()[0]
-    return outgoing_ip_address
+    try:
+        s.connect(('8.8.8.8', 9))
+        return s.getsockname()[0]
+    except OSError:
+        pass
+    finally:
+        s.close()
+    try:
+        address = socket.gethostbyname(socket.gethostname())
+        if not address.startswith('127.'):
+            return address
+    except OSError:
+        pass
+    return ''
+
+
+def _parse_discovery_reply(data, addr):
+    """Returns the fields of an N4's "key=value" per line discovery reply,
+    plus its address."""
+    response = {}
+    for line in data.decode('utf-8', 'replace').splitlines():
+        key, sep, value = line.partition('=')
+        if sep:
+            response[key.strip()] = value.strip()
+    response['address'] = str(addr[0])
+    return response
+
+
+def _read_discovery_cache(cache_file, ttl):
+    """Returns the devices in cache_file if it is younger than ttl seconds."""
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if 0 <= time.time() - cached['time'] <= ttl:
+            return cached['devices']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
 
-def discoverN4Device(n4_serial_number):
-    """Discover an N4 device given its serial number."""
-    _LOGGER.info("Discovering N4 with serial number %s", n4_serial_number)
+
+def _write_discovery_cache(cache_file, devices):
+    directory = os.path.dirname(os.path.abspath(cache_file))
+    fd, tmp = tempfile.mkstemp(prefix='.ketra_discovery_', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'time': time.time(), 'devices': devices}, f)
+        os.replace(tmp, cache_file)
+    except OSError as e:
+        _LOGGER.warning("Could not write discovery cache %s: %s", cache_file, e)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+def discoverN4Devices(timeout=1.0, serial=None, cache_file='ketra_discovery.json',
+                      cache_ttl=DISCOVERY_CACHE_TTL, interface=None,
+                      broadcast='255.255.255.255', port=N4_DISCOVERY_PORT):
+    """Discover the N4 devices on the local network.
+
+    Broadcasts one discovery request and collects replies for timeout
+    seconds, returning a list of dicts of each device's advertised fields
+    (e.g. 'serial') plus its 'address'. If serial is given, returns as soon
+    as that device answers. The results of a full scan are saved to
+    cache_file (None disables caching) and reused for cache_ttl seconds; a
+    cache without serial in it is ignored."""
+    if cache_file:
+        devices = _read_discovery_cache(cache_file, cache_ttl)
+        if devices is not None and (serial is None or
+                                    any(d.get('serial') == serial for d in devices)):
+            return devices
+
+    if interface is None:
+        interface = getMyIpAddress()
+    _LOGGER.info("Discovering N4s using local interface %s", interface or '*')
+    devices = {}
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    outgoing_ip_address = getMyIpAddress()
-    _LOGGER.info("Using local interface %s", outgoing_ip_address)
-    sock.bind((outgoing_ip_address, 0))
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    sock.setblocking(False)
-    attempt = 0
-    while attempt < 5:
-        attempt += 1
-        time.sleep(.1)
+    with sock, selectors.DefaultSelector() as selector:
+        sock.bind((interface, 0))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
         try:
-            sock.sendto("*", ('255.255.255.255', 4934))
-        except socket.error as e:
+            sock.sendto(b'*', (broadcast, port))
+        except OSError as e:
             _LOGGER.warning("Failed to discover N4, socket error %s", e)
-
-            t_end = time.time() + 1
-            while time.time() < t_end:
+            return []
+        deadline = time.monotonic() + timeout
+        found = False
+        while not found:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not selector.select(remaining):
+                break
+            while True:
                 try:
-                    data, addr = sock.recvfrom(1024)
-                    response = dict([s.split("=") for s in data.splitlines()])
-                    response["address"] = str(addr[0])
-                    if response["serial"] == n4_serial_number:
-                        _LOGGER.info("Found N4 at address %s", response["address"])
-                        return response["address"]
-                except socket.error:
-                    pass
+                    data, addr = sock.recvfrom(4096)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError as e:
+                    _LOGGER.debug("Discovery receive failed: %s", e)
+                    break
+                response = _parse_discovery_reply(data, addr)
+                key = response.get('serial', response['address'])
+                if key not in devices:
+                    _LOGGER.info("Found N4 %s at address %s", key, response['address'])
+                devices[key] = response
+                found = found or (serial is not None and key == serial)
+
+    devices = list(devices.values())
+    # A scan cut short for serial may have missed devices, so it is not
+    # cached as the whole network.
+    if cache_file and devices and not found:
+        _write_discovery_cache(cache_file, devices)
+    return devices
+
+
+def discoverN4Device(n4_serial_number, timeout=1.0, **kwargs):
+    """Discover an N4 device given its serial number; returns its address, or
+    None if it did not answer within timeout seconds. Other arguments are
+    passed to discoverN4Devices()."""
+    _LOGGER.info("Discovering N4 with serial number %s", n4_serial_number)
+    for device in discoverN4Devices(timeout, serial=n4_serial_number, **kwargs):
+        if device.get('serial') == n4_serial_number:
+            _LOGGER.info("Found N4 at address %s", device['address'])
+            return device['address']
     return None
 
+# Default deadlines, in seconds, of the requests pyketra makes to the N4, by
+# operation: loading the configuration, polling status, reading one group or
+# the keypads, and sending a command. Retries happen within the deadline.
+REQUEST_TIMEOUTS = {'load': 30.0, 'poll': 10.0, 'query': 5.0, 'set': 5.0}
+
+# Default TransitionTime (milliseconds) of the State updates pyketra sends:
+# how long the N4 takes to fade from the current state to the new one.
+DEFAULT_TRANSITION_TIME = 1000
+
+# Outcome of one State update sent by Ketra.set_states(): ok is a bool, latency
+# is in seconds, and error is the exception raised (None when ok).
+SetStateResult = namedtuple('SetStateResult', ['ok', 'latency', 'error'])
+
+
+# What changed when the groups were (re)loaded; each field is a list of
+# Outputs. Objects in removed are no longer registered with the Ketra.
+DbChanges = namedtuple('DbChanges', ['added', 'removed', 'renamed', 'changed'])
+
+
 class KetraException(Exception):
     """Top level module exception."""
     pass
@@ -171,26 +470,95 @@ class ConnectionExistsError(KetraException):
     pass
 
 
+class KetraRequestError(KetraException):
+    """Raised when a request to the controller fails. status is the HTTP
+    status the N4 answered with, or None if there was no answer."""
+
+    def __init__(self, message, status=None):
+        super(KetraRequestError, self).__init__(message)
+        self.status = status
+
+
+class KetraTimeoutError(KetraRequestError):
+    """Raised when a request to the controller, or the wait for one, takes
+    too long."""
+    pass
+
+
+class CircuitOpenError(KetraRequestError):
+    """Raised without contacting the controller while its circuit breaker
+    is open, i.e. it has been failing and is presumed down."""
+    pass
+
+
 class KetraConnection(threading.Thread):
-    """Encapsulates the connection to the Ketra controller."""
+    """Encapsulates the connection to the Ketra controller.
+
+    The N4 does not push status, so this thread polls it: each cycle reads
+    every group's state in one request (Ketra.poll). The interval adapts,
+    dropping to min_interval after a change is seen or a command is sent
+    (note_activity), and growing by a factor of backoff per quiet cycle up
+    to max_interval."""
 
-    def __init__(self, host, password):
+    def __init__(self, ketra, min_interval=1.0, max_interval=30.0, backoff=1.5):
         """Initializes the ketra connection, doesn't actually connect."""
         threading.Thread.__init__(self)
 
-        self._host = host
-        self._password = password
+        self._ketra = ketra
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._backoff = backoff
+        self._interval = min_interval
+        self._next_poll = 0
+        self._cond = threading.Condition()
         self._done = False
 
-        self.setDaemon(True)
+        self.daemon = True
+
+    def note_activity(self):
+        """Tells the poller something is probably changing, so it should poll
+        again soon."""
+        with self._cond:
+            self._interval = self._min_interval
+            self._next_poll = min(self._next_poll, time.monotonic() + self._min_interval)
+            self._cond.notify()
 
+    def stop(self):
+        """Asks the thread to exit."""
+        with self._cond:
+            self._done = True
+            self._cond.notify()
+
+    @property
+    def interval(self):
+        """The current polling interval in seconds."""
+        return self._interval
 
     # KetraConnection
     def run(self):
         """Main thread function to maintain connection and receive remote status."""
         _LOGGER.info("Started")
         while True:
-            time.sleep(10)
+            with self._cond:
+                while not self._done:
+                    now = time.monotonic()
+                    if now >= self._next_poll:
+                        break
+                    self._cond.wait(self._next_poll - now)
+                if self._done:
+                    return
+            try:
+                changed = self._ketra._shared_poll()
+            except Exception as e:
+                _LOGGER.warning("Polling %s failed: %s", self._ketra._host, e)
+                changed = None
+            with self._cond:
+                if changed:
+                    self._interval = self._min_interval
+                else:
+                    self._interval = min(self._interval * self._backoff,
+                                         self._max_interval)
+                self._next_poll = time.monotonic() + self._interval
 
 
 class KetraJsonDbParser:
@@ -200,10 +568,12 @@ class KetraJsonDbParser:
     (Output). We handle the most relevant features, but some things like LEDs,
     etc. are not implemented."""
 
-    def __init__(self, ketra, area, json_db):
-        """Initializes the JSON parser, takes the JSON data as structured object."""
+    def __init__(self, ketra, area, json_db, output_class=None):
+        """Initializes the JSON parser, takes the JSON data as structured object.
+        output_class defaults to Output and must take the same constructor args."""
         self._ketra = ketra
         self._json_db = json_db
+        self._output_class = output_class or Output
         self.outputs = []
         self.id_to_area = {}
         self.id_to_load = {}
@@ -240,6 +610,36 @@ class KetraJsonDbParser:
                     note='')
         return area
 
+    @staticmethod
+    def _area_path(output_json):
+        """Returns the list of area names, outermost first, that a group is in
+        below the root area. Groups may carry an Area, either a list of names
+        or a "/"-separated string such as "Floor 1/Kitchen", and/or a Room.
+        Neither field is in the groups misc/KetraN4APIExample.py shows, so
+        groups without them stay in the root area."""
+        path = output_json.get('Area') or []
+        if isinstance(path, str):
+            path = path.split('/')
+        path = [name.strip() for name in path if name and name.strip()]
+        room = output_json.get('Room')
+        if room and room.strip():
+            path.append(room.strip())
+        return path
+
+    def _area_for(self, path):
+        """Returns the Area for a list of names below the root area, creating
+        it and any missing ancestors."""
+        area = self.id_to_area[self._area]
+        for name in path:
+            uid = area.uid + '/' + name
+            child = self.id_to_area.get(uid)
+            if child is None:
+                child = Area(self._ketra, name=name, parent=area, uid=uid, note='')
+                area.add_child(child)
+                self.id_to_area[uid] = child
+            area = child
+        return area
+
     def _parse_output(self, output_json):
         """Parses a load, which is generally a switch controlling a set of
         lights/outlets, etc."""
@@ -248,53 +648,509 @@ class KetraJsonDbParser:
             out_name = out_name.strip()
         else:
             _LOGGER.info("Using dname = %s", out_name)
-        area_id = self._area
+        area_id = self._area_for(self._area_path(output_json)).uid
 
-#    area_name = self.id_to_area[area_id].name
         load_type = "Ketra_light"
         state = output_json['State']
         xy_chroma = [state['xChromaticity'], state['yChromaticity']]
         level = state['Brightness']
 
-        output = Output(self._ketra,
+        output = self._output_class(self._ketra,
                         name=out_name,
                         area=area_id,
                         output_type='light',
                         xy_chroma=xy_chroma,
                         level=level,
                         load_type=load_type,
-                        uid=output_json['Id'])
+                        uid=output_json['Id'],
+                        power=state.get('PowerOn'))
         return output
 
+    def parse_keypads(self, keypads_json):
+        """Creates the Keypads, and their Buttons, from the content of the N4
+        keypads response. id_to_area must already hold the top area."""
+        keypads = []
+        for keypad_json in keypads_json:
+            keypad = self._parse_keypad(keypad_json)
+            for button_json in keypad_json.get('Buttons') or ():
+                keypad.add_button(self._parse_button(button_json, keypad))
+            self.id_to_keypad[keypad.uid] = keypad
+            self.id_to_area[keypad.area].add_keypad(keypad)
+            keypads.append(keypad)
+        return keypads
+
     def _parse_keypad(self, keypad_json):
         """Parses a keypad device."""
-        area_id = int(keypad_json.find('Area').text)
+        area_id = self._area_for(self._area_path(keypad_json)).uid
         keypad = Keypad(self._ketra,
-                        name=keypad_json.find('Name').text,
+                        name=(keypad_json['Name'] or '').strip(),
                         area=area_id,
-                        uid=int(keypad_json.get('ID'))) #TODO Case right? or Id
+                        uid=keypad_json.get('Id') or keypad_json['Name'])
         return keypad
 
-    def _parse_button(self, component_json):
-        """Parses a button device that part of a keypad."""
-        button_json = component_json.find('Button')
-        name = button_json.get('Engraving')
+    def _parse_button(self, button_json, keypad):
+        """Parses a button that is part of a keypad."""
+        n4_name = button_json.get('Name')
+        name = n4_name or button_json.get('Engraving')
         button_type = button_json.get('ButtonType')
         direction = button_json.get('Direction')
         # Hybrid keypads have dimmer buttons which have no engravings.
-        if button_type == 'SingleSceneRaiseLower':
+        if button_type == 'SingleSceneRaiseLower' and direction:
             name = 'Dimmer ' + direction
         if not name:
             name = "Unknown Button"
         button = Button(self._ketra,
                         name=name,
-                        area=None,
-                        uid=None, # TODO: is this available
-                        num=int(component_json.get('ComponentNumber')),
+                        area=keypad.area,
+                        uid=button_json.get('Id'),
+                        num=int(button_json.get('Position') or len(keypad.buttons) + 1),
                         button_type=button_type,
-                        direction=direction)
+                        direction=direction,
+                        keypad=keypad,
+                        n4_name=n4_name)
+        self.id_to_button[button.uid] = button
         return button
 
+# The groups cache file is a fixed-width, one-line JSON header,
+# {"sha256": ..., "version": ...}, followed by the raw groups response; the
+# hash covers the response.
+CACHE_VERSION = 2
+_CHUNK_SIZE = 64 * 1024
+
+
+def _cache_header(digest):
+    return (json.dumps({'sha256': digest, 'version': CACHE_VERSION},
+                       sort_keys=True) + '\n').encode('utf-8')
+
+
+class _CacheWriter:
+    """Writes a groups response through to the cache file chunk by chunk as it
+    streams past, then atomically replaces the old cache with it. Failures to
+    write are logged and otherwise ignored."""
+
+    def __init__(self, filename):
+        """filename may be None to only hash the response."""
+        self._filename = filename
+        self._sha = hashlib.sha256()
+        self._file = None
+        if filename is None:
+            return
+        try:
+            fd, self._tmpname = tempfile.mkstemp(
+                prefix=os.path.basename(filename) + '.',
+                dir=os.path.dirname(filename) or '.')
+            self._file = os.fdopen(fd, "wb")
+            self._file.write(_cache_header('0' * 64))  # rewritten in commit()
+        except Exception as e:
+            self._fail(e)
+
+    def _fail(self, e):
+        _LOGGER.warning("Exception = %s; could not save %s", e, self._filename)
+        self.discard()
+
+    @property
+    def digest(self):
+        """The sha256 of everything passed through tee() so far."""
+        return self._sha.hexdigest()
+
+    def tee(self, chunks):
+        """Yields chunks unchanged, hashing and saving each one on the way."""
+        for chunk in chunks:
+            self._sha.update(chunk)
+            if self._file is not None:
+                try:
+                    self._file.write(chunk)
+                except Exception as e:
+                    self._fail(e)
+            yield chunk
+
+    def commit(self):
+        """Finishes the file and moves it into place as the cache."""
+        if self._file is None:
+            return
+        try:
+            self._file.seek(0)
+            self._file.write(_cache_header(self.digest))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+            os.replace(self._tmpname, self._filename)
+            _LOGGER.info("wrote file %s", self._filename)
+        except Exception as e:
+            self._fail(e)
+
+    def discard(self):
+        """Throws away the partly written file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.unlink(self._tmpname)
+
+
+class _GroupStreamDecoder:
+    """Incrementally decodes an N4 groups response, {"Content": [group, ...],
+    ...}. feed() returns each group as soon as its JSON is complete, so only
+    about one chunk and one group are held at a time. The envelope's other
+    fields end up in envelope."""
+
+    _INCOMPLETE = object()
+
+    def __init__(self):
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._state = 'start'
+        self._key = None
+        self._saw_content = False
+        self.envelope = {}
+
+    def feed(self, data, final=False):
+        """Adds the next bytes of the response; returns the groups completed."""
+        self._buf = self._buf[self._pos:] + self._text.decode(data, final)
+        self._pos = 0
+        groups = []
+        while self._step(groups, final):
+            pass
+        return groups
+
+    def close(self):
+        """Marks the end of the response; returns any last groups."""
+        groups = self.feed(b'', final=True)
+        if self._state != 'done' or not self._saw_content:
+            raise ValueError("truncated or malformed groups response")
+        return groups
+
+    def _decode(self, final):
+        """Decodes the JSON value at the current position."""
+        try:
+            value, end = self._json.raw_decode(self._buf, self._pos)
+        except ValueError:
+            if final:
+                raise
+            return self._INCOMPLETE
+        if end == len(self._buf) and not final and self._buf[self._pos] in '-0123456789':
+            return self._INCOMPLETE  # the number may go on in the next chunk
+        self._pos = end
+        return value
+
+    def _step(self, groups, final):
+        """Consumes one token or value; returns False when more input is needed."""
+        buf = self._buf
+        while self._pos < len(buf) and buf[self._pos] in ' \t\r\n':
+            self._pos += 1
+        if self._pos == len(buf):
+            return False
+        c = buf[self._pos]
+        state = self._state
+        if state == 'done':
+            raise ValueError("unexpected data after groups response")
+        if c in '{:,]}' and (state, c) in _STREAM_PUNCTUATION:
+            self._pos += 1
+            self._state = _STREAM_PUNCTUATION[(state, c)]
+            if self._state == 'value' and self._key == 'Content':
+                self._state = 'content'
+            return True
+        if state == 'content' and c == '[':
+            self._pos += 1
+            self._state = 'array'
+            self._saw_content = True
+            return True
+        if state not in ('key', 'value', 'content', 'array'):
+            raise ValueError("malformed groups response at %r" % buf[self._pos:self._pos + 20])
+        value = self._decode(final)
+        if value is self._INCOMPLETE:
+            return False
+        if state == 'key':
+            self._key = value
+            self._state = 'colon'
+        elif state == 'array':
+            groups.append(value)
+        else:
+            self.envelope[self._key] = value
+            self._saw_content = self._saw_content or self._key == 'Content'
+            self._state = 'key'
+        return True
+
+
+# (state, character) -> next state for the punctuation of a groups response.
+_STREAM_PUNCTUATION = {
+    ('start', '{'): 'key',
+    ('key', ','): 'key',
+    ('key', '}'): 'done',
+    ('colon', ':'): 'value',
+    ('array', ','): 'array',
+    ('array', ']'): 'key',
+}
+
+
+def _iter_groups(chunks):
+    """Yields the groups of a groups response given as an iterable of bytes."""
+    decoder = _GroupStreamDecoder()
+    for chunk in chunks:
+        for group in decoder.feed(chunk):
+            yield group
+    for group in decoder.close():
+        yield group
+
+
+def _read_until(chunks, deadline):
+    """Yields the response body chunks, raising KetraTimeoutError if they are
+    still coming at deadline (a time.monotonic() value)."""
+    try:
+        for chunk in chunks:
+            if time.monotonic() > deadline:
+                raise KetraTimeoutError("Timed out reading the response")
+            yield chunk
+    except requests.RequestException as e:
+        raise KetraRequestError("Reading the response failed: %s" % e) from e
+
+
+class _SerializedState(dict):
+    """A State dictionary that carries its JSON encoding, made once up front
+    so sending it costs no encoding."""
+
+    __slots__ = ('body',)
+
+    def __init__(self, state):
+        super(_SerializedState, self).__init__(state)
+        self.body = json.dumps(state)
+
+
+def _state_body(state):
+    """Returns the JSON request body for a State dictionary or JSON string."""
+    if isinstance(state, str):
+        return state
+    if isinstance(state, _SerializedState):
+        return state.body
+    return json.dumps(state)
+
+
+class Snapshot:
+    """The saved brightness, chromaticity and power of some outputs, made by
+    Ketra.snapshot() and put back by Ketra.restore().
+
+    The State bodies that restoring sends are encoded when the snapshot is
+    made or loaded, so restoring only compares and sends. Snapshots are
+    keyed by output id and survive to_json()/from_json() for storing
+    scenes."""
+
+    FORMAT_VERSION = 1
+
+    __slots__ = ('_states', '_bodies')
+
+    def __init__(self, states):
+        """states maps output ids to [brightness, x, y, power on]."""
+        self._states = states
+        self._bodies = {uid: _SerializedState(self._state(saved))
+                        for uid, saved in states.items()}
+
+    @staticmethod
+    def _state(saved):
+        brightness, x, y, power = saved
+        state = {"Brightness": brightness,
+                 "xChromaticity": x,
+                 "yChromaticity": y,
+                 "TransitionTime": DEFAULT_TRANSITION_TIME,
+                 "TransitionComplete": True}
+        if power is not None:
+            state["PowerOn"] = power
+        return state
+
+    @classmethod
+    def of(cls, outputs):
+        """Returns a snapshot of the cached state of outputs."""
+        return cls({output.uid: [output._level, output._xy[0], output._xy[1],
+                                 output._power]
+                    for output in outputs})
+
+    def __len__(self):
+        return len(self._states)
+
+    @property
+    def uids(self):
+        """Returns the ids of the outputs in the snapshot."""
+        return list(self._states)
+
+    def differs(self, output):
+        """Returns True if output's cached state is not what was saved."""
+        brightness, x, y, power = self._states[output.uid]
+        return (output._level != brightness or output._xy[0] != x or
+                output._xy[1] != y or (power is not None and output._power != power))
+
+    def to_json(self):
+        """Returns the snapshot as a JSON string."""
+        return json.dumps({'version': self.FORMAT_VERSION, 'states': self._states},
+                          separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text):
+        """Returns the snapshot saved by to_json()."""
+        saved = json.loads(text)
+        if saved.get('version') != cls.FORMAT_VERSION:
+            raise KetraException("snapshot version %s, want %s" % (
+                saved.get('version'), cls.FORMAT_VERSION))
+        return cls(saved['states'])
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class EntityIndex:
+    """Looks up entities (Outputs, Keypads) by id, name, area or part of
+    their name.
+
+    Names are kept unique: add() gives an entity its name, or the name
+    numbered " 2", " 3", ... if it is taken, in constant time per insert.
+    Id, name and area lookups are dict lookups. prefix() bisects a sorted
+    name list and search() intersects a trigram index; both are built on
+    first use and kept up to date after that."""
+
+    def __init__(self):
+        self._by_uid = {}
+        self._by_name = {}       # unique name -> entity
+        self._names = {}         # entity -> unique name
+        self._given = {}         # entity -> name as given, for numbered entities
+        self._by_area = {}       # area id -> {entity: None}, in insertion order
+        self._next_suffix = {}   # name as given -> next number to try
+        self._lower = None       # lowercased name -> [entity], built by prefix()
+        self._sorted = None      # sorted keys of _lower, or None if stale
+        self._trigrams = None    # trigram of lowercased name -> set of entities
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, obj):
+        return obj in self._names
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def _unique_name(self, name):
+        if name not in self._by_name:
+            return name
+        i = self._next_suffix.get(name, 2)
+        while "%s %d" % (name, i) in self._by_name:
+            i += 1
+        self._next_suffix[name] = i + 1
+        return "%s %d" % (name, i)
+
+    def add(self, obj, name):
+        """Indexes obj under name, or a numbered variant of it if the name is
+        taken, and returns the name used."""
+        unique = self._unique_name(name)
+        self._by_uid[obj.uid] = obj
+        self._by_name[unique] = obj
+        self._names[obj] = unique
+        if unique != name:
+            self._given[obj] = name
+        self._by_area.setdefault(obj.area, {})[obj] = None
+        lower = unique.lower()
+        if self._lower is not None:
+            if lower not in self._lower:
+                self._lower[lower] = []
+                self._sorted = None
+            self._lower[lower].append(obj)
+        if self._trigrams is not None:
+            for trigram in _trigrams(lower):
+                self._trigrams.setdefault(trigram, set()).add(obj)
+        return unique
+
+    def remove(self, obj):
+        """Drops obj from the index."""
+        unique = self._names.pop(obj)
+        self._given.pop(obj, None)
+        if self._by_uid.get(obj.uid) is obj:
+            del self._by_uid[obj.uid]
+        del self._by_name[unique]
+        area = self._by_area[obj.area]
+        del area[obj]
+        if not area:
+            del self._by_area[obj.area]
+        lower = unique.lower()
+        if self._lower is not None:
+            same = self._lower[lower]
+            same.remove(obj)
+            if not same:
+                del self._lower[lower]
+                self._sorted = None
+        if self._trigrams is not None:
+            for trigram in _trigrams(lower):
+                entities = self._trigrams[trigram]
+                entities.discard(obj)
+                if not entities:
+                    del self._trigrams[trigram]
+
+    def set_area(self, obj, area, old_area):
+        """Records that obj moved from old_area to area (area ids)."""
+        entities = self._by_area[old_area]
+        del entities[obj]
+        if not entities:
+            del self._by_area[old_area]
+        self._by_area.setdefault(area, {})[obj] = None
+
+    def get(self, uid):
+        """Returns the entity with id uid, or None."""
+        return self._by_uid.get(uid)
+
+    def named(self, name):
+        """Returns the entity with the (unique) name, or None."""
+        return self._by_name.get(name)
+
+    def given_name(self, obj):
+        """Returns the name obj was added with, before any numbering."""
+        return self._given.get(obj) or self._names[obj]
+
+    def in_area(self, area):
+        """Returns the list of entities in area (an Area or its id)."""
+        if isinstance(area, Area):
+            area = area.uid
+        return list(self._by_area.get(area, ()))
+
+    @property
+    def areas(self):
+        """Returns the ids of the areas that have entities."""
+        return list(self._by_area)
+
+    def prefix(self, text):
+        """Returns the entities whose names start with text, ignoring case,
+        sorted by name."""
+        if self._lower is None:
+            self._lower = {}
+            for obj, unique in self._names.items():
+                self._lower.setdefault(unique.lower(), []).append(obj)
+        if self._sorted is None:
+            self._sorted = sorted(self._lower)
+        text = text.lower()
+        found = []
+        for i in range(bisect.bisect_left(self._sorted, text), len(self._sorted)):
+            if not self._sorted[i].startswith(text):
+                break
+            found.extend(self._lower[self._sorted[i]])
+        return found
+
+    def search(self, text):
+        """Returns the entities whose names contain text, ignoring case,
+        sorted by name."""
+        text = text.lower()
+        if len(text) < 3:
+            candidates = self._names
+        else:
+            if self._trigrams is None:
+                self._trigrams = {}
+                for obj, unique in self._names.items():
+                    for trigram in _trigrams(unique.lower()):
+                        self._trigrams.setdefault(trigram, set()).add(obj)
+            sets = sorted((self._trigrams.get(trigram, ()) for trigram in _trigrams(text)),
+                          key=len)
+            candidates = set(sets[0]).intersection(*sets[1:])
+        found = [obj for obj in candidates if text in self._names[obj].lower()]
+        found.sort(key=self._names.get)
+        return found
+
+
 class Ketra:
     """Main Ketra Controller class.
 
@@ -306,29 +1162,112 @@ class Ketra:
     OP_RESPONSE = 'R:'        # Response lines come back from Ketra with this prefix
     OP_STATUS = 'S:'          # Status report lines come back from Ketra with this prefix
 
-    def __init__(self, host, password, area, noop_set_state=False):
+    output_class = None       # class used for parsed groups; None means Output
+
+    def __init__(self, host, password, area, noop_set_state=False, pool_size=16,
+                 prewarm=False, coalesce_window=None, coalesce_max_latency=None,
+                 native_cct=False, poll_min_interval=1.0, poll_max_interval=30.0,
+                 event_workers=4, event_queue_depth=1024, state_ttl=None,
+                 max_rate=None, burst=None, timeouts=None, retries=2,
+                 retry_backoff=0.1, breaker_threshold=5, breaker_reset=30.0):
         """Initializes the Ketra object. No connection is made to the remote
-        device."""
+        device.
+
+        pool_size is the number of connections to the N4 kept open for reuse;
+        it should be at least the concurrency used with set_states(). If
+        prewarm is set, load_json_db() opens them all up front.
+
+        If coalesce_window (seconds) is set, the Output setters queue their
+        changes and changes to the same output are merged into one request
+        until the output has been quiet for coalesce_window, or for at most
+        coalesce_max_latency (default 4 * coalesce_window) after the first
+        queued change.
+
+        If native_cct is set, Output.cct sends the N4's own CCT state field
+        instead of converting the temperature to xy chromaticity.
+
+        After connect(), status is polled every poll_min_interval seconds
+        while things are changing, backing off to poll_max_interval when
+        idle. Subscribed handlers run on up to event_workers threads; at most
+        event_queue_depth objects wait for delivery (see subscribe()).
+
+        If state_ttl (seconds) is set, reading an Output's level or color
+        when the cached state is older than that first refreshes every output
+        with one groups request. Otherwise reads return the cached state; see
+        ensure_fresh() and Output.query() for explicit refreshes.
+
+        Requests pass through an AdmissionControl (see Ketra.admission) that
+        tunes how many are in flight, up to pool_size, from the N4's
+        response times and errors; max_rate (requests per second, with
+        bursts of burst) additionally caps the rate.
+
+        Every request has a deadline, by operation, from timeouts (a dict
+        overriding REQUEST_TIMEOUTS). Reads and State updates that time out,
+        fail to connect or get an overload response are retried up to
+        retries times within that deadline, after a random delay of up to
+        retry_backoff * 2**attempt seconds; button presses are not. After
+        breaker_threshold such failures in a row, requests fail right away
+        with CircuitOpenError until one probe, breaker_reset seconds later,
+        succeeds (see Ketra.breaker). Failed requests raise KetraRequestError
+        or one of its subclasses."""
         self._host = host
         self._password = password
+        self._pool_size = pool_size
+        self._prewarm = prewarm
+        self._ssl_context = KetraSSLContext()
+        self._adapter = KetraHttpAdapter(ssl_context=self._ssl_context,
+                                         pool_connections=1, pool_maxsize=pool_size)
+        self._session = requests.Session()
+        self._session.auth = ('', password)
+        self._session.mount(self._url(''), self._adapter)
+        self._coalescer = None
+        if coalesce_window:
+            self._coalescer = _WriteCoalescer(
+                self, coalesce_window, coalesce_max_latency or 4 * coalesce_window)
         self._name = None
-        self._conn = KetraConnection(host, password)
+        self._conn = KetraConnection(self, poll_min_interval, poll_max_interval)
         self._ids = {}
-        self._names = {}   # maps from unique name to id
-        self._subscribers = {}
+        self._index = EntityIndex()
+        self._events = _EventBus(event_workers, event_queue_depth)
+        self._state_ttl = state_ttl
+        self._states_fetched = None  # time.monotonic() of the last groups read
+        self._groups_reads = _RequestHelper()
+        self._request_slots = None  # semaphore shared by a KetraFleet
+        self._admission = AdmissionControl(pool_size, min(4, pool_size), max_rate, burst)
+        self._timeouts = dict(REQUEST_TIMEOUTS, **(timeouts or {}))
+        self._retries = retries
+        self._retry_backoff = retry_backoff
+        self._breaker = CircuitBreaker(breaker_threshold, breaker_reset)
         self._id_to_area = {}  # copied out from the parser
         self._id_to_load = {}  # copied out from the parser
         self._noop_set_state = noop_set_state
+        self._db_lock = threading.RLock()
+        self._db_loaded = False  # whether the outputs have been built
+        self._db_hash = None     # sha256 of the groups response in the cache file
+        self._revalidation = None
+        self._native_cct = native_cct
         self._area = area
         self._outputs = []
+        self._keypads = []
 
     def subscribe(self, obj, handler):
         """Subscribes to status updates of the requested object.
 
         The handler will be invoked when the controller sends a notification
         regarding changed state. The user can then further query the object for the
-        state itself."""
-        self._subscribers[obj] = handler
+        state itself.
+
+        obj may also be an Area, to hear about every output in it or in the
+        areas below it, or None to hear about everything. Any number of
+        handlers can subscribe to the same obj. Handlers are called with the changed object on the event
+        worker threads, never on the polling thread; if a consumer falls
+        behind, further changes to an object still waiting for delivery are
+        folded into that one pending notification."""
+        self._events.subscribe(obj, handler)
+
+    def unsubscribe(self, obj, handler):
+        """Removes a handler added with subscribe()."""
+        self._events.unsubscribe(obj, handler)
 
     #TODO: cleanup this awful logic
     def register_id(self, cmd_type, obj):
@@ -339,56 +1278,264 @@ class Ketra:
         if obj.uid in ids:
             raise IDExistsError("ID exists %s" % obj.uid)
         self._ids[cmd_type][obj.uid] = obj
-        obj.name = obj.name.strip()
-        if obj.name in self._names:
-            area = self._id_to_area.get(int(obj.area))
-            oldname = obj.name
-            newname = obj.name
-#      newname = "%s %s" % (area.name.title().strip(), obj.name)
-#      obj.name = newname
-            i = 2
-            while obj.name in self._names:
-                obj.name = newname + " " + str(i)
-                i += 1
+        self._register_name(obj, obj.name)
+
+    def _register_name(self, obj, name):
+        """Gives obj the name (stripped), or a numbered variant of it if the
+        name is already taken."""
+        name = name.strip()
+        obj.name = self._index.add(obj, name)
+        if obj.name != name:
+            area = self._id_to_area.get(obj.area)
             _LOGGER.warning("Repeated name `%s' in area %s - using %s",
-                            oldname, area.name, obj.name)
-        self._names[obj.name] = obj.uid
-
-    def load_json_db(self, disable_cache=False):
-        """Load the Ketra database from the server."""
-        filename = self._host + "_ketraconfig.txt"
-        json_db = ""
-        success = False
-        if not disable_cache:
-            try:
-                f = open(filename, "r")
-                json_db = json.loads(f.read())['Content']
-                _LOGGER.info("read cached ketra configuration file %s", filename)
-                f.close()
-                success = True
-            except Exception as e:
-                _LOGGER.warning("Failed loading cached config file for ketra: %s", e)
-
-        if not success:
-            groupsUrl = 'https://' + self._host + '/ketra.cgi/api/v1/groups'
-            _LOGGER.info("doing request for ketra configuration file ", groupsUrl)
-            ketra_session.mount(groupsUrl, KetraHttpAdapter())
-            r = ketra_session.get(groupsUrl, auth=('', self._password), verify=False)
-            # convert the response into a JSON object
-            responseEnvelope = r.json()
-            # pull the relevant content out of the response envelope
-            json_db = responseEnvelope['Content']
-            try:
-                f = open(filename, "w")
-                f.write(r.content.decode('utf-8'))
-                f.close()
-                _LOGGER.info("wrote file %s", filename)
-            except Exception as e:
-                _LOGGER.warning("Exception = %s; could not save %s", e, filename)
+                            name, area.name if area else obj.area, obj.name)
 
-        _LOGGER.info("Loaded json db")
+    def unregister_id(self, cmd_type, obj):
+        """Forgets an object registered with register_id."""
+        del self._ids[cmd_type][obj.uid]
+        self._release_name(obj)
 
-        parser = KetraJsonDbParser(ketra=self, area=self._area, json_db=json_db)
+    def _release_name(self, obj):
+        self._index.remove(obj)
+
+    def _base_name(self, obj):
+        """Returns the name obj was registered with, before any numbering."""
+        return self._index.given_name(obj)
+
+    @property
+    def index(self):
+        """The EntityIndex of the registered outputs and keypads."""
+        return self._index
+
+    def _cache_filename(self):
+        """Returns the name of the file used to cache the groups response."""
+        return self._host + "_ketraconfig.txt"
+
+    def _read_cached_db(self):
+        """Returns (iterator over the cached groups, hash of the cached
+        response), or (None, None) if there is no cache or it fails validation.
+        The file is checked, and later decoded, a chunk at a time."""
+        filename = self._cache_filename()
+        try:
+            with open(filename, "rb") as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                if header.get('version') != CACHE_VERSION:
+                    raise KetraException("cache version %s, want %s" % (
+                        header.get('version'), CACHE_VERSION))
+                sha = hashlib.sha256()
+                for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+                    sha.update(chunk)
+            digest = sha.hexdigest()
+            if digest != header.get('sha256'):
+                raise KetraException("cache content does not match its hash")
+        except Exception as e:
+            _LOGGER.warning("Failed loading cached config file for ketra: %s", e)
+            return None, None
+        _LOGGER.info("read cached ketra configuration file %s", filename)
+        return _iter_groups(self._cached_chunks(filename)), digest
+
+    def _load_cached_db(self):
+        """Loads the groups from a valid cache file; returns False if there
+        is none. Outputs already loaded are updated in place, as by
+        refresh(), and a cache holding what was last loaded is skipped."""
+        json_db, digest = self._read_cached_db()
+        if json_db is None:
+            return False
+        with self._db_lock:
+            if digest != self._db_hash:
+                self._load_groups(json_db)
+                self._db_hash = digest
+        return True
+
+    def _load_groups(self, json_db):
+        """Builds the outputs from the groups on the first load, and updates
+        them in place after that. Returns a DbChanges. Hold _db_lock."""
+        if not self._db_loaded:
+            self._parse_json_db(json_db)
+            self._db_loaded = True
+            return DbChanges(list(self._outputs), [], [], [])
+        return self._update_json_db(json_db)
+
+    @staticmethod
+    def _cached_chunks(filename):
+        """Yields the cached groups response in chunks, skipping the header."""
+        with open(filename, "rb") as f:
+            f.readline()
+            for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+                yield chunk
+
+    def _apply_fetched_groups(self, chunks, cache=True):
+        """Loads a freshly fetched groups response, given as an iterable of
+        bytes chunks. Groups are decoded as they arrive and, if cache is set,
+        the response is written through to the cache file, so it is never held
+        in memory whole. The first load builds the outputs; later ones update
+        them in place. Returns a DbChanges, or None if nothing changed."""
+        fetched = time.monotonic()
+        writer = _CacheWriter(self._cache_filename() if cache else None)
+        groups = _iter_groups(writer.tee(chunks))
+        try:
+            with self._db_lock:
+                changes = self._load_groups(groups)
+        except BaseException:
+            writer.discard()
+            raise
+        self._states_fetched = fetched
+        # _db_hash only follows what is in the cache file, so a response read
+        # without caching it (a poll) cannot make a later one look cached.
+        if cache and writer.digest != self._db_hash:
+            writer.commit()
+            self._db_hash = writer.digest
+        else:
+            writer.discard()
+        if not any(changes):
+            _LOGGER.debug("ketra configuration unchanged")
+            return None
+        return changes
+
+    def ensure_fresh(self, max_age=0, timeout=None):
+        """Makes sure the cached state of every output is at most max_age
+        seconds old, refreshing all of them with one groups request if not
+        (see poll()). max_age None accepts any age, and 0 always refreshes.
+        A groups read already in flight is shared rather than repeated;
+        waiting for it gives up with KetraTimeoutError after timeout seconds.
+        Returns True if a request was made or joined."""
+        if max_age is None:
+            return False
+        if (max_age > 0 and self._states_fetched is not None and
+                time.monotonic() - self._states_fetched <= max_age):
+            return False
+        self._shared_poll(timeout)
+        return True
+
+    def _shared_poll(self, timeout=None):
+        """poll(), sharing a call already in flight."""
+        return self._groups_reads.request(self.poll, timeout)
+
+    @property
+    def admission(self):
+        """The AdmissionControl pacing requests to this N4."""
+        return self._admission
+
+    @property
+    def breaker(self):
+        """The CircuitBreaker failing requests fast while this N4 is down."""
+        return self._breaker
+
+    @property
+    def request_stats(self):
+        """Counts of state reads sent to the N4 and of reads that shared an
+        in-flight one instead, as {'requests': n, 'deduplicated': n}."""
+        helpers = [self._groups_reads] + [output._waiters for output in self._outputs
+                                          if output._waiters is not None]
+        return {'requests': sum(helper.requests for helper in helpers),
+                'deduplicated': sum(helper.deduplicated for helper in helpers)}
+
+    def _read_through(self):
+        """Called before an Output getter returns cached state."""
+        if self._state_ttl is not None:
+            self.ensure_fresh(self._state_ttl)
+
+    def connect(self):
+        """Starts polling the N4 for status changes; subscribers are notified
+        of changed outputs. Call after load_json_db()."""
+        if self._conn.is_alive():
+            raise ConnectionExistsError("Already connected")
+        self._conn.start()
+
+    def poll(self):
+        """Reads every group's state in one request, updates the outputs that
+        changed (or were added or renamed) and notifies their subscribers.
+        The cache file is left alone. Returns the DbChanges, or None."""
+        with self._fetch_groups('poll') as chunks:
+            changes = self._apply_fetched_groups(chunks, cache=False)
+        if changes:
+            for output in changes.added + changes.renamed + changes.changed:
+                self._notify(output)
+        return changes
+
+    def _notify(self, obj):
+        """Queues obj for delivery to its subscribers."""
+        area = self._id_to_area.get(obj.area)
+        self._events.publish(obj, area.ancestry if area is not None else ())
+
+    def _update_json_db(self, json_db):
+        """Brings the loaded outputs in line with json_db, keeping the existing
+        Output objects (and so subscriptions to them): new groups are added,
+        missing ones removed, and renamed or changed ones updated in place.
+        Returns a DbChanges."""
+        changes = DbChanges([], [], [], [])
+        parser = KetraJsonDbParser(ketra=self, area=self._area, json_db=(),
+                                   output_class=self.output_class)
+        parser.id_to_area = self._id_to_area
+        seen = set()
+        for group in json_db:
+            uid = group['Id']
+            seen.add(uid)
+            output = self._id_to_load.get(uid)
+            if output is None:
+                output = parser._parse_output(group)
+                self._outputs.append(output)
+                self._id_to_load[uid] = output
+                self._id_to_area[output.area].add_output(output)
+                changes.added.append(output)
+                continue
+            name = (group['Name'] or '').strip()
+            if name != self._base_name(output):
+                self._release_name(output)
+                self._register_name(output, name)
+                changes.renamed.append(output)
+            changed = output._refresh_from_state(group['State'])
+            area = parser._area_for(parser._area_path(group))
+            if area.uid != output.area:
+                self._id_to_area[output.area].remove_output(output)
+                self._index.set_area(output, area.uid, output.area)
+                output._area = area.uid
+                area.add_output(output)
+                changed = True
+            if changed:
+                changes.changed.append(output)
+
+        if len(seen) != len(self._id_to_load):
+            for uid, output in list(self._id_to_load.items()):
+                if uid not in seen:
+                    del self._id_to_load[uid]
+                    self.unregister_id(Output.CMD_TYPE, output)
+                    self._id_to_area[output.area].remove_output(output)
+                    changes.removed.append(output)
+            self._outputs[:] = [output for output in self._outputs
+                                if output.uid in seen]
+
+        _LOGGER.info("ketra configuration updated: %d added, %d removed, "
+                     "%d renamed, %d changed", len(changes.added),
+                     len(changes.removed), len(changes.renamed), len(changes.changed))
+        return changes
+
+    def refresh(self):
+        """Re-reads the groups from the N4 and updates the loaded outputs in
+        place. Returns a DbChanges, or None if nothing changed."""
+        with self._fetch_groups('load') as chunks:
+            return self._apply_fetched_groups(chunks)
+
+    @contextlib.contextmanager
+    def _fetch_groups(self, operation):
+        """GETs the groups and yields the response body as an iterable of
+        chunks, which raises KetraTimeoutError if it is not all read within
+        operation's deadline."""
+        deadline = time.monotonic() + self._timeouts[operation]
+        with self._request('GET', 'groups', operation, retry=True, stream=True) as r:
+            yield _read_until(r.iter_content(_CHUNK_SIZE), deadline)
+
+    def _revalidate_db(self):
+        """Re-fetches the groups and reloads them if they changed."""
+        try:
+            self.refresh()
+        except Exception as e:
+            _LOGGER.warning("Failed revalidating ketra configuration: %s", e)
+
+    def _parse_json_db(self, json_db):
+        """Builds the areas and outputs from the groups content."""
+        parser = KetraJsonDbParser(ketra=self, area=self._area, json_db=json_db,
+                                   output_class=self.output_class)
         self._id_to_area = parser.id_to_area
         self._name = parser.project_name
         self._outputs = parser.outputs
@@ -399,65 +1546,942 @@ class Ketra:
                      self._name, len(self._id_to_area.keys()),
                      len(self._id_to_load.keys()))
 
+    def _url(self, path):
+        """Returns the full N4 API url for path (e.g. 'groups')."""
+        return 'https://' + self._host + '/ketra.cgi/api/v1/' + path
+
+    def _request(self, method, path, operation='query', retry=False, **kwargs):
+        """Performs one request against the N4 over the pooled connections and
+        returns the response, raising KetraRequestError (or a subclass) if it
+        fails or gets an error status. It must complete within the deadline
+        of operation (a REQUEST_TIMEOUTS key); if retry is set, transient
+        failures are retried within it."""
+        deadline = time.monotonic() + self._timeouts[operation]
+        attempt = 0
+        while True:
+            try:
+                return self._request_once(method, path, deadline, **kwargs)
+            except KetraRequestError as e:
+                delay = self._retry_delay(e, attempt, deadline) if retry else None
+                if delay is None:
+                    raise
+                _LOGGER.debug("Retrying %s %s in %.2fs: %s", method, path, delay, e)
+            time.sleep(delay)
+            attempt += 1
+
+    def _request_once(self, method, path, deadline, **kwargs):
+        """Sends one attempt at a request, once the circuit breaker and
+        admission control (and the fleet, if any) let it through before
+        deadline."""
+        self._breaker.allow()
+        try:
+            started = self._admission.acquire()
+        except BaseException:
+            self._breaker.abandon()
+            raise
+        ok = False
+        sent = False
+        slots = None
+        try:
+            if self._request_slots is not None:
+                if not self._request_slots.acquire(
+                        timeout=max(0.0, deadline - time.monotonic())):
+                    raise KetraTimeoutError("%s %s: no fleet connection free in time"
+                                            % (method, path))
+                slots = self._request_slots
+                # Time queued behind the fleet's other controllers is not
+                # this N4's latency.
+                started = time.monotonic()
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise KetraTimeoutError("%s %s: no time left" % (method, path))
+            sent = True
+            # verify is passed per request since REQUESTS_CA_BUNDLE would
+            # override a session-level setting.
+            try:
+                r = self._session.request(method, self._url(path), verify=False,
+                                          timeout=timeout, **kwargs)
+            except requests.Timeout as e:
+                raise KetraTimeoutError("%s %s timed out after %.1fs"
+                                        % (method, path, timeout)) from e
+            except requests.RequestException as e:
+                raise KetraRequestError("%s %s failed: %s" % (method, path, e)) from e
+            ok = not _overloaded(r.status_code)
+            if r.status_code >= 400:
+                r.close()
+                raise KetraRequestError("%s %s returned HTTP %d"
+                                        % (method, path, r.status_code), r.status_code)
+            return r
+        finally:
+            if slots is not None:
+                slots.release()
+            if sent:
+                self._admission.release(started, ok)
+                self._breaker.record(ok)
+            else:
+                # Never sent, so it says nothing about this N4.
+                self._admission.abandon()
+                self._breaker.abandon()
+
+    def _retry_delay(self, error, attempt, deadline):
+        """Returns how long to wait before retrying a request that failed with
+        error on its attempt'th retry, or None to give up."""
+        if attempt >= self._retries or not _retryable(error):
+            return None
+        delay = random.uniform(0, self._retry_backoff * 2 ** attempt)
+        if time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def prewarm_connections(self, count=None):
+        """Opens count (default: pool_size) connections to the N4 in parallel
+        and parks them in the pool, so the first commands skip the TCP and TLS
+        handshakes."""
+        count = min(count or self._pool_size, self._pool_size)
+        # Same pool key requests uses for our verify=False requests.
+        pool = self._adapter.poolmanager.connection_from_url(
+            self._url(''), pool_kwargs={'cert_reqs': 'CERT_NONE'})
+        conns = [pool._get_conn() for _ in range(count)]
+
+        def connect(conn):
+            conn.connect()
+            # A TLS 1.3 server sends its session tickets after the handshake.
+            # Read them now; otherwise urllib3 sees a readable idle socket and
+            # throws the connection away as dropped.
+            conn.sock.settimeout(0.1)
+            try:
+                conn.sock.recv(1)
+            except (socket.timeout, ssl.SSLWantReadError):
+                pass
+            conn.sock.settimeout(conn.timeout)
+
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            for conn, future in [(conn, executor.submit(connect, conn)) for conn in conns]:
+                try:
+                    future.result()
+                except Exception as e:
+                    _LOGGER.warning("Failed to pre-open connection to %s: %s",
+                                    self._host, e)
+                    conn.close()
+                pool._put_conn(conn)
+
+    def close(self):
+        """Sends any coalesced writes still pending, then stops polling and
+        event delivery and closes all pooled connections to the N4. Setters
+        used after close() send their changes right away."""
+        coalescer, self._coalescer = self._coalescer, None
+        if coalescer is not None:
+            coalescer.stop()
+            coalescer.flush()
+        self._conn.stop()
+        self._events.stop()
+        self._session.close()
+
+    @staticmethod
+    def _group_state_path(output):
+        """Returns the API path used to PUT the state of output. Groups are
+        addressed by Id, since names may be shared (and are then numbered
+        only on our side)."""
+        return 'groups/' + quote(output.uid, safe='') + '/state'
+
+    def load_json_db(self, disable_cache=False, revalidate=True, keypads=False):
+        """Load the Ketra database from the server.
+
+        A valid cache file is used right away, without waiting on the N4; if
+        revalidate is set, the groups are then re-fetched in the background
+        and reloaded only if they changed. If keypads is set, the keypads are
+        loaded too (see load_keypads())."""
+        if disable_cache or not self._load_cached_db():
+            _LOGGER.info("doing request for ketra configuration file %s",
+                         self._url('groups'))
+            self.refresh()
+        else:
+            if revalidate:
+                self._revalidation = threading.Thread(target=self._revalidate_db,
+                                                      daemon=True)
+                self._revalidation.start()
+        if keypads:
+            self.load_keypads()
+
+        _LOGGER.info("Loaded json db")
+        if self._prewarm:
+            self.prewarm_connections()
         return True
 
+    def load_keypads(self):
+        """Loads the keypads and their buttons from the N4, replacing any
+        loaded before. Returns the list of Keypads."""
+        r = self._request('GET', 'keypads', retry=True)
+        return self._apply_keypads(r.json()['Content'])
+
+    def _apply_keypads(self, keypads_json):
+        with self._db_lock:
+            for keypad in self._keypads:
+                self.unregister_id(Keypad.CMD_TYPE, keypad)
+                self._id_to_area[keypad.area].remove_keypad(keypad)
+            parser = KetraJsonDbParser(ketra=self, area=self._area, json_db=(),
+                                       output_class=self.output_class)
+            if self._area not in self._id_to_area:
+                root = parser._parse_area(self._area)
+                self._id_to_area[root.uid] = root
+            parser.id_to_area = self._id_to_area
+            self._keypads = parser.parse_keypads(keypads_json)
+        _LOGGER.info("Loaded %d keypads", len(self._keypads))
+        return self._keypads
+
+    @property
+    def keypads(self):
+        """Return the list of keypads loaded by load_keypads()."""
+        return self._keypads
+
+    @staticmethod
+    def _activate_button_path(button):
+        """Returns the API path used to activate button. Both are named as
+        the N4 names them, not by the names we show."""
+        keypad = button.keypad
+        keypad_name = keypad._ketra._base_name(keypad)
+        return 'activateButton?keypadName=%s&buttonName=%s' % (
+            quote(keypad_name, safe=''), quote(button.n4_name, safe=''))
+
+    def _activate_button(self, button, level):
+        """Activates button on the N4, see Button.activate()."""
+        _LOGGER.debug("Activating %s on %s", button.name, button.keypad.name)
+        if self._noop_set_state:
+            _LOGGER.warning("NOT ACTUALLY MAKING REQUEST TO KETRA N4")
+            return
+        self._request('POST', self._activate_button_path(button), 'set',
+                      data=json.dumps({"Level": level}))
+        self._conn.note_activity()
+
+    def set_states(self, states, max_concurrency=16):
+        """Sends State updates to many outputs concurrently.
+
+        states maps each Output to the State dictionary to send for it, e.g.
+        {output: {"PowerOn": False}}, or to that dictionary already encoded
+        as a JSON string. At most max_concurrency requests are in
+        flight at once, so the whole call takes about one round-trip per
+        max_concurrency outputs. Returns a dict mapping each Output to a
+        SetStateResult; failures are reported there rather than raised."""
+        results = {}
+        if not states:
+            return results
+
+        def send(output, dictionary):
+            start = time.monotonic()
+            try:
+                output._send_state(dictionary)
+            except Exception as e:
+                _LOGGER.warning("Failed setting state of %s: %s", output.name, e)
+                return SetStateResult(False, time.monotonic() - start, e)
+            output._update_cached_state(dictionary)
+            return SetStateResult(True, time.monotonic() - start, None)
+
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(states))) as pool:
+            futures = {output: pool.submit(send, output, dictionary)
+                       for output, dictionary in states.items()}
+            for output, future in futures.items():
+                results[output] = future.result()
+        return results
+
+    def snapshot(self, outputs=None, max_age=None):
+        """Returns a Snapshot of outputs (default: all of them), such as an
+        Area's all_outputs. The cached state is used as is unless max_age is
+        given, in which case it is first refreshed as by ensure_fresh()."""
+        self.ensure_fresh(max_age)
+        return Snapshot.of(self._outputs if outputs is None else outputs)
+
+    def restore(self, snapshot, max_concurrency=None):
+        """Puts the outputs in snapshot back the way they were. Only outputs
+        whose cached state differs from the snapshot are sent their saved
+        state, all at once through set_states(), whose result this returns.
+        Outputs no longer on the controller are skipped."""
+        states = {}
+        for uid in snapshot.uids:
+            output = self._id_to_load.get(uid)
+            if output is not None and snapshot.differs(output):
+                states[output] = snapshot._bodies[uid]
+        return self.set_states(states, max_concurrency or self._pool_size)
+
+    def precompute_colors(self, outputs=None):
+        """Computes the derived rgb/hs of outputs (default: all of them) in one
+        NumPy pass, for callers about to read them for every output; otherwise
+        each Output computes them on first access."""
+        outputs = [output for output in (outputs or self._outputs)
+                   if output._rgb is None or output._hs is None]
+        if not outputs:
+            return
+        rgbs, hss = xy_to_rgb_hs([output._xy[0] for output in outputs],
+                                 [output._xy[1] for output in outputs])
+        for output, rgb, hs in zip(outputs, rgbs.tolist(), hss.tolist()):
+            output._rgb = rgb
+            output._hs = hs
+
+    def flush_writes(self):
+        """Sends any setter changes held back by write coalescing right away."""
+        if self._coalescer is not None:
+            self._coalescer.flush()
+
     @property
     def outputs(self):
         """Return the full list of outputs in the controller."""
         return self._outputs
 
+    @property
+    def areas(self):
+        """Return the list of areas, the top one (named at creation) first."""
+        return list(self._id_to_area.values())
+
+    def area(self, uid):
+        """Returns the area with the given id, a "/"-separated path starting
+        with the top area's name (e.g. "Home/Floor 1/Kitchen"), or None."""
+        return self._id_to_area.get(uid)
+
+
+
+class KetraFleet:
+    """A set of Ketra controllers (say, one N4 per building) used as one.
+
+    load_json_db() loads every controller in parallel, so startup takes as
+    long as the slowest one. Outputs can be looked up across all of them,
+    and since each Output sends through its own controller, commands always
+    go to the right N4. At most max_connections requests are in flight
+    across the whole fleet."""
+
+    def __init__(self, controllers=(), max_connections=64):
+        """Initializes the fleet from Ketra objects; more can be add()ed."""
+        self._controllers = []
+        self._slots = threading.BoundedSemaphore(max_connections)
+        for ketra in controllers:
+            self.add(ketra)
+
+    def add(self, ketra):
+        """Adds a controller to the fleet."""
+        ketra._request_slots = self._slots
+        self._controllers.append(ketra)
+
+    @property
+    def controllers(self):
+        """Return the tuple of the Ketra controllers in the fleet."""
+        return tuple(self._controllers)
+
+    def _each(self, action):
+        """Calls action(ketra) for every controller in parallel; returns a
+        dict mapping each controller to the exception it raised, or None."""
+        def call(ketra):
+            try:
+                action(ketra)
+            except Exception as e:
+                _LOGGER.warning("%s failed for %s: %s", action.__name__, ketra._host, e)
+                return e
+            return None
+
+        if not self._controllers:
+            return {}
+        with ThreadPoolExecutor(max_workers=len(self._controllers)) as pool:
+            return dict(zip(self._controllers, pool.map(call, self._controllers)))
+
+    def load_json_db(self, disable_cache=False, revalidate=True):
+        """Loads every controller's database in parallel. A controller that
+        fails is left unloaded rather than failing the rest; returns a dict
+        mapping each controller to its exception, or None if it loaded."""
+        def load(ketra):
+            ketra.load_json_db(disable_cache, revalidate)
+        return self._each(load)
+
+    def connect(self):
+        """Starts polling every controller."""
+        for ketra in self._controllers:
+            ketra.connect()
+
+    def close(self):
+        """Closes every controller."""
+        for ketra in self._controllers:
+            ketra.close()
+
+    def subscribe(self, obj, handler):
+        """Subscribes as Ketra.subscribe(); obj None subscribes to every
+        controller."""
+        for ketra in self._route(obj):
+            ketra.subscribe(obj, handler)
+
+    def unsubscribe(self, obj, handler):
+        """Removes a handler added with subscribe()."""
+        for ketra in self._route(obj):
+            ketra.unsubscribe(obj, handler)
+
+    def _route(self, obj):
+        return self._controllers if obj is None else [obj._ketra]
+
+    @property
+    def outputs(self):
+        """Return the list of outputs of every controller."""
+        return [output for ketra in self._controllers for output in ketra.outputs]
+
+    def output(self, uid):
+        """Returns the Output with the given id on any controller, or None."""
+        for ketra in self._controllers:
+            output = ketra._ids.get(Output.CMD_TYPE, {}).get(uid)
+            if output is not None:
+                return output
+        return None
+
+    def outputs_named(self, name):
+        """Returns the list of outputs called name; the same name may be used
+        on several controllers."""
+        found = []
+        for ketra in self._controllers:
+            output = ketra.index.named(name)
+            if isinstance(output, Output):
+                found.append(output)
+        return found
+
+    def set_states(self, states, max_concurrency=16):
+        """As Ketra.set_states(), for outputs on any of the controllers; each
+        controller's share is sent in parallel with the others."""
+        by_ketra = {}
+        for output, dictionary in states.items():
+            by_ketra.setdefault(output._ketra, {})[output] = dictionary
+        results = {}
+        if not by_ketra:
+            return results
+        with ThreadPoolExecutor(max_workers=len(by_ketra)) as pool:
+            for part in pool.map(lambda item: item[0].set_states(item[1], max_concurrency),
+                                 by_ketra.items()):
+                results.update(part)
+        return results
+
+
+class _WriteCoalescer(threading.Thread):
+    """Merges queued State updates to the same output into a single request.
+
+    An output's pending State is sent once no new change has arrived for it
+    within window seconds, or max_latency seconds after its first pending
+    change, whichever is sooner. Later values of a field replace earlier ones,
+    so intermediate slider positions are never sent. Everything that comes
+    due together goes out through Ketra.set_states()."""
+
+    def __init__(self, ketra, window, max_latency):
+        """Initializes the coalescer; the thread starts with the first change."""
+        threading.Thread.__init__(self)
+        self._ketra = ketra
+        self._window = window
+        self._max_latency = max_latency
+        self._cond = threading.Condition()
+        self._pending = {}  # output -> [state dict, first change, last change]
+        self._done = False
+        self.submitted = 0
+        self.sent = 0
+        self.daemon = True
+
+    def submit(self, output, dictionary):
+        """Queues a State update for output."""
+        now = time.monotonic()
+        with self._cond:
+            entry = self._pending.get(output)
+            if entry is None:
+                self._pending[output] = [dict(dictionary), now, now]
+            else:
+                entry[0].update(dictionary)
+                entry[2] = now
+            self.submitted += 1
+            if not self.is_alive():
+                self.start()
+            self._cond.notify()
+
+    def stop(self):
+        """Asks the thread to exit, leaving anything pending for flush()."""
+        with self._cond:
+            self._done = True
+            self._cond.notify()
+        if self.is_alive():
+            self.join()
+
+    def flush(self):
+        """Sends everything pending now, from the calling thread."""
+        with self._cond:
+            due = {output: entry[0] for output, entry in self._pending.items()}
+            self._pending.clear()
+        self._send(due)
+
+    def _deadline(self, entry):
+        return min(entry[2] + self._window, entry[1] + self._max_latency)
+
+    def _send(self, due):
+        if due:
+            self.sent += len(due)
+            self._ketra.set_states(due)
+
+    def run(self):
+        """Sends each output's merged State when it comes due."""
+        while True:
+            with self._cond:
+                while True:
+                    if self._done:
+                        return
+                    now = time.monotonic()
+                    deadlines = {output: self._deadline(entry)
+                                 for output, entry in self._pending.items()}
+                    due = {output: self._pending.pop(output)[0]
+                           for output, deadline in deadlines.items() if deadline <= now}
+                    if due:
+                        break
+                    timeout = min(deadlines.values()) - now if deadlines else None
+                    self._cond.wait(timeout)
+            self._send(due)
+
+
+class AdmissionControl:
+    """Decides when a request may be sent to one N4, so that concurrent
+    callers keep it busy without overwhelming it.
+
+    Requests are limited in two ways. An optional token bucket caps the rate
+    at max_rate requests per second with bursts of up to burst. The number
+    in flight is capped by a limit tuned AIMD-style: it grows by one per
+    prompt response until latency starts to rise (slow start), then by about
+    one per limit's worth of prompt responses, and is cut by decrease_factor
+    (at most once per round-trip) on an error or a response slower than
+    tolerance times the uncongested latency. That latency is learned as a
+    slowly rising minimum of the observed ones. The limit stays between 1
+    and max_concurrency.
+
+    The counters (admitted, delayed, wait_time, errors, slow, increases,
+    decreases) and the limit, in_flight, baseline and latency attributes are
+    there for monitoring."""
+
+    def __init__(self, max_concurrency=16, initial_concurrency=4, max_rate=None,
+                 burst=None, tolerance=1.5, decrease_factor=0.7):
+        self._max_concurrency = max_concurrency
+        self._max_rate = max_rate
+        self._burst = burst or max(1, max_concurrency)
+        self._tolerance = tolerance
+        self._decrease_factor = decrease_factor
+        self._cond = threading.Condition()
+        self._tokens = float(self._burst)
+        self._refilled = time.monotonic()
+        self._last_decrease = 0.0
+        self._slow_start = True
+        self._async_waiters = deque()  # (loop, future) of acquire_async()
+        self.limit = float(min(initial_concurrency, max_concurrency))
+        self.in_flight = 0
+        self.baseline = None     # learned uncongested latency, seconds
+        self.latency = None      # moving average of latency, seconds
+        self.admitted = 0
+        self.delayed = 0
+        self.wait_time = 0.0
+        self.errors = 0
+        self.slow = 0
+        self.increases = 0
+        self.decreases = 0
+
+    def _try_admit(self, now):
+        """Admits a request and returns 0, or returns how long to wait before
+        trying again (None: until a request completes). Hold _cond."""
+        if self.in_flight >= int(self.limit):
+            return None
+        if self._max_rate:
+            self._tokens = min(self._burst,
+                               self._tokens + (now - self._refilled) * self._max_rate)
+            self._refilled = now
+            if self._tokens < 1:
+                return (1 - self._tokens) / self._max_rate
+            self._tokens -= 1
+        self.in_flight += 1
+        self.admitted += 1
+        return 0
+
+    def acquire(self):
+        """Blocks until a request may be sent; returns its start time for
+        release()."""
+        start = None
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                delay = self._try_admit(now)
+                if delay == 0:
+                    break
+                start = start or now
+                self._cond.wait(delay)
+            self._count_wait(start, now)
+        return now
+
+    async def acquire_async(self):
+        """The coroutine version of acquire(), for the asyncio client. A
+        coroutine waiting for a request to complete sleeps on a future that
+        release() resolves."""
+        loop = asyncio.get_running_loop()
+        start = None
+        while True:
+            waiter = None
+            with self._cond:
+                now = time.monotonic()
+                delay = self._try_admit(now)
+                if delay == 0:
+                    self._count_wait(start, now)
+                    return now
+                if delay is None:
+                    waiter = (loop, loop.create_future())
+                    self._async_waiters.append(waiter)
+            start = start or now
+            if waiter is None:
+                await asyncio.sleep(delay)
+                continue
+            try:
+                await waiter[1]
+            except asyncio.CancelledError:
+                with self._cond:
+                    if waiter in self._async_waiters:
+                        self._async_waiters.remove(waiter)
+                    else:
+                        self._wake_async()  # pass on the wakeup it was given
+                raise
+
+    def _wake_async(self):
+        """Wakes as many waiting coroutines as there are free slots. Hold
+        _cond."""
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._async_waiters:
+            loop, future = self._async_waiters.popleft()
+            loop.call_soon_threadsafe(_resolve, future)
+            free -= 1
+
+    def _count_wait(self, start, now):
+        if start is not None:
+            self.delayed += 1
+            self.wait_time += now - start
+
+    def release(self, started, ok):
+        """Records the outcome of a request admitted at started; ok is False
+        for errors, including overload responses from the N4."""
+        now = time.monotonic()
+        latency = now - started
+        with self._cond:
+            self.in_flight -= 1
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                self.baseline += (latency - self.baseline) * 0.002
+            self.latency = (latency if self.latency is None
+                            else self.latency + (latency - self.latency) * 0.2)
+            congested = not ok or latency > max(self.baseline * self._tolerance,
+                                                self.baseline + 0.01)
+            if not ok:
+                self.errors += 1
+            elif congested:
+                self.slow += 1
+            if congested:
+                if now - self._last_decrease > self.latency:
+                    # Slow start overshoots by up to a round-trip's growth,
+                    # so leaving it halves the limit.
+                    factor = 0.5 if self._slow_start else self._decrease_factor
+                    self._slow_start = False
+                    self.limit = max(1.0, self.limit * factor)
+                    self._last_decrease = now
+                    self.decreases += 1
+            elif self.limit < self._max_concurrency:
+                # Until the first sign of congestion, grow exponentially
+                # (slow start) rather than by one per round-trip. Latency
+                # rising halfway to tolerance is such a sign.
+                if latency > self.baseline * (1 + self._tolerance) / 2:
+                    self._slow_start = False
+                step = 1.0 if self._slow_start else 1.0 / self.limit
+                self.limit = min(self._max_concurrency, self.limit + step)
+                self.increases += 1
+            self._cond.notify_all()
+            self._wake_async()
+
+    def abandon(self):
+        """Frees the place of a request that was admitted but never sent,
+        without counting it towards the tuning."""
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+            self._wake_async()
+
+    @property
+    def stats(self):
+        """The counters and current tuning as a dict."""
+        with self._cond:
+            return {'limit': self.limit, 'in_flight': self.in_flight,
+                    'baseline': self.baseline, 'latency': self.latency,
+                    'admitted': self.admitted, 'delayed': self.delayed,
+                    'wait_time': self.wait_time, 'errors': self.errors,
+                    'slow': self.slow, 'increases': self.increases,
+                    'decreases': self.decreases}
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _overloaded(status):
+    """True for HTTP statuses that mean the N4 is failing or overloaded."""
+    return status >= 500 or status == 429
+
+
+def _retryable(error):
+    """True if a request that failed with error (a KetraRequestError) may
+    succeed if sent again: it timed out, got no answer or was overloaded."""
+    return (not isinstance(error, CircuitOpenError) and
+            (error.status is None or _overloaded(error.status)))
+
+
+class CircuitBreaker:
+    """Fails requests to one N4 fast while it is down.
+
+    The breaker opens after threshold requests in a row have timed out,
+    failed to connect or got an overload response (None never opens it).
+    While it is open, allow() raises CircuitOpenError. reset_timeout seconds
+    after opening it lets a single probe request through (half-open), and
+    closes if that succeeds or opens again if not.
+
+    state is 'closed', 'open' or 'half-open'; it and the counters failures
+    (in a row), opened and rejected are there for monitoring."""
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self._threshold = threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._opened_at = None
+        self._probing = False
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self):
+        """Returns if a request may be sent, else raises CircuitOpenError."""
+        with self._lock:
+            if self.state == 'closed':
+                return
+            wait = self._opened_at + self._reset_timeout - time.monotonic()
+            if self.state == 'open' and wait <= 0:
+                self.state = 'half-open'
+            if self.state == 'half-open' and not self._probing:
+                self._probing = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError("N4 unavailable after %d failed requests; next try in %.1fs"
+                               % (self.failures, max(wait, 0)))
+
+    def abandon(self):
+        """Records that a request allowed through was never sent, or was
+        given up with no outcome, so a probe slot is freed for the next."""
+        with self._lock:
+            self._probing = False
+
+    def record(self, ok):
+        """Records whether a request allowed through succeeded; ok is False
+        for the failures counted towards opening."""
+        with self._lock:
+            self._probing = False
+            if ok:
+                if self.state != 'closed':
+                    _LOGGER.info("N4 reachable again; closing circuit")
+                self.state = 'closed'
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == 'half-open' or (
+                    self.state == 'closed' and self._threshold is not None and
+                    self.failures >= self._threshold):
+                if self.state == 'closed':
+                    _LOGGER.warning("Opening circuit after %d failed requests",
+                                    self.failures)
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+                self.opened += 1
+
+    @property
+    def stats(self):
+        """The state and counters as a dict."""
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures,
+                    'opened': self.opened, 'rejected': self.rejected}
+
+
+class _EventBus:
+    """Delivers change notifications to subscribed handlers.
+
+    Handlers are registered against an object, an Area (for every object in
+    it) or None (for everything). publish() only queues the object and
+    returns, so slow handlers never hold up status ingestion; up to workers
+    threads, started on demand, call the handlers. An object already waiting
+    for delivery is not queued twice, and handlers for one object never run
+    concurrently. If more than depth objects are waiting, the oldest is
+    dropped and counted in dropped."""
+
+    def __init__(self, workers, depth):
+        self._workers = workers
+        self._depth = depth
+        self._handlers = {}       # object, Area or None -> [handler]
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()  # object -> its Areas, in arrival order
+        self._busy = set()        # objects whose handlers are running
+        self._threads = []
+        self._done = False
+        self.published = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.delivered = 0
+
+    def subscribe(self, key, handler):
+        with self._cond:
+            self._handlers.setdefault(key, []).append(handler)
+
+    def unsubscribe(self, key, handler):
+        with self._cond:
+            handlers = self._handlers.get(key, [])
+            if handler in handlers:
+                handlers.remove(handler)
+            if not handlers:
+                self._handlers.pop(key, None)
+
+    def _handlers_for(self, obj, areas):
+        handlers = list(self._handlers.get(obj, []))
+        for area in areas:
+            handlers.extend(self._handlers.get(area, []))
+        return handlers + self._handlers.get(None, [])
+
+    def publish(self, obj, areas=()):
+        """Queues obj for delivery to its handlers, and those of areas (the
+        areas it is in), unless nobody listens."""
+        with self._cond:
+            if self._done or not (obj in self._handlers or None in self._handlers or
+                                  any(area in self._handlers for area in areas)):
+                return
+            self.published += 1
+            if obj in self._pending:
+                self.coalesced += 1
+                return
+            if len(self._pending) >= self._depth:
+                dropped, _ = self._pending.popitem(last=False)
+                self.dropped += 1
+                _LOGGER.warning("Event queue full, dropped update of %s", dropped.name)
+            self._pending[obj] = areas
+            if len(self._threads) < self._workers:
+                thread = threading.Thread(target=self._run, daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._cond.notify()
+
+    def wait_idle(self, timeout=None):
+        """Waits until everything published so far has been delivered;
+        returns False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._pending and not self._busy, timeout)
+
+    def stop(self):
+        """Stops the workers once their current handlers return."""
+        with self._cond:
+            self._done = True
+            self._pending.clear()
+            self._cond.notify_all()
+
+    def _next(self):
+        for obj in self._pending:
+            if obj not in self._busy:
+                return obj
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                obj = self._next()
+                while obj is None and not self._done:
+                    self._cond.wait()
+                    obj = self._next()
+                if self._done:
+                    return
+                areas = self._pending.pop(obj)
+                self._busy.add(obj)
+                handlers = self._handlers_for(obj, areas)
+            for handler in handlers:
+                try:
+                    handler(obj)
+                except Exception:
+                    _LOGGER.exception("Subscriber for %s failed", obj.name)
+            with self._cond:
+                self._busy.discard(obj)
+                self.delivered += 1
+                self._cond.notify_all()
 
 
 class _RequestHelper:
     """A class to help with sending queries to the controller and waiting for
     responses.
 
-    It is a wrapper used to help with executing a user action
-    and then waiting for an event when that action completes.
-
-    The user calls request() and gets back a threading.Event on which they then
-    wait.
-
     If multiple clients of a ketra object (say an Output) want to get a status
     update on the current brightness (output level), we don't want to spam the
     controller with (near)identical requests. So, if a request is pending, we
-    just enqueue another waiter on the pending request and return a new Event
-    object. All waiters will be woken up when the reply is received and the
-    wait list is cleared.
+    just wait for the pending request rather than sending another one, and
+    every waiter gets its result, or has its exception raised.
 
     NOTE: Only the first enqueued action is executed as the assumption is that the
     queries will be identical in nature.
+
+    requests counts the actions actually run and deduplicated the calls that
+    shared one instead.
     """
 
     def __init__(self):
         """Initialize the request helper class."""
         self.__lock = threading.Lock()
-        self.__events = []
-
-    def request(self, action):
-        """Request an action to be performed, in case one."""
-        ev = threading.Event()
-        first = False
+        self.__pending = None
+        self.requests = 0
+        self.deduplicated = 0
+
+    def request(self, action, timeout=None):
+        """Runs action() and returns its result, or, if a call is already in
+        flight, waits for that one and returns its result instead. Its
+        exception is raised in every caller. Waiting callers give up with
+        KetraTimeoutError after timeout seconds; the caller running the action
+        is bounded only by the action itself."""
         with self.__lock:
-            if not self.__events:
+            flight = self.__pending
+            if flight is None:
+                flight = self.__pending = _Flight()
+                self.requests += 1
                 first = True
-            self.__events.append(ev)
+            else:
+                self.deduplicated += 1
+                first = False
         if first:
-            action()
-        return ev
+            try:
+                flight.result = action()
+            except BaseException as e:
+                flight.error = e
+            finally:
+                with self.__lock:
+                    self.__pending = None
+                flight.done.set()
+        elif not flight.done.wait(timeout):
+            raise KetraTimeoutError("Timed out waiting for a shared request")
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
 
-    def notify(self):
-        """Have all events pending trigger, and reset to []."""
-        with self.__lock:
-            events = self.__events
-            self.__events = []
-        for ev in events:
-            ev.set()
+
+class _Flight:
+    """One in-flight _RequestHelper action and its outcome."""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
 
 
 class KetraEntity:
     """Base class for all the Ketra objects we'd like to manage. Just holds basic
-    common info we'd rather not manage repeatedly."""
+    common info we'd rather not manage repeatedly.
+
+    Entities use __slots__ to stay small on installs with many thousands of
+    groups; subclasses must declare __slots__ too."""
+
+    __slots__ = ('_ketra', '_name', '_area', '_id')
 
     def __init__(self, ketra, name, area, uid):
         """Initializes the base class with common, basic data."""
@@ -487,190 +2511,386 @@ class KetraEntity:
         return self._area
 
 
+# Output metadata shared by all outputs of the same type; see _output_kind.
+_OutputKind = namedtuple('_OutputKind', ['output_type', 'load_type', 'is_dimmable'])
+_output_kinds = {}
+_lazy_init_lock = threading.Lock()
+
+
+def _output_kind(output_type, load_type):
+    """Returns the shared _OutputKind for output_type and load_type."""
+    kind = _output_kinds.get((output_type, load_type))
+    if kind is None:
+        kind = _output_kinds.setdefault(
+            (output_type, load_type),
+            _OutputKind(output_type, load_type,
+                        load_type.lower().find("non-dim") == -1))
+    return kind
+
+
 class Output(KetraEntity):
     """This is the output entity in Ketra universe. This generally refers to a
     switched/dimmed load, e.g. light fixture, outlet, etc."""
     CMD_TYPE = 'LOAD'
     ACTION_ZONE_LEVEL = 1
+
+    __slots__ = ('_kind', '_level', '_power', '_xy', '_rgb', '_hs', '_cct', '_waiters')
     #  _wait_seconds = 0.3  # TODO:move this to a parameter
 
-    def __init__(self, ketra, name, area, output_type, xy_chroma, level, load_type, uid):
-        """Initializes the Output."""
+    def __init__(self, ketra, name, area, output_type, xy_chroma, level, load_type, uid,
+                 rgb=None, hs=None, power=None):
+        """Initializes the Output. rgb and hs may be passed in if already
+        computed from xy_chroma; otherwise they are computed on first use.
+        power is the PowerOn state, None if unknown."""
         super(Output, self).__init__(ketra, name, area, uid)
-        self._output_type = output_type
-        self._load_type = load_type
+        self._kind = _output_kind(output_type, load_type)
         self._level = level
+        self._power = power
+        # rgb, hs and cct are derived from xy; None means not computed yet.
         self._xy = xy_chroma
-        xyY = xyYColor(xy_chroma[0], xy_chroma[1], 1)
-        rgb = convert_color(xyY, sRGBColor)
-        self._rgb = [rgb.rgb_r, rgb.rgb_g, rgb.rgb_b]
-        hs = convert_color(xyY, HSVColor)
-        self._hs = [hs.hsv_h, hs.hsv_s]
+        self._rgb = rgb
+        self._hs = hs
         self._cct = None
-        self._xy_chroma = None
-        self._query_waiters = _RequestHelper()
+        self._waiters = None  # see _query_waiters
 
         self._ketra.register_id(Output.CMD_TYPE, self)
 
     def __str__(self):
         """Returns a pretty-printed string for this object."""
         return 'Output name: "%s" area: %s type: "%s" load: "%s" id: %s %s' % (
-            self._name, self._area, self._output_type, self._load_type,
+            self._name, self._area, self._kind.output_type, self._kind.load_type,
             self._id, ("(dim)" if self.is_dimmable else ""))
 
     def __repr__(self):
         """Returns a stringified representation of this object."""
         return str({'name': self._name, 'area': self._area,
-                    'type': self._load_type, 'load': self._load_type,
+                    'type': self._kind.load_type, 'load': self._kind.load_type,
                     'id': self._id, 'level': self._level, 'xy': self._xy})
 
+    @property
+    def _query_waiters(self):
+        """The _RequestHelper for queries of this output, made on first use
+        since most outputs are never queried individually."""
+        if self._waiters is None:
+            with _lazy_init_lock:
+                if self._waiters is None:
+                    self._waiters = _RequestHelper()
+        return self._waiters
+
     def __do_query_level(self):
         """Helper to perform the actual query the current dimmer level of the
         output. For pure on/off loads the result is either 0.0 or 100.0."""
         _LOGGER.info("__do_query_level(%s)", self.name)
-        lightURL = 'https://' + self._ketra._host + '/ketra.cgi/api/v1/Groups/' + quote(self._name)
-        ketra_session.mount(lightURL, KetraHttpAdapter())
-        r = ketra_session.get(lightURL, auth=('', self._ketra._password), verify=False)
-        content = r.json()['Content']
-        state = content['State']
-        self._xy_chroma = [state['xChromaticity'], state['yChromaticity']]
-        self._level = state['Brightness']
-        return True
-
+        r = self._ketra._request('GET', 'groups/' + quote(self._id, safe=''), retry=True)
+        state = r.json()['Content']['State']
+        if self._refresh_from_state(state):
+            self._ketra._notify(self)
+        return state
+
+    def read_state(self, timeout=None):
+        """Reads this output's State alone from the controller (one GET of its
+        group) and returns it, updating the cached state. Concurrent callers
+        share one request; those waiting on another caller's request give up
+        with KetraTimeoutError after timeout seconds."""
+        return self._query_waiters.request(self.__do_query_level, timeout)
 
     def last_level(self):
         """Returns last cached value of the output level, no query is performed."""
         return self._level
 
+    def query(self, max_age=0):
+        """Refreshes the cached state unless it is at most max_age seconds old,
+        then returns self, e.g. output.query(0.5).level. All outputs are
+        refreshed by the same request; see Ketra.ensure_fresh()."""
+        self._ketra.ensure_fresh(max_age)
+        return self
+
     @property
     def level(self):
-        """Returns the current output level by querying the remote controller."""
-#    ev = self._query_waiters.request(self.__do_query_level)
-#    ev.wait(self._wait_seconds)
+        """Returns the current output level, refreshed from the remote
+        controller if older than the controller's state_ttl."""
+        self._ketra._read_through()
         return self._level
 
     def _set_state(self, dictionary):
-        lightURL = ('https://' + self._ketra._host +
-                    '/ketra.cgi/api/v1/Groups/' + quote(self._name) + "/State")
-        _LOGGER.warning("Sending Ketra %s", json.dumps(dictionary))
+        """Sends a State update, through the write coalescer if enabled."""
+        if self._ketra._coalescer is not None:
+            self._ketra._coalescer.submit(self, dictionary)
+        else:
+            self._send_state(dictionary)
+
+    def _send_state(self, dictionary):
+        """Sends a State update (a dictionary or its JSON) to the N4 right away."""
+        body = _state_body(dictionary)
+        _LOGGER.warning("Sending Ketra %s", body)
         # TODO: make an option to do NOOP sends -- for now just comment out if you don't want to hit
         # the Ketra N4 with the request
         if not self._ketra._noop_set_state:
-            ketra_session.mount(lightURL, KetraHttpAdapter())
-            ketra_session.put(lightURL, data=json.dumps(dictionary),
-                         auth=('', self._ketra._password), verify=False)
+            self._ketra._request('PUT', Ketra._group_state_path(self), 'set', retry=True,
+                                 data=body)
+            self._ketra._conn.note_activity()
         else:
             _LOGGER.warning("NOT ACTUALLY MAKING REQUEST TO KETRA N4")
 
 
+    def _set_xy(self, new_xy):
+        """Records a new xy, dropping the colors derived from the old one."""
+        self._xy = new_xy
+        self._rgb = None
+        self._hs = None
+        self._cct = None
+
+    def _compute_colors(self):
+        rgbs, hss = xy_to_rgb_hs([self._xy[0]], [self._xy[1]])
+        self._rgb = rgbs[0].tolist()
+        self._hs = hss[0].tolist()
+
+    def _cached_rgb(self):
+        if self._rgb is None:
+            self._compute_colors()
+        return self._rgb
+
+    def _cached_hs(self):
+        if self._hs is None:
+            self._compute_colors()
+        return self._hs
+
+    def _refresh_from_state(self, state):
+        """Updates the cached state from a State read back from the N4.
+        Returns True if it differed from what we had."""
+        if (state['Brightness'] == self._level and
+                [state['xChromaticity'], state['yChromaticity']] == self._xy and
+                state.get('PowerOn', self._power) == self._power):
+            return False
+        self._update_cached_state(state)
+        return True
+
+    def _update_cached_state(self, dictionary):
+        """Updates the cached level/xy/power from a State dictionary (or its
+        JSON) that was sent or received."""
+        if isinstance(dictionary, str):
+            dictionary = json.loads(dictionary)
+        if "PowerOn" in dictionary:
+            self._power = dictionary["PowerOn"]
+        if "Brightness" in dictionary:
+            self._level = dictionary["Brightness"]
+        if "xChromaticity" in dictionary and "yChromaticity" in dictionary:
+            self._set_xy([dictionary["xChromaticity"], dictionary["yChromaticity"]])
+        elif "CCT" in dictionary:
+            self._set_xy(cctKelvin_to_xyColor_fast(dictionary["CCT"]))
+            self._cct = dictionary["CCT"]
+
+    @property
+    def power(self):
+        """Returns whether the output is powered on (None if unknown)."""
+        self._ketra._read_through()
+        return self._power
+
+    @power.setter
+    def power(self, power_on):
+        """Turns the output on or off, keeping its level and color."""
+        self.set_power(power_on)
+
     @level.setter
     def level(self, new_level):
         """Sets the new brightness level."""
-        if self._level == new_level:
-            return
-        self._set_state({"Brightness": new_level,
-                         "PowerOn": True,
-                         "TransitionTime": 1000,
-                         "TransitionComplete": True})
-        self._level = new_level
+        self.set_level(new_level)
 
     @property
     def rgb(self):
         """Returns current RGB of the lamp."""
-        return self._rgb
+        self._ketra._read_through()
+        return self._cached_rgb()
 
     @rgb.setter
     def rgb(self, new_rgb):
         """Sets new RGB levels."""
-        if self._rgb == new_rgb:
-            return
-        srgb = sRGBColor(*new_rgb)
-        xyY = convert_color(srgb, xyYColor)
-        self._set_state({"PowerOn": True,
-                         "xChromaticity": xyY.xyy_x,
-                         "yChromaticity": xyY.xyy_y,
-                         "TransitionTime": 1000,
-                         "TransitionComplete": True})
-        self._rgb = new_rgb
+        self.set_rgb(new_rgb)
 
     @property
     def hs(self):
         """Returns current HS of the lamp."""
-        return self._hs
+        self._ketra._read_through()
+        return self._cached_hs()
 
     @hs.setter
     def hs(self, new_hs):
         """Sets new Hue/Saturation levels."""
-        if self._hs == new_hs:
-            return
-        _LOGGER.info("hs = %s", json.dumps(new_hs))
-        hs_color = HSVColor(new_hs[0], new_hs[1], 1.0)
-        xyY = convert_color(hs_color, xyYColor)
-        self._set_state({"PowerOn": True,
-                         "xChromaticity": xyY.xyy_x,
-                         "yChromaticity": xyY.xyy_y,
-                         "TransitionTime": 1000,
-                         "TransitionComplete": True})
-        self._hs = new_hs
+        self.set_hs(new_hs)
 
     @property
     def xy(self):
         """Returns current XY of the lamp."""
+        self._ketra._read_through()
         return self._xy
 
     @xy.setter
     def xy(self, new_xy):
         """Sets new XY levels."""
-        if self._xy == new_xy:
-            return
-        self._set_state({"PowerOn": True,
-                         "xChromaticity": new_xy[0],
-                         "yChromaticity": new_xy[1],
-                         "TransitionTime": 1000,
-                         "TransitionComplete": True})
-        self._xy = new_xy
+        self.set_xy(new_xy)
 
     @property
     def cct(self):
-        """Returns current CCT (coordinated color temperature) of the lamp."""
+        """Returns current CCT (coordinated color temperature) of the lamp:
+        the last one set, or else an estimate from its xy (None if that is
+        not near white)."""
+        self._ketra._read_through()
+        if self._cct is None:
+            self._cct = xyColor_to_cctKelvin(*self._xy)
         return self._cct
 
     @cct.setter
     def cct(self, new_cct):
+        self.set_cct(new_cct)
+
+    # The set_* methods are the property setters with a choice of how long
+    # (in milliseconds) the N4 takes to fade to the new state.
+    def set_power(self, power_on, transition_time=DEFAULT_TRANSITION_TIME):
+        """Turns the output on or off, keeping its level and color."""
+        if self._power == power_on:
+            return
+        state = self._state_for_power(power_on, transition_time)
+        self._set_state(state)
+        self._update_cached_state(state)
+
+    def set_level(self, new_level, transition_time=DEFAULT_TRANSITION_TIME):
+        """Sets the new brightness level."""
+        if self._level == new_level:
+            return
+        state = self._state_for_level(new_level, transition_time)
+        self._set_state(state)
+        self._update_cached_state(state)
+
+    def set_rgb(self, new_rgb, transition_time=DEFAULT_TRANSITION_TIME):
+        """Sets new RGB levels."""
+        if self._cached_rgb() == new_rgb:
+            return
+        state = self._state_for_rgb(new_rgb, transition_time)
+        self._set_state(state)
+        self._update_cached_state(state)
+        self._rgb = new_rgb
+
+    def set_hs(self, new_hs, transition_time=DEFAULT_TRANSITION_TIME):
+        """Sets new Hue/Saturation levels."""
+        if self._cached_hs() == new_hs:
+            return
+        state = self._state_for_hs(new_hs, transition_time)
+        self._set_state(state)
+        self._update_cached_state(state)
+        self._hs = new_hs
+
+    def set_xy(self, new_xy, transition_time=DEFAULT_TRANSITION_TIME):
+        """Sets new XY levels."""
+        if self._xy == list(new_xy):
+            return
+        state = self._state_for_xy(new_xy, transition_time)
+        self._set_state(state)
+        self._update_cached_state(state)
+
+    def set_cct(self, new_cct, transition_time=DEFAULT_TRANSITION_TIME):
+        """Sets a new CCT (coordinated color temperature) in kelvin."""
         if self._cct == new_cct:
             return
-        [x, y] = cctKelvin_to_xyColor(new_cct)
-        self._set_state({"PowerOn": True,
-                         "xChromaticity": x,
-                         "yChromaticity": y,
-                         "TransitionTime": 1000,
-                         "TransitionComplete": True})
+        state = self._state_for_cct(new_cct, transition_time)
+        self._set_state(state)
+        self._update_cached_state(state)
         self._cct = new_cct
 
-## At some later date, we may want to also specify fade and delay times
-#  def set_level(self, new_level, fade_time, delay):
-#    self._ketra.send(Ketra.OP_EXECUTE, Output.CMD_TYPE,
-#        Output.ACTION_ZONE_LEVEL, new_level, fade_time, delay)
+    # The _state_for_* helpers build the State dictionary for each setter so
+    # the threaded and asyncio clients send identical requests.
+    @staticmethod
+    def _state_for_level(new_level, transition_time=DEFAULT_TRANSITION_TIME):
+        return {"Brightness": new_level,
+                "PowerOn": True,
+                "TransitionTime": transition_time,
+                "TransitionComplete": True}
+
+    @staticmethod
+    def _state_for_rgb(new_rgb, transition_time=DEFAULT_TRANSITION_TIME):
+        srgb = sRGBColor(*new_rgb)
+        xyY = convert_color(srgb, xyYColor)
+        return {"PowerOn": True,
+                "xChromaticity": xyY.xyy_x,
+                "yChromaticity": xyY.xyy_y,
+                "TransitionTime": transition_time,
+                "TransitionComplete": True}
+
+    @staticmethod
+    def _state_for_hs(new_hs, transition_time=DEFAULT_TRANSITION_TIME):
+        _LOGGER.info("hs = %s", json.dumps(new_hs))
+        hs_color = HSVColor(new_hs[0], new_hs[1], 1.0)
+        xyY = convert_color(hs_color, xyYColor)
+        return {"PowerOn": True,
+                "xChromaticity": xyY.xyy_x,
+                "yChromaticity": xyY.xyy_y,
+                "TransitionTime": transition_time,
+                "TransitionComplete": True}
+
+    @staticmethod
+    def _state_for_power(power_on, transition_time=DEFAULT_TRANSITION_TIME):
+        return {"PowerOn": power_on,
+                "TransitionTime": transition_time,
+                "TransitionComplete": True}
+
+    @staticmethod
+    def _state_for_xy(new_xy, transition_time=DEFAULT_TRANSITION_TIME):
+        return {"PowerOn": True,
+                "xChromaticity": new_xy[0],
+                "yChromaticity": new_xy[1],
+                "TransitionTime": transition_time,
+                "TransitionComplete": True}
+
+    def _color_for_cct(self, new_cct):
+        """Returns the State fields for a color temperature: the N4's own CCT
+        field if native_cct is set, otherwise the equivalent xy."""
+        if self._ketra._native_cct:
+            return {"CCT": new_cct}
+        [x, y] = cctKelvin_to_xyColor_fast(new_cct)
+        return {"xChromaticity": x, "yChromaticity": y}
+
+    def _state_for_cct(self, new_cct, transition_time=DEFAULT_TRANSITION_TIME):
+        state = {"PowerOn": True}
+        state.update(self._color_for_cct(new_cct))
+        state["TransitionTime"] = transition_time
+        state["TransitionComplete"] = True
+        return state
 
     @property
     def type(self):
         """Returns the output type. At present AUTO_DETECT or NON_DIM."""
-        return self._output_type
+        return self._kind.output_type
 
     @property
     def is_dimmable(self):
         """Returns a boolean of whether or not the output is dimmable."""
-        return self._load_type.lower().find("non-dim") == -1
+        return self._kind.is_dimmable
 
 # TODO: Is there an "action" field to capture and report
 class Button(KetraEntity):
     """This object represents a keypad button that we can trigger and handle
     events for (button presses)."""
-    def __init__(self, ketra, name, area, uid, num, button_type, direction):
+
+    # activateButton's Level runs from 0 to this.
+    MAX_LEVEL = 65535
+
+    __slots__ = ('_num', '_button_type', '_direction', '_keypad', '_n4_name')
+
+    def __init__(self, ketra, name, area, uid, num, button_type, direction,
+                 keypad=None, n4_name=None):
+        """name is the name to show; n4_name, if different, is the one the
+        N4 knows the button by."""
         super(Button, self).__init__(ketra, name, area, uid)
         self._num = num
         self._button_type = button_type
         self._direction = direction
+        self._keypad = keypad
+        self._n4_name = n4_name or name
+
+    def activate(self, level=MAX_LEVEL):
+        """Presses the button: the N4 runs whatever scene it is programmed
+        with, changing any number of groups in this one request. level
+        (0 to MAX_LEVEL) is passed to the scene."""
+        return self._ketra._activate_button(self, level)
 
     def __str__(self):
         """Pretty printed string value of the Button object."""
@@ -687,6 +2907,11 @@ class Button(KetraEntity):
         """Returns the name of the button."""
         return self._name
 
+    @property
+    def n4_name(self):
+        """Returns the name the N4 knows the button by, used to activate it."""
+        return self._n4_name
+
     @property
     def number(self):
         """Returns the button number."""
@@ -697,6 +2922,11 @@ class Button(KetraEntity):
         """Returns the button type (Toggle, MasterRaiseLower, etc.)."""
         return self._button_type
 
+    @property
+    def keypad(self):
+        """Returns the Keypad this button is on."""
+        return self._keypad
+
 
 class Keypad(KetraEntity):
     """Object representing a Ketra keypad.
@@ -706,6 +2936,8 @@ class Keypad(KetraEntity):
     """
     CMD_TYPE = 'DEVICE'
 
+    __slots__ = ('_buttons',)
+
     def __init__(self, ketra, name, area, uid):
         """Initializes the Keypad object."""
         super(Keypad, self).__init__(ketra, name, area, uid)
@@ -719,7 +2951,7 @@ class Keypad(KetraEntity):
 
     def __str__(self):
         """Returns a pretty-printed string for this object."""
-        return 'Keypad name: "%s", area: "%s", id: %d' % (
+        return 'Keypad name: "%s", area: "%s", id: %s' % (
             self._name, self._area, self._id)
 
     @property
@@ -727,9 +2959,27 @@ class Keypad(KetraEntity):
         """Return a tuple of buttons for this keypad."""
         return tuple(button for button in self._buttons)
 
+    def button(self, name):
+        """Returns the button with the given name, shown or as the N4 names
+        it, or None."""
+        for button in self._buttons:
+            if name in (button.name, button.n4_name):
+                return button
+        return None
+
 
 class Area:
-    """An area (i.e. a room) that contains devices/outputs/etc."""
+    """An area (i.e. a room) that contains devices/outputs/etc.
+
+    Areas form a tree below the area named when creating the Ketra (say
+    Home > Floor 1 > Kitchen). The set_* and power_off methods change every
+    output in the area and the areas below it with one Ketra.set_states()
+    call, so the whole area changes in about one round-trip; with an
+    AsyncKetra they return coroutines."""
+
+    __slots__ = ('_ketra', '_name', '_id', '_note', '_parent', '_outputs',
+                 '_keypads', '_sensors', '_children')
+
     def __init__(self, ketra, name, parent, uid, note):
         self._ketra = ketra
         self._name = name
@@ -739,6 +2989,7 @@ class Area:
         self._outputs = []
         self._keypads = []
         self._sensors = []
+        self._children = []
 
     def __str__(self):
         """Returns a pretty-printed string for this object."""
@@ -750,11 +3001,23 @@ class Area:
         initial parsing."""
         self._outputs.append(output)
 
+    def add_child(self, area):
+        """Adds an area nested in this one, only used during parsing."""
+        self._children.append(area)
+
+    def remove_output(self, output):
+        """Removes an output that is no longer in the controller's database."""
+        self._outputs.remove(output)
+
     def add_keypad(self, keypad):
         """Adds a keypad object that's part of this area, only used during
         initial parsing."""
         self._keypads.append(keypad)
 
+    def remove_keypad(self, keypad):
+        """Removes a keypad that is no longer in the controller's database."""
+        self._keypads.remove(keypad)
+
     def add_sensor(self, sensor):
         """Adds a motion sensor object that's part of this area, only used during
         initial parsing."""
@@ -770,11 +3033,72 @@ class Area:
         """The integration id of the area."""
         return self._id
 
+    @property
+    def parent(self):
+        """The area containing this one, or None for the top area."""
+        return self._parent
+
+    @property
+    def children(self):
+        """Return the tuple of the areas directly inside this one."""
+        return tuple(self._children)
+
+    @property
+    def ancestry(self):
+        """Return the tuple of this area and the areas containing it,
+        innermost first."""
+        areas = []
+        area = self
+        while area is not None:
+            areas.append(area)
+            area = area._parent
+        return tuple(areas)
+
+    def walk(self):
+        """Yields this area and every area below it."""
+        stack = [self]
+        while stack:
+            area = stack.pop()
+            yield area
+            stack.extend(reversed(area._children))
+
     @property
     def outputs(self):
         """Return the tuple of the Outputs from this area."""
         return tuple(output for output in self._outputs)
 
+    @property
+    def all_outputs(self):
+        """Return the tuple of the Outputs in this area and the areas below."""
+        return tuple(output for area in self.walk() for output in area._outputs)
+
+    def _set_all(self, state_for, max_concurrency):
+        """Sends state_for(output) to every output in all_outputs at once."""
+        states = {output: state_for(output) for output in self.all_outputs}
+        return self._ketra.set_states(states, max_concurrency or self._ketra._pool_size)
+
+    def set_level(self, level, transition_time=DEFAULT_TRANSITION_TIME,
+                  max_concurrency=None):
+        """Sets the brightness of every output in the area. Returns what
+        Ketra.set_states() returns."""
+        state = Output._state_for_level(level, transition_time)
+        return self._set_all(lambda output: state, max_concurrency)
+
+    def set_xy(self, xy, transition_time=DEFAULT_TRANSITION_TIME, max_concurrency=None):
+        """Sets the xy color of every output in the area."""
+        state = Output._state_for_xy(xy, transition_time)
+        return self._set_all(lambda output: state, max_concurrency)
+
+    def set_cct(self, cct, transition_time=DEFAULT_TRANSITION_TIME, max_concurrency=None):
+        """Sets the color temperature (kelvin) of every output in the area."""
+        return self._set_all(lambda output: output._state_for_cct(cct, transition_time),
+                             max_concurrency)
+
+    def power_off(self, transition_time=DEFAULT_TRANSITION_TIME, max_concurrency=None):
+        """Turns off every output in the area."""
+        state = Output._state_for_power(False, transition_time)
+        return self._set_all(lambda output: state, max_concurrency)
+
     @property
     def keypads(self):
         """Return the tuple of the Keypads from this area."""
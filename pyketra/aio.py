@@ -0,0 +1,427 @@
+"""
+Asyncio client for the Ketra N4.
+
+AsyncKetra and AsyncOutput mirror Ketra and Output, but every request to the
+N4 is a coroutine on one shared aiohttp session, so an event loop can keep
+hundreds of group updates in flight without a thread per request:
+
+    async with AsyncKetra(host, password, 'Home') as ketra:
+        await ketra.load_json_db()
+        await asyncio.gather(*(o.set_level(0) for o in ketra.outputs))
+
+Needs aiohttp (pip install pyketra[async]).
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+
+from pyketra import (DEFAULT_TRANSITION_TIME, ConnectionExistsError, Ketra,
+                     KetraRequestError, KetraTimeoutError, Output, SetStateResult,
+                     Snapshot, _overloaded, _state_body, quote)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+async def _cancel(task):
+    """Cancels task, if any, and waits for it to finish."""
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+class _AsyncRequestHelper:
+    """The coroutine version of pyketra._RequestHelper: concurrent request()
+    calls share one in-flight call of the coroutine function, and all get its
+    result or exception."""
+
+    def __init__(self):
+        self._pending = None
+        self.requests = 0
+        self.deduplicated = 0
+
+    async def request(self, action, timeout=None):
+        """Awaits action(), or the call of it already in flight; gives up with
+        KetraTimeoutError after timeout seconds, leaving the call running for
+        the other waiters."""
+        flight = self._pending
+        if flight is None or flight.done():
+            flight = self._pending = asyncio.ensure_future(action())
+            self.requests += 1
+        else:
+            self.deduplicated += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(flight), timeout)
+        except asyncio.TimeoutError:
+            raise KetraTimeoutError("Timed out waiting for a shared request")
+
+
+class AsyncOutput(Output):
+    """An Output whose setters are coroutines.
+
+    The level/rgb/hs/xy/cct/power properties are read-only here and always
+    return the cached state; use set_level(), set_rgb(), set_hs(), set_xy(),
+    set_cct() and set_power() to change it and query() to refresh it."""
+
+    __slots__ = ()
+
+    level = property(Output.level.fget)
+    rgb = property(Output.rgb.fget)
+    hs = property(Output.hs.fget)
+    xy = property(Output.xy.fget)
+    cct = property(Output.cct.fget)
+    power = property(Output.power.fget)
+
+    async def query(self, max_age=0, timeout=None):
+        """Refreshes the cached state unless it is at most max_age seconds
+        old, then returns self; see AsyncKetra.ensure_fresh()."""
+        await self._ketra.ensure_fresh(max_age, timeout)
+        return self
+
+    @property
+    def _query_waiters(self):
+        if self._waiters is None:
+            self._waiters = _AsyncRequestHelper()
+        return self._waiters
+
+    async def _read_state(self):
+        body = await self._ketra._request('GET', 'groups/' + quote(self._id, safe=''),
+                                          retry=True)
+        state = json.loads(body)['Content']['State']
+        if self._refresh_from_state(state):
+            self._ketra._notify(self)
+        return state
+
+    async def read_state(self, timeout=None):
+        """The coroutine version of Output.read_state()."""
+        return await self._query_waiters.request(self._read_state, timeout)
+
+    async def set_level(self, new_level, transition_time=DEFAULT_TRANSITION_TIME):
+        """Sets the new brightness level."""
+        if self._level == new_level:
+            return
+        state = self._state_for_level(new_level, transition_time)
+        await self._ketra._put_state(self, state)
+        self._update_cached_state(state)
+
+    async def set_power(self, power_on, transition_time=DEFAULT_TRANSITION_TIME):
+        """Turns the output on or off, keeping its level and color."""
+        if self._power == power_on:
+            return
+        state = self._state_for_power(power_on, transition_time)
+        await self._ketra._put_state(self, state)
+        self._update_cached_state(state)
+
+    async def set_rgb(self, new_rgb, transition_time=DEFAULT_TRANSITION_TIME):
+        """Sets new RGB levels."""
+        if self._cached_rgb() == new_rgb:
+            return
+        state = self._state_for_rgb(new_rgb, transition_time)
+        await self._ketra._put_state(self, state)
+        self._update_cached_state(state)
+        self._rgb = new_rgb
+
+    async def set_hs(self, new_hs, transition_time=DEFAULT_TRANSITION_TIME):
+        """Sets new Hue/Saturation levels."""
+        if self._cached_hs() == new_hs:
+            return
+        state = self._state_for_hs(new_hs, transition_time)
+        await self._ketra._put_state(self, state)
+        self._update_cached_state(state)
+        self._hs = new_hs
+
+    async def set_xy(self, new_xy, transition_time=DEFAULT_TRANSITION_TIME):
+        """Sets new XY levels."""
+        if self._xy == list(new_xy):
+            return
+        state = self._state_for_xy(new_xy, transition_time)
+        await self._ketra._put_state(self, state)
+        self._update_cached_state(state)
+
+    async def set_cct(self, new_cct, transition_time=DEFAULT_TRANSITION_TIME):
+        """Sets a new CCT (coordinated color temperature) in kelvin."""
+        if self._cct == new_cct:
+            return
+        state = self._state_for_cct(new_cct, transition_time)
+        await self._ketra._put_state(self, state)
+        self._update_cached_state(state)
+        self._cct = new_cct
+
+
+class AsyncKetra(Ketra):
+    """Asyncio flavor of the Ketra controller class.
+
+    limit caps the number of simultaneous connections to the N4; requests
+    beyond it wait for a free connection rather than failing. Timeouts,
+    retries and the circuit breaker work as for Ketra. Use it as an async
+    context manager, or call close() when done."""
+
+    output_class = AsyncOutput
+
+    def __init__(self, host, password, area, noop_set_state=False, limit=100,
+                 poll_min_interval=1.0, poll_max_interval=30.0, timeouts=None,
+                 retries=2, retry_backoff=0.1, breaker_threshold=5, breaker_reset=30.0):
+        """Initializes the AsyncKetra object. No connection is made to the
+        remote device."""
+        super(AsyncKetra, self).__init__(host, password, area, noop_set_state,
+                                         pool_size=limit,
+                                         poll_min_interval=poll_min_interval,
+                                         poll_max_interval=poll_max_interval,
+                                         timeouts=timeouts, retries=retries,
+                                         retry_backoff=retry_backoff,
+                                         breaker_threshold=breaker_threshold,
+                                         breaker_reset=breaker_reset)
+        self._limit = limit
+        self._client = None
+        self._poller = None
+        self._activity = None
+        self._groups_reads = _AsyncRequestHelper()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Stops polling and any background revalidation, and closes the
+        connections to the N4."""
+        await _cancel(self._poller)
+        self._poller = None
+        await _cancel(self._revalidation)
+        self._revalidation = None
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        super(AsyncKetra, self).close()
+
+    def _client_session(self):
+        """Returns the aiohttp session, creating it inside the running loop."""
+        if self._client is None or self._client.closed:
+            connector = aiohttp.TCPConnector(limit=self._limit,
+                                             ssl=self._ssl_context)
+            self._client = aiohttp.ClientSession(
+                connector=connector, auth=aiohttp.BasicAuth('', self._password))
+        return self._client
+
+    async def _request(self, method, path, operation='query', retry=False, data=None):
+        """Performs one request against the N4 and returns the response body;
+        the coroutine version of Ketra._request(), with the same deadlines,
+        retries and errors."""
+        deadline = time.monotonic() + self._timeouts[operation]
+        attempt = 0
+        while True:
+            try:
+                return await self._request_once(method, path, deadline, data)
+            except KetraRequestError as e:
+                delay = self._retry_delay(e, attempt, deadline) if retry else None
+                if delay is None:
+                    raise
+                _LOGGER.debug("Retrying %s %s in %.2fs: %s", method, path, delay, e)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _request_once(self, method, path, deadline, data):
+        self._breaker.allow()
+        try:
+            started = await self._admission.acquire_async()
+        except BaseException:
+            self._breaker.abandon()
+            raise
+        ok = False
+        sent = False
+        try:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise KetraTimeoutError("%s %s: no time left" % (method, path))
+            sent = True
+            try:
+                async with self._client_session().request(
+                        method, self._url(path), data=data,
+                        timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+                    ok = not _overloaded(r.status)
+                    if r.status >= 400:
+                        raise KetraRequestError("%s %s returned HTTP %d"
+                                                % (method, path, r.status), r.status)
+                    return await r.text()
+            except asyncio.TimeoutError as e:
+                ok = False
+                raise KetraTimeoutError("%s %s timed out after %.1fs"
+                                        % (method, path, timeout)) from e
+            except aiohttp.ClientError as e:
+                ok = False
+                raise KetraRequestError("%s %s failed: %s" % (method, path, e)) from e
+        except asyncio.CancelledError:
+            sent = False          # given up with no outcome
+            raise
+        finally:
+            if sent:
+                self._admission.release(started, ok)
+                self._breaker.record(ok)
+            else:
+                self._admission.abandon()
+                self._breaker.abandon()
+
+    async def _put_state(self, output, dictionary):
+        """Sends a State update for output."""
+        body = _state_body(dictionary)
+        _LOGGER.debug("Sending Ketra %s", body)
+        if self._noop_set_state:
+            _LOGGER.warning("NOT ACTUALLY MAKING REQUEST TO KETRA N4")
+            return
+        await self._request('PUT', self._group_state_path(output), 'set', retry=True,
+                            data=body)
+        if self._activity is not None:
+            self._activity.set()
+
+    async def load_keypads(self):
+        """The coroutine version of Ketra.load_keypads()."""
+        body = await self._request('GET', 'keypads', retry=True)
+        return self._apply_keypads(json.loads(body)['Content'])
+
+    async def _activate_button(self, button, level):
+        """Activates button on the N4; Button.activate() returns this
+        coroutine for buttons of an AsyncKetra."""
+        if self._noop_set_state:
+            _LOGGER.warning("NOT ACTUALLY MAKING REQUEST TO KETRA N4")
+            return
+        await self._request('POST', self._activate_button_path(button), 'set',
+                            data=json.dumps({"Level": level}))
+        if self._activity is not None:
+            self._activity.set()
+
+    async def snapshot(self, outputs=None, max_age=None):
+        """The coroutine version of Ketra.snapshot(); restore() works as is
+        and returns a coroutine."""
+        await self.ensure_fresh(max_age)
+        return Snapshot.of(self._outputs if outputs is None else outputs)
+
+    async def set_states(self, states, max_concurrency=100):
+        """Sends State updates to many outputs concurrently; the coroutine
+        version of Ketra.set_states(), with the same arguments and result."""
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def send(output, dictionary):
+            async with semaphore:
+                start = time.monotonic()
+                try:
+                    await self._put_state(output, dictionary)
+                except Exception as e:
+                    _LOGGER.warning("Failed setting state of %s: %s", output.name, e)
+                    return SetStateResult(False, time.monotonic() - start, e)
+                output._update_cached_state(dictionary)
+                return SetStateResult(True, time.monotonic() - start, None)
+
+        outputs = list(states)
+        results = await asyncio.gather(*(send(output, states[output])
+                                         for output in outputs))
+        return dict(zip(outputs, results))
+
+    async def refresh(self):
+        """Re-reads the groups from the N4 and updates the loaded outputs in
+        place; the coroutine version of Ketra.refresh(). The cache file is
+        written from a worker thread, off the event loop."""
+        body = await self._request('GET', 'groups', 'load', retry=True)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._apply_fetched_groups, [body.encode('utf-8')])
+
+    def _read_through(self):
+        """Getters cannot await a request, so state_ttl is not applied."""
+
+    async def ensure_fresh(self, max_age=0, timeout=None):
+        """The coroutine version of Ketra.ensure_fresh()."""
+        if max_age is None:
+            return False
+        if (max_age > 0 and self._states_fetched is not None and
+                time.monotonic() - self._states_fetched <= max_age):
+            return False
+        await self._shared_poll(timeout)
+        return True
+
+    async def _shared_poll(self, timeout=None):
+        """poll(), sharing a call already in flight."""
+        return await self._groups_reads.request(self.poll, timeout)
+
+    async def poll(self):
+        """Reads every group's state in one request and notifies subscribers
+        of the outputs that changed; the coroutine version of Ketra.poll()."""
+        body = await self._request('GET', 'groups', 'poll', retry=True)
+        changes = self._apply_fetched_groups([body.encode('utf-8')], cache=False)
+        if changes:
+            for output in changes.added + changes.renamed + changes.changed:
+                self._notify(output)
+        return changes
+
+    def connect(self):
+        """Starts polling the N4 as a task on the running event loop, with the
+        same adaptive interval as the threaded client."""
+        if self._poller is not None and not self._poller.done():
+            raise ConnectionExistsError("Already connected")
+        self._activity = asyncio.Event()
+        self._poller = asyncio.ensure_future(self._poll_loop())
+
+    async def _poll_loop(self):
+        conn = self._conn
+        interval = conn._min_interval
+        next_poll = time.monotonic() + interval
+        while True:
+            wait = next_poll - time.monotonic()
+            if wait > 0:
+                try:
+                    await asyncio.wait_for(self._activity.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                if self._activity.is_set():
+                    # As KetraConnection.note_activity(): poll again within
+                    # min_interval, without polling after every command.
+                    self._activity.clear()
+                    interval = conn._min_interval
+                    next_poll = min(next_poll, time.monotonic() + interval)
+                continue
+            try:
+                changed = await self._shared_poll()
+            except Exception as e:
+                _LOGGER.warning("Polling %s failed: %s", self._host, e)
+                changed = None
+            if changed:
+                interval = conn._min_interval
+            else:
+                interval = min(interval * conn._backoff, conn._max_interval)
+            conn._interval = interval
+            next_poll = time.monotonic() + interval
+
+    async def _revalidate_db(self):
+        """Re-fetches the groups and reloads them if they changed."""
+        try:
+            await self.refresh()
+        except Exception as e:
+            _LOGGER.warning("Failed revalidating ketra configuration: %s", e)
+
+    async def load_json_db(self, disable_cache=False, revalidate=True, keypads=False):
+        """Load the Ketra database from the server; as Ketra.load_json_db, but
+        the revalidation runs as a task on the event loop and the cache file
+        is read and parsed from a worker thread."""
+        loaded = False
+        if not disable_cache:
+            loaded = await asyncio.get_running_loop().run_in_executor(
+                None, self._load_cached_db)
+
+        if not loaded:
+            _LOGGER.info("doing request for ketra configuration file %s",
+                         self._url('groups'))
+            await self.refresh()
+        else:
+            if revalidate:
+                self._revalidation = asyncio.ensure_future(self._revalidate_db())
+        if keypads:
+            await self.load_keypads()
+
+        _LOGGER.info("Loaded json db")
+        return True
@@ -0,0 +1,292 @@
+"""
+Lighting effects animated by the N4 itself.
+
+An N4 fades a group from its current state, or from a StartState given in
+the same request, to a new state over TransitionTime milliseconds.  The
+effects here compile into keyframes, each one such State command covering
+a whole segment of the effect, so a fade costs one request per output
+instead of a stream of small steps.  EffectScheduler sends each keyframe to
+every output playing an effect in one Ketra.set_states() batch, on time:
+
+    scheduler = EffectScheduler(ketra)
+    scheduler.play(Sunrise(duration=1800), ketra.area('Home/Bedroom').all_outputs)
+    scheduler.play(ColorCycle([(0.68, 0.3), (0.3, 0.6), (0.155, 0.076)],
+                              period=30, cycles=None), ketra.outputs[:4])
+
+The scheduler drives the threaded Ketra; with AsyncKetra, send the
+keyframes from Effect.compile() with its set_states() instead.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+_LOGGER = logging.getLogger(__name__)
+
+# One State command of a compiled effect: at is the offset in seconds from
+# the start of the effect (or of each cycle) at which to send state.
+Keyframe = namedtuple('Keyframe', ['at', 'state'])
+
+
+def _look(output, level=None, xy=None, cct=None):
+    """Returns the State fields for a brightness and color, any of which may
+    be None to leave it alone."""
+    state = {"PowerOn": True}
+    if level is not None:
+        state["Brightness"] = level
+    if xy is not None:
+        state["xChromaticity"] = xy[0]
+        state["yChromaticity"] = xy[1]
+    elif cct is not None:
+        state.update(output._color_for_cct(cct))
+    return state
+
+
+def _command(look, seconds, start=None):
+    """Returns a State command fading to look over seconds, from start if
+    given, else from wherever the output is."""
+    state = dict(look)
+    state["TransitionTime"] = int(round(seconds * 1000))
+    state["TransitionComplete"] = True
+    if start is not None:
+        state["StartState"] = start
+    return state
+
+
+class Effect:
+    """Base class of the effects. duration is the length in seconds of one
+    pass, and cycles the number of passes (None repeats until cancelled)."""
+
+    duration = 0.0
+    cycles = 1
+
+    def compile(self, output):
+        """Returns the list of Keyframes that play the effect on output."""
+        raise NotImplementedError
+
+
+class Fade(Effect):
+    """Fades to a brightness and/or color (xy or cct) over duration seconds,
+    from start (a dict with any of level, xy and cct) or from the current
+    state. One command per output."""
+
+    def __init__(self, duration, level=None, xy=None, cct=None, start=None):
+        self.duration = duration
+        self._level = level
+        self._xy = xy
+        self._cct = cct
+        self._start = start
+
+    def compile(self, output):
+        start = None
+        if self._start is not None:
+            start = _look(output, self._start.get('level'), self._start.get('xy'),
+                          self._start.get('cct'))
+        return [Keyframe(0.0, _command(_look(output, self._level, self._xy, self._cct),
+                                       self.duration, start))]
+
+
+class ColorCycle(Effect):
+    """Cycles through colors (xy pairs) every period seconds, fading between
+    them, cycles times (None for ever). One command per color per cycle."""
+
+    def __init__(self, colors, period, level=None, cycles=1):
+        if len(colors) < 2:
+            raise ValueError("ColorCycle needs at least two colors")
+        self.duration = period
+        self.cycles = cycles
+        self._colors = list(colors)
+        self._level = level
+
+    def compile(self, output):
+        segment = self.duration / len(self._colors)
+        frames = []
+        for i, xy in enumerate(self._colors):
+            target = self._colors[(i + 1) % len(self._colors)]
+            start = _look(output, self._level, xy) if i == 0 else None
+            frames.append(Keyframe(i * segment,
+                                   _command(_look(output, self._level, target),
+                                            segment, start)))
+        return frames
+
+
+class Sunrise(Effect):
+    """Brightens from off to end_level while warming up from start_cct to
+    end_cct (kelvin) over duration seconds. The light level follows a
+    quadratic ease-in, which the N4 draws as segments straight lines."""
+
+    def __init__(self, duration, start_cct=1800, end_cct=5000, end_level=1.0,
+                 segments=4):
+        self.duration = duration
+        self._start_cct = start_cct
+        self._end_cct = end_cct
+        self._end_level = end_level
+        self._segments = segments
+
+    def _point(self, output, t):
+        """The look at fraction t of the way through."""
+        return _look(output, self._end_level * t * t,
+                     cct=self._start_cct + (self._end_cct - self._start_cct) * t)
+
+    def compile(self, output):
+        segment = self.duration / self._segments
+        frames = []
+        for i in range(self._segments):
+            start = self._point(output, 0.0) if i == 0 else None
+            frames.append(Keyframe(i * segment,
+                                   _command(self._point(output, (i + 1.0) / self._segments),
+                                            segment, start)))
+        return frames
+
+
+class _Play:
+    """An effect being played on some outputs."""
+
+    __slots__ = ('effect', 'frames', 'times', 'start')
+
+    def __init__(self, effect, frames, start):
+        self.effect = effect
+        self.frames = frames  # output -> [Keyframe]
+        self.times = [frame.at for frame in next(iter(frames.values()))]
+        self.start = start
+
+
+class EffectScheduler:
+    """Sends the keyframes of playing effects when they come due.
+
+    Keyframes due at the same moment, across all outputs and effects, go
+    out as one Ketra.set_states() batch, sent from a small pool of threads
+    so a slow batch does not delay the next one. Playing an effect on an
+    output takes it out of any effect it was already playing."""
+
+    def __init__(self, ketra, max_concurrency=None, senders=4):
+        """Initializes the scheduler; its thread starts with the first play()."""
+        self._ketra = ketra
+        self._max_concurrency = max_concurrency or ketra._pool_size
+        self._cond = threading.Condition()
+        self._heap = []           # (due, seq, play id, keyframe index, cycle)
+        self._seq = itertools.count()
+        self._ids = itertools.count(1)
+        self._plays = {}          # play id -> _Play
+        self._senders = ThreadPoolExecutor(max_workers=senders)
+        self._thread = None
+        self._done = False
+        self._sending = 0         # batches handed to the senders, not yet done
+        self.batches = 0
+        self.commands = 0
+
+    def play(self, effect, outputs, delay=0.0):
+        """Starts effect on outputs after delay seconds; returns an id for
+        cancel()."""
+        outputs = list(outputs)
+        if not outputs:
+            return None
+        frames = {output: effect.compile(output) for output in outputs}
+        with self._cond:
+            for play_id, other in list(self._plays.items()):
+                for output in outputs:
+                    other.frames.pop(output, None)
+                if not other.frames:
+                    del self._plays[play_id]
+            play_id = next(self._ids)
+            play = _Play(effect, frames, time.monotonic() + delay)
+            self._plays[play_id] = play
+            self._push(play_id, play, 0, 0)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return play_id
+
+    def cancel(self, play_id):
+        """Stops sending the rest of an effect. The N4 still finishes the
+        transition it is in."""
+        with self._cond:
+            self._plays.pop(play_id, None)
+            self._cond.notify_all()
+
+    @property
+    def playing(self):
+        """The ids of the effects still to send keyframes."""
+        with self._cond:
+            return list(self._plays)
+
+    def wait(self, timeout=None):
+        """Waits until every effect has sent its last keyframe and the N4 has
+        answered; returns False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._plays and not self._sending,
+                                       timeout)
+
+    def stop(self):
+        """Cancels everything, including batches waiting for a sender, and
+        stops the scheduler. Batches already being sent finish."""
+        with self._cond:
+            self._plays.clear()
+            self._done = True
+            self._cond.notify_all()
+        self._senders.shutdown(wait=False, cancel_futures=True)
+
+    def _push(self, play_id, play, index, cycle):
+        due = play.start + cycle * play.effect.duration + play.times[index]
+        heapq.heappush(self._heap, (due, next(self._seq), play_id, index, cycle))
+
+    def _advance(self, play_id, play, index, cycle):
+        """Schedules the keyframe after index, or ends the play."""
+        if index + 1 < len(play.times):
+            self._push(play_id, play, index + 1, cycle)
+        elif play.effect.cycles is None or cycle + 1 < play.effect.cycles:
+            self._push(play_id, play, 0, cycle + 1)
+        else:
+            del self._plays[play_id]
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._done:
+                        return
+                    while self._heap and self._heap[0][2] not in self._plays:
+                        heapq.heappop(self._heap)
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                states = {}
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, play_id, index, cycle = heapq.heappop(self._heap)
+                    play = self._plays.get(play_id)
+                    if play is None:
+                        continue
+                    for output, frames in play.frames.items():
+                        states[output] = frames[index].state
+                    self._advance(play_id, play, index, cycle)
+                if not states:
+                    continue
+                # Counted before the plays it ends are seen to be gone.
+                self._sending += 1
+            self.batches += 1
+            self.commands += len(states)
+            try:
+                future = self._senders.submit(self._send, states)
+            except RuntimeError:    # stop() shut the senders down
+                self._sent(None)
+                return
+            future.add_done_callback(self._sent)
+
+    def _sent(self, future):
+        """Called when a batch has been sent, failed or was cancelled."""
+        with self._cond:
+            self._sending -= 1
+            self._cond.notify_all()
+
+    def _send(self, states):
+        results = self._ketra.set_states(states, self._max_concurrency)
+        failed = sum(1 for result in results.values() if not result.ok)
+        if failed:
+            _LOGGER.warning("%d of %d effect commands failed", failed, len(results))
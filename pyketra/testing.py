@@ -0,0 +1,320 @@
+"""
+Local stand-ins for a Ketra N4, for exercising pyketra without hardware.
+
+FakeN4 serves the subset of the N4 HTTPS API that pyketra uses from an
+asyncio server on localhost.  Its address can be handed straight to Ketra
+or AsyncKetra as the host:
+
+    n4 = FakeN4(make_groups(200), password='pw',
+                ssl_context=self_signed_context()).start_in_thread()
+    k = Ketra(n4.address, 'pw', 'Home')
+    k.load_json_db(disable_cache=True)
+    ...
+    n4.stop_in_thread()
+
+FakeN4Responder answers UDP discovery broadcasts the way N4s do, for
+exercising discoverN4Devices() with broadcast and port pointed at it.
+
+"""
+
+import asyncio
+import base64
+import json
+import os
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import parse_qs, unquote, urlsplit
+
+API_PREFIX = '/ketra.cgi/api/v1/'
+
+# Fields of a state PUT that describe the transition rather than the state.
+_TRANSITION_FIELDS = ('TransitionTime', 'TransitionComplete', 'StartState')
+
+_REASONS = {200: 'OK', 401: 'Unauthorized', 404: 'Not Found',
+            405: 'Method Not Allowed', 500: 'Internal Server Error',
+            503: 'Service Unavailable'}
+
+
+def make_groups(count, prefix='Group'):
+    """Returns count synthetic groups shaped like the N4 groups Content."""
+    groups = []
+    for i in range(count):
+        groups.append({'Id': str(uuid.UUID(int=i + 1)),
+                       'Name': '%s %d' % (prefix, i),
+                       'State': {'PowerOn': True,
+                                 'Brightness': (i % 100) / 100.0,
+                                 'xChromaticity': 0.3 + (i % 50) / 500.0,
+                                 'yChromaticity': 0.3 + (i % 37) / 400.0,
+                                 'Vibrancy': 0.6}})
+    return groups
+
+
+def self_signed_context(directory=None):
+    """Returns a server SSLContext using a throwaway self-signed certificate,
+    which is what a real N4 presents too. Needs the openssl command line tool."""
+    directory = directory or tempfile.mkdtemp(prefix='fake_n4_')
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                    '-keyout', key, '-out', cert, '-days', '1',
+                    '-subj', '/CN=localhost'],
+                   check=True, capture_output=True)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+class FakeN4:
+    """An asyncio HTTP(S) server answering like an N4's groups API.
+
+    groups is the list returned by GET /groups; state PUTs update it in place.
+    keypads is the list returned by GET /keypads, and each POST to
+    activateButton is appended to activations as (keypad name, button name,
+    level). latency (seconds) is added to every response to model the
+    round-trip. If capacity is set, the N4 is modelled as serving that many
+    requests at once: with more in flight, latency stretches in proportion,
+    and beyond twice capacity requests fail with 503. While fail_requests is
+    positive, each request uses one up and fails with 503, to model a flaky
+    N4. Every request is appended to requests as (method, path), and
+    max_in_flight records the highest number of requests served at once."""
+
+    def __init__(self, groups=None, password='', latency=0.0, ssl_context=None,
+                 host='127.0.0.1', port=0, keypads=None, capacity=None):
+        self.groups = list(groups or [])
+        self.keypads = list(keypads or [])
+        self.activations = []
+        self.password = password
+        self.latency = latency
+        self.capacity = capacity
+        self.fail_requests = 0
+        self.requests = []
+        self.max_in_flight = 0
+        self._in_flight = 0
+        self._ssl_context = ssl_context
+        self._host = host
+        self._port = port
+        self._server = None
+        self._handlers = {}  # handler task -> its StreamWriter
+        self._loop = None
+        self._thread = None
+
+    @property
+    def address(self):
+        """host:port of the running server, usable as a Ketra host."""
+        return '%s:%d' % (self._host, self._port)
+
+    async def start(self):
+        """Starts serving on the current event loop."""
+        self._server = await asyncio.start_server(self._handle, self._host,
+                                                  self._port, ssl=self._ssl_context)
+        self._port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        """Stops serving, dropping any open client connections."""
+        self._server.close()
+        for writer in list(self._handlers.values()):
+            writer.transport.abort()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def start_in_thread(self):
+        """Starts serving from a private event loop on a daemon thread, for use
+        with the threaded client."""
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop_in_thread(self):
+        """Stops a server started with start_in_thread()."""
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def group(self, key):
+        """Returns the group whose Name or Id is key, or None."""
+        for group in self.groups:
+            if key in (group['Name'], group['Id']):
+                return group
+        return None
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._handlers[task] = writer
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                self._in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self._in_flight)
+                try:
+                    load = self._in_flight / self.capacity if self.capacity else 1.0
+                    if self.latency:
+                        await asyncio.sleep(self.latency * max(1.0, load))
+                    if self.fail_requests > 0:
+                        self.fail_requests -= 1
+                        status, payload = 503, _envelope(None, 'Unavailable')
+                    elif load > 2:
+                        status, payload = 503, _envelope(None, 'Busy')
+                    else:
+                        status, payload = self._respond(method, target, headers, body)
+                finally:
+                    self._in_flight -= 1
+
+                data = json.dumps(payload).encode('utf-8')
+                writer.write(b'HTTP/1.1 %d %s\r\n'
+                             b'Content-Type: application/json\r\n'
+                             b'Content-Length: %d\r\n\r\n'
+                             % (status, _REASONS[status].encode('ascii'), len(data)))
+                writer.write(data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            self._handlers.pop(task, None)
+            writer.close()
+
+    def _respond(self, method, target, headers, body):
+        """Returns (status, payload) for one request."""
+        url = urlsplit(target)
+        self.requests.append((method, url.path))
+        expected = 'Basic ' + base64.b64encode(
+            (':' + self.password).encode('utf-8')).decode('ascii')
+        if headers.get('authorization') != expected:
+            return 401, _envelope(None, 'Unauthorized')
+        if not url.path.startswith(API_PREFIX):
+            return 404, _envelope(None, 'Not found')
+        parts = [unquote(p) for p in url.path[len(API_PREFIX):].split('/')]
+        if parts[0].lower() == 'keypads' and method == 'GET':
+            names = parse_qs(url.query).get('name')
+            return 200, _envelope([k for k in self.keypads
+                                   if names is None or k['Name'] in names])
+        if parts[0].lower() == 'activatebutton' and method == 'POST':
+            return self._activate(parse_qs(url.query), body)
+        if parts[0].lower() != 'groups':
+            return 404, _envelope(None, 'Not found')
+
+        if len(parts) == 1:
+            if method != 'GET':
+                return 405, _envelope(None, 'Method not allowed')
+            return 200, _envelope(self.groups)
+        group = self.group(parts[1])
+        if group is None:
+            return 404, _envelope(None, 'No such group')
+        if len(parts) == 2:
+            return 200, _envelope(group)
+        if parts[2].lower() != 'state':
+            return 404, _envelope(None, 'Not found')
+        if method == 'PUT':
+            new_state = json.loads(body.decode('utf-8'))
+            for field in _TRANSITION_FIELDS:
+                new_state.pop(field, None)
+            group['State'].update(new_state)
+        return 200, _envelope(group['State'])
+
+    def _activate(self, query, body):
+        keypad_name = query.get('keypadName', [None])[0]
+        button_name = query.get('buttonName', [None])[0]
+        for keypad in self.keypads:
+            if keypad['Name'] != keypad_name:
+                continue
+            for button in keypad.get('Buttons') or ():
+                if button['Name'] == button_name:
+                    level = json.loads(body.decode('utf-8') or '{}').get('Level')
+                    self.activations.append((keypad_name, button_name, level))
+                    return 200, _envelope(None)
+        return 404, _envelope(None, 'No such button')
+
+
+class FakeN4Responder:
+    """Answers N4 discovery requests on a local UDP port.
+
+    devices is a list of dicts of the fields each pretend N4 advertises
+    (e.g. {'serial': 'KP00001485'}); every discovery datagram gets one reply
+    per device, each after delay seconds. queries counts the requests seen."""
+
+    def __init__(self, devices, host='127.0.0.1', port=0, delay=0.0):
+        self.devices = list(devices)
+        self.delay = delay
+        self.queries = 0
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((host, port))
+        self._sock.settimeout(0.1)
+        self._done = threading.Event()
+        self._thread = None
+
+    @property
+    def port(self):
+        """The UDP port to pass to discoverN4Devices()."""
+        return self._sock.getsockname()[1]
+
+    def start(self):
+        """Starts answering on a daemon thread."""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops answering and closes the socket."""
+        self._done.set()
+        self._thread.join()
+        self._sock.close()
+
+    def _run(self):
+        while not self._done.is_set():
+            try:
+                _, addr = self._sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            self.queries += 1
+            for device in self.devices:
+                if self.delay:
+                    time.sleep(self.delay)
+                reply = ''.join('%s=%s\n' % item for item in device.items())
+                self._sock.sendto(reply.encode('utf-8'), addr)
+
+
+def make_keypads(count, buttons=4, prefix='Keypad'):
+    """Returns count synthetic keypads shaped like the N4 keypads Content."""
+    keypads = []
+    for i in range(count):
+        keypads.append({'Id': str(uuid.UUID(int=0x10000 + i)),
+                        'Name': '%s %d' % (prefix, i),
+                        'Buttons': [{'Id': str(uuid.UUID(int=0x20000 + i * buttons + b)),
+                                     'Name': 'Scene %d' % b,
+                                     'Position': b + 1}
+                                    for b in range(buttons)]})
+    return keypads
+
+
+def _envelope(content, error=None):
+    """Wraps content the way the N4 does."""
+    return {'Content': content, 'Success': error is None, 'Error': error}
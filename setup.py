@@ -20,6 +20,7 @@ setup(
         'Topic :: Home Automation',
         'Topic :: Software Development :: Libraries :: Python Modules',
     ],
-    install_requires=['colormath', 'requests'],
+    install_requires=['colormath', 'numpy', 'requests'],
+    extras_require={'async': ['aiohttp']},
     zip_safe=True,
 )
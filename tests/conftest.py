@@ -0,0 +1,43 @@
+import pytest
+
+from pyketra import Ketra
+from pyketra.testing import FakeN4, make_groups, self_signed_context
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    """Runs each test in its own directory, where Ketra writes its cache."""
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.fixture(scope='session')
+def ssl_context():
+    return self_signed_context()
+
+
+@pytest.fixture
+def n4(ssl_context):
+    server = FakeN4(make_groups(8), password='pw', ssl_context=ssl_context)
+    server.start_in_thread()
+    yield server
+    server.stop_in_thread()
+
+
+@pytest.fixture
+def make_ketra(n4):
+    """Returns a factory for loaded Ketras talking to n4."""
+    made = []
+
+    def make(**kwargs):
+        ketra = Ketra(n4.address, 'pw', 'Home', **kwargs)
+        ketra.load_json_db(disable_cache=True)
+        made.append(ketra)
+        return ketra
+    yield make
+    for ketra in made:
+        ketra.close()
+
+
+@pytest.fixture
+def ketra(make_ketra):
+    return make_ketra()
@@ -0,0 +1,91 @@
+import asyncio
+import threading
+import time
+
+from pyketra import AdmissionControl
+
+
+def _complete(admission, latency, ok=True, count=1):
+    """Admits and releases count requests that took latency seconds."""
+    for _ in range(count):
+        admission.acquire()
+        admission.release(time.monotonic() - latency, ok)
+
+
+def test_token_bucket_caps_the_rate():
+    admission = AdmissionControl(max_concurrency=16, max_rate=20, burst=2)
+    start = time.monotonic()
+    _complete(admission, 0.0, count=6)
+    assert time.monotonic() - start >= (6 - 2) / 20 - 0.01
+    assert admission.admitted == 6
+    assert admission.delayed >= 3
+    assert admission.wait_time > 0
+
+
+def test_limit_grows_while_responses_are_prompt():
+    admission = AdmissionControl(max_concurrency=16, initial_concurrency=4)
+    _complete(admission, 0.05, count=5)
+    assert admission.limit == 9              # slow start: one per response
+    assert admission.increases == 5
+    assert 0.05 <= admission.baseline < 0.06
+    _complete(admission, 0.05, count=20)
+    assert admission.limit == 16
+
+
+def test_errors_and_slow_responses_cut_the_limit_once_per_round_trip():
+    admission = AdmissionControl(max_concurrency=16, initial_concurrency=4)
+    _complete(admission, 0.05, count=4)
+    _complete(admission, 0.05, ok=False, count=2)
+    assert admission.limit == 4              # leaving slow start halves it
+    assert (admission.errors, admission.decreases) == (2, 1)
+    time.sleep(0.3)                          # a round-trip, slow one included
+    _complete(admission, 0.5)
+    assert admission.slow == 1
+    assert admission.decreases == 2
+    assert abs(admission.limit - 4 * 0.7) < 1e-9
+    _complete(admission, 0.05, ok=False, count=10)
+    assert admission.decreases == 2
+
+
+def test_in_flight_is_capped_by_the_limit():
+    admission = AdmissionControl(max_concurrency=2, initial_concurrency=2)
+    started = [admission.acquire(), admission.acquire()]
+    admitted = threading.Event()
+    thread = threading.Thread(target=lambda: (admission.acquire(), admitted.set()))
+    thread.start()
+    assert not admitted.wait(0.1)
+    admission.release(started.pop(), True)
+    assert admitted.wait(1)
+    thread.join()
+    assert admission.in_flight == 2
+    assert admission.delayed == 1
+
+
+def test_async_waiters_are_woken_by_release():
+    admission = AdmissionControl(max_concurrency=1, initial_concurrency=1)
+
+    async def main():
+        started = admission.acquire()
+        abandoned = asyncio.ensure_future(admission.acquire_async())
+        waiting = asyncio.ensure_future(admission.acquire_async())
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        abandoned.cancel()
+        threading.Thread(target=admission.release, args=(started, True)).start()
+        await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(main())
+    assert admission.in_flight == 1
+    assert admission.admitted == 2
+
+
+def test_ketra_backs_off_when_the_n4_is_overloaded(n4, make_ketra):
+    ketra = make_ketra(retries=0)
+    limit = ketra.admission.limit
+    n4.fail_requests = 3
+    ketra.set_states({output: {'Brightness': 0.6} for output in ketra.outputs})
+    stats = ketra.admission.stats
+    assert stats['errors'] == 3
+    assert stats['decreases'] >= 1
+    assert stats['limit'] < limit + stats['increases']
+    assert stats['in_flight'] == 0
@@ -0,0 +1,84 @@
+import asyncio
+
+from pyketra import KetraRequestError
+from pyketra.aio import AsyncKetra, AsyncOutput
+
+
+def _run(n4, test, **kwargs):
+    """Runs test(ketra) with a loaded AsyncKetra talking to n4."""
+    async def main():
+        async with AsyncKetra(n4.address, 'pw', 'Home', **kwargs) as ketra:
+            await ketra.load_json_db(disable_cache=True)
+            return await test(ketra)
+    return asyncio.run(main())
+
+
+def test_load_makes_async_outputs(n4):
+    async def test(ketra):
+        assert len(ketra.outputs) == 8
+        assert all(isinstance(output, AsyncOutput) for output in ketra.outputs)
+        assert ketra.outputs[3].level == n4.groups[3]['State']['Brightness']
+    _run(n4, test)
+
+
+def test_setters_send_and_update_the_cache(n4):
+    async def test(ketra):
+        output = ketra.outputs[0]
+        await output.set_power(False)
+        assert n4.group(output.name)['State']['PowerOn'] is False
+        await output.set_level(0.25)
+        await output.set_xy((0.45, 0.41))
+        state = n4.group(output.name)['State']
+        assert (state['PowerOn'], state['Brightness']) == (True, 0.25)
+        assert (state['xChromaticity'], state['yChromaticity']) == (0.45, 0.41)
+        assert (output.power, output.level) == (True, 0.25)
+        assert list(output.xy) == [0.45, 0.41]
+        await output.set_cct(2700)
+        assert output.cct == 2700
+        assert abs(output.xy[0] - n4.group(output.name)['State']['xChromaticity']) < 1e-9
+    _run(n4, test)
+
+
+def test_unchanged_value_sends_nothing(n4):
+    async def test(ketra):
+        output = ketra.outputs[5]
+        sent = len(n4.requests)
+        await output.set_level(output.level)
+        assert len(n4.requests) == sent
+    _run(n4, test)
+
+
+def test_set_states_reports_each_output(n4):
+    async def test(ketra):
+        states = {output: {'Brightness': 0.5} for output in ketra.outputs}
+        n4.fail_requests = 1
+        results = await ketra.set_states(states)
+        assert set(results) == set(ketra.outputs)
+        assert all(result.ok for result in results.values())
+        assert all(group['State']['Brightness'] == 0.5 for group in n4.groups)
+        assert all(output.level == 0.5 for output in ketra.outputs)
+    _run(n4, test)
+
+
+def test_set_states_reports_failures_without_raising(n4):
+    async def test(ketra):
+        output = ketra.outputs[0]
+        n4.groups.remove(n4.group(output.uid))
+        results = await ketra.set_states({output: {'Brightness': 0.9},
+                                          ketra.outputs[1]: {'Brightness': 0.9}})
+        assert not results[output].ok
+        assert isinstance(results[output].error, KetraRequestError)
+        assert results[output].error.status == 404
+        assert results[ketra.outputs[1]].ok
+        assert output.level != 0.9
+    _run(n4, test, retries=0)
+
+
+def test_read_state_refreshes_the_cache(n4):
+    async def test(ketra):
+        output = ketra.outputs[2]
+        n4.group(output.uid)['State']['Brightness'] = 0.66
+        state = await output.read_state()
+        assert state['Brightness'] == 0.66
+        assert output.level == 0.66
+    _run(n4, test)
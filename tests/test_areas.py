@@ -0,0 +1,117 @@
+import asyncio
+import threading
+
+import pytest
+
+from pyketra import Ketra
+from pyketra.aio import AsyncKetra
+from pyketra.testing import FakeN4, make_groups
+
+
+def _house():
+    """Groups placed in areas through the Area and Room fields, in the forms
+    the parser accepts."""
+    groups = make_groups(7)
+    groups[0]['Area'] = 'Floor 1/Kitchen'
+    groups[1]['Area'] = ' Floor 1 / Kitchen '
+    groups[2]['Area'] = ['Floor 1']
+    groups[2]['Room'] = 'Den'
+    groups[3]['Room'] = 'Garage'
+    groups[4]['Area'] = 'Floor 2'
+    return groups                      # 5 and 6 stay in the top area
+
+
+@pytest.fixture
+def house_n4(ssl_context):
+    server = FakeN4(_house(), password='pw', ssl_context=ssl_context)
+    server.start_in_thread()
+    yield server
+    server.stop_in_thread()
+
+
+@pytest.fixture
+def house(house_n4):
+    ketra = Ketra(house_n4.address, 'pw', 'Home')
+    ketra.load_json_db(disable_cache=True)
+    yield ketra
+    ketra.close()
+
+
+def _names(outputs):
+    return sorted(output.name for output in outputs)
+
+
+def test_areas_form_a_tree(house):
+    home = house.area('Home')
+    assert sorted(area.uid for area in house.areas) == [
+        'Home', 'Home/Floor 1', 'Home/Floor 1/Den', 'Home/Floor 1/Kitchen',
+        'Home/Floor 2', 'Home/Garage']
+    assert [area.name for area in home.children] == ['Floor 1', 'Garage', 'Floor 2']
+    kitchen = house.area('Home/Floor 1/Kitchen')
+    assert [area.name for area in kitchen.ancestry] == ['Kitchen', 'Floor 1', 'Home']
+    assert _names(kitchen.outputs) == ['Group 0', 'Group 1']
+    assert _names(home.outputs) == ['Group 5', 'Group 6']
+
+
+def test_all_outputs_covers_the_areas_below(house):
+    assert _names(house.area('Home/Floor 1').all_outputs) == ['Group 0', 'Group 1',
+                                                              'Group 2']
+    assert len(house.area('Home').all_outputs) == 7
+    assert house.area('Home/Floor 1').outputs == ()
+
+
+def test_area_subscribers_hear_about_outputs_below(house):
+    heard = []
+    done = threading.Event()
+    house.subscribe(house.area('Home/Floor 1'), lambda obj: (heard.append(obj), done.set()))
+    den_lamp = house.area('Home/Floor 1/Den').outputs[0]
+    house._notify(house.area('Home/Floor 2').outputs[0])
+    house._notify(den_lamp)
+    assert done.wait(2)
+    assert house._events.wait_idle(2)
+    assert heard == [den_lamp]
+
+
+def test_refresh_moves_outputs_whose_area_changed(house_n4, house):
+    garage = house.area('Home/Garage')
+    output = garage.outputs[0]
+    group = house_n4.group(output.uid)
+    group['Area'] = 'Floor 1'
+    group['Room'] = 'Kitchen'
+    changes = house.refresh()
+    assert changes.changed == [output]
+    assert output.area == 'Home/Floor 1/Kitchen'
+    assert garage.outputs == ()
+    assert output in house.area('Home/Floor 1/Kitchen').outputs
+    assert output in house.index.in_area('Home/Floor 1/Kitchen')
+    assert output not in house.index.in_area('Home/Garage')
+
+
+def test_area_setters_change_every_output_below(house_n4, house):
+    floor = house.area('Home/Floor 1')
+    results = floor.set_level(0.42)
+    assert _names(results) == ['Group 0', 'Group 1', 'Group 2']
+    assert all(result.ok for result in results.values())
+    levels = [group['State']['Brightness'] for group in house_n4.groups]
+    assert levels[:3] == [0.42] * 3
+    assert 0.42 not in levels[3:]
+
+    floor.set_xy((0.5, 0.4))
+    floor.set_cct(3000)
+    floor.power_off()
+    for output in floor.all_outputs:
+        state = house_n4.group(output.uid)['State']
+        assert state['PowerOn'] is False
+        assert output.power is False
+        assert output.xy == [state['xChromaticity'], state['yChromaticity']]
+
+
+def test_async_area_setters_are_coroutines(house_n4):
+    async def main():
+        async with AsyncKetra(house_n4.address, 'pw', 'Home') as ketra:
+            await ketra.load_json_db(disable_cache=True)
+            results = await ketra.area('Home/Floor 2').set_level(0.9)
+            return [output.level for output in results]
+
+    assert asyncio.run(main()) == [0.9]
+    assert house_n4.groups[4]['State']['Brightness'] == 0.9
@@ -0,0 +1,124 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from pyketra import (CircuitBreaker, CircuitOpenError, Ketra, KetraFleet,
+                     KetraRequestError, KetraTimeoutError)
+from pyketra.testing import FakeN4, make_groups
+
+
+def test_breaker_opens_after_threshold_and_probes_after_reset():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=0.05)
+    for _ in range(2):
+        breaker.allow()
+        breaker.record(False)
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    time.sleep(0.06)
+    breaker.allow()                    # the probe
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()                # only one at a time
+    breaker.record(True)
+    assert breaker.state == 'closed'
+    assert breaker.stats['rejected'] == 2
+
+
+def test_failed_probe_reopens_and_abandoned_probe_frees_slot():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.01)
+    breaker.allow()
+    breaker.record(False)
+    time.sleep(0.02)
+    breaker.allow()
+    breaker.abandon()
+    breaker.allow()
+    breaker.record(False)
+    assert breaker.state == 'open'
+    assert breaker.opened == 2
+
+
+def test_transient_errors_are_retried(n4, ketra):
+    output = ketra.outputs[0]
+    n4.fail_requests = 2
+    result = ketra.set_states({output: {'Brightness': 0.4}})[output]
+    assert result.ok
+    assert n4.group(output.name)['State']['Brightness'] == 0.4
+
+
+def test_client_errors_are_not_retried(n4, make_ketra):
+    ketra = make_ketra()
+    ketra._session.auth = ('', 'wrong')
+    sent = len(n4.requests)
+    with pytest.raises(KetraRequestError) as e:
+        ketra.refresh()
+    assert e.value.status == 401
+    assert len(n4.requests) == sent + 1
+    assert ketra.breaker.state == 'closed'
+
+
+def test_wedged_n4_times_out_then_fails_fast(n4, make_ketra):
+    ketra = make_ketra(timeouts={'query': 0.2, 'set': 0.2}, breaker_threshold=2,
+                       breaker_reset=60)
+    n4.latency = 1.0
+    for output in ketra.outputs[:2]:
+        start = time.monotonic()
+        with pytest.raises(KetraTimeoutError):
+            output.read_state()
+        assert time.monotonic() - start < 0.5
+    assert ketra.breaker.state == 'open'
+    results = ketra.set_states({output: {'Brightness': 0.1}
+                                for output in ketra.outputs})
+    assert all(isinstance(r.error, CircuitOpenError) for r in results.values())
+
+
+def test_cancelled_async_probe_does_not_wedge_breaker(n4):
+    from pyketra.aio import AsyncKetra
+
+    async def main():
+        async with AsyncKetra(n4.address, 'pw', 'Home', limit=1, retries=0,
+                              breaker_threshold=1, breaker_reset=0.05) as ketra:
+            await ketra.load_json_db(disable_cache=True, revalidate=False)
+            outputs = ketra.outputs
+            n4.fail_requests = 1
+            with pytest.raises(KetraRequestError):
+                await outputs[0].set_level(0.1)
+            await asyncio.sleep(0.06)
+            ketra.admission.limit = 0.5          # admit nothing
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(outputs[1].set_level(0.2), 0.05)
+            ketra.admission.limit = 1.0
+            await outputs[1].set_level(0.2)
+            assert ketra.breaker.state == 'closed'
+
+    asyncio.run(main())
+
+
+def test_waiting_for_the_fleet_counts_against_the_deadline_not_the_n4(n4, ssl_context):
+    wedged = FakeN4(make_groups(1, prefix='W'), password='pw', ssl_context=ssl_context,
+                    latency=1.0)
+    wedged.start_in_thread()
+    stuck = Ketra(wedged.address, 'pw', 'Home', timeouts={'query': 2})
+    healthy = Ketra(n4.address, 'pw', 'Home', timeouts={'query': 0.2})
+    try:
+        stuck.load_json_db(disable_cache=True)
+        healthy.load_json_db(disable_cache=True)
+        KetraFleet([stuck, healthy], max_connections=1)
+        holder = threading.Thread(target=stuck.outputs[0].read_state)
+        holder.start()
+        time.sleep(0.1)
+        before = healthy.admission.stats
+        start = time.monotonic()
+        with pytest.raises(KetraTimeoutError):
+            healthy.outputs[0].read_state()
+        assert time.monotonic() - start < 0.5
+        assert healthy.breaker.stats['failures'] == 0
+        after = healthy.admission.stats
+        assert (after['errors'], after['decreases'], after['in_flight']) == (
+            before['errors'], before['decreases'], 0)
+        holder.join()
+    finally:
+        stuck.close()
+        healthy.close()
+        wedged.stop_in_thread()
@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+from pyketra import CACHE_VERSION, Ketra
+from pyketra.aio import AsyncKetra
+
+
+def _fill_cache(n4):
+    """Loads n4 once, which writes its cache file; returns the file name."""
+    ketra = Ketra(n4.address, 'pw', 'Home')
+    ketra.load_json_db(disable_cache=True)
+    ketra.close()
+    return ketra._cache_filename()
+
+
+def _load_from(n4, revalidate=False):
+    ketra = Ketra(n4.address, 'pw', 'Home')
+    ketra.load_json_db(revalidate=revalidate)
+    return ketra
+
+
+def test_valid_cache_is_used_without_asking_the_n4(n4):
+    filename = _fill_cache(n4)
+    with open(filename) as f:
+        header = json.loads(f.readline())
+    assert header['version'] == CACHE_VERSION
+    sent = len(n4.requests)
+    ketra = _load_from(n4)
+    assert len(n4.requests) == sent
+    assert [output.uid for output in ketra.outputs] == [g['Id'] for g in n4.groups]
+    ketra.close()
+
+
+def test_corrupt_or_old_cache_is_ignored(n4):
+    filename = _fill_cache(n4)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    for bad in (data.replace(b'Group 3', b'Group X'),
+                data.replace(b'"version": %d' % CACHE_VERSION, b'"version": 1')):
+        with open(filename, 'wb') as f:
+            f.write(bad)
+        sent = len(n4.requests)
+        ketra = _load_from(n4)
+        assert len(n4.requests) == sent + 1
+        assert len(ketra.outputs) == 8
+        ketra.close()
+
+
+def test_background_revalidation_picks_up_changes(n4):
+    filename = _fill_cache(n4)
+    n4.groups[0]['Name'] = 'Renamed'
+    ketra = _load_from(n4, revalidate=True)
+    output = ketra.outputs[0]
+    ketra._revalidation.join()
+    assert ketra.outputs[0] is output
+    assert output.name == 'Renamed'
+    with open(filename, 'rb') as f:
+        assert b'Renamed' in f.read()
+    ketra.close()
+
+
+def test_unchanged_revalidation_leaves_the_cache_alone(n4):
+    filename = _fill_cache(n4)
+    with open(filename, 'rb') as f:
+        before = f.read()
+    ketra = _load_from(n4, revalidate=True)
+    ketra._revalidation.join()
+    with open(filename, 'rb') as f:
+        assert f.read() == before
+    ketra.close()
+
+
+def test_async_close_stops_revalidation(n4):
+    _fill_cache(n4)
+    n4.latency = 0.2
+
+    async def main():
+        ketra = AsyncKetra(n4.address, 'pw', 'Home')
+        await ketra.load_json_db()
+        await ketra.close()
+        await asyncio.sleep(0.3)
+        return ketra
+
+    ketra = asyncio.run(main())
+    assert ketra._client is None     # not reopened by the revalidation
@@ -0,0 +1,37 @@
+import time
+
+
+def _puts(n4):
+    return sum(1 for method, _ in n4.requests if method == 'PUT')
+
+
+def test_slider_drag_is_sent_once_with_the_last_value(n4, make_ketra):
+    ketra = make_ketra(coalesce_window=0.1)
+    output = ketra.outputs[0]
+    for i in range(1, 21):
+        output.level = i / 20.0
+    assert _puts(n4) == 0
+    time.sleep(0.4)
+    assert _puts(n4) == 1
+    assert n4.group(output.name)['State']['Brightness'] == 1.0
+
+
+def test_fields_of_queued_changes_are_merged(n4, make_ketra):
+    ketra = make_ketra(coalesce_window=10)
+    output = ketra.outputs[0]
+    output.level = 0.3
+    output.xy = (0.4, 0.4)
+    ketra.flush_writes()
+    state = n4.group(output.name)['State']
+    assert _puts(n4) == 1
+    assert (state['Brightness'], state['xChromaticity']) == (0.3, 0.4)
+
+
+def test_close_sends_pending_writes(n4, make_ketra):
+    ketra = make_ketra(coalesce_window=10)
+    output = ketra.outputs[0]
+    output.level = 0.7
+    ketra.close()
+    assert n4.group(output.name)['State']['Brightness'] == 0.7
+    output.level = 0.2          # after close() setters send directly
+    assert n4.group(output.name)['State']['Brightness'] == 0.2
@@ -0,0 +1,51 @@
+import pytest
+
+from pyketra import Ketra, KetraHttpAdapter
+from pyketra.testing import FakeN4, make_groups
+
+
+@pytest.fixture
+def twin_n4(ssl_context):
+    """An N4 with two groups both named "Lamp", and one named "Lamp 2"."""
+    groups = make_groups(3)
+    groups[0]['Name'] = groups[1]['Name'] = 'Lamp'
+    groups[2]['Name'] = 'Lamp 2'
+    server = FakeN4(groups, password='pw', ssl_context=ssl_context)
+    server.start_in_thread()
+    yield server
+    server.stop_in_thread()
+
+
+@pytest.fixture
+def twin_ketra(twin_n4):
+    ketra = Ketra(twin_n4.address, 'pw', 'Home', retries=0)
+    ketra.load_json_db(disable_cache=True)
+    yield ketra
+    ketra.close()
+
+
+def test_groups_with_shared_names_are_addressed_by_id(twin_n4, twin_ketra):
+    # The second "Lamp" is numbered "Lamp 2", so the N4's own "Lamp 2"
+    # becomes "Lamp 2 2" on our side.
+    assert [output.name for output in twin_ketra.outputs] == ['Lamp', 'Lamp 2', 'Lamp 2 2']
+    for i, output in enumerate(twin_ketra.outputs):
+        output.level = 0.1 * (i + 1)
+    for i, group in enumerate(twin_n4.groups):
+        assert group['State']['Brightness'] == pytest.approx(0.1 * (i + 1))
+
+
+def test_read_state_of_a_renumbered_group(twin_n4, twin_ketra):
+    output = twin_ketra.outputs[1]
+    twin_n4.groups[1]['State']['Brightness'] = 0.37
+    assert output.read_state()['Brightness'] == 0.37
+    assert output.level == 0.37
+
+
+def test_connections_are_kept_for_reuse(n4, make_ketra):
+    ketra = make_ketra(pool_size=4)
+    for i in range(20):
+        ketra.outputs[i % 8].level = i / 20.0
+    context = ketra._ssl_context
+    assert context.handshakes <= 4
+    assert sum(isinstance(adapter, KetraHttpAdapter)
+               for adapter in ketra._session.adapters.values()) == 1
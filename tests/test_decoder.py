@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from pyketra import _iter_groups
+from pyketra.testing import make_groups
+
+
+def _body(groups, **envelope):
+    return json.dumps(dict(envelope, Content=groups)).encode('utf-8')
+
+
+def _chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('size', [1, 7, 64, 1 << 20])
+def test_groups_decode_across_any_chunking(size):
+    groups = make_groups(20)
+    groups[3]['Name'] = 'Café "Corner" \\ Lamp'
+    data = _body(groups, Success=True, Error=None)
+    assert list(_iter_groups(_chunks(data, size))) == groups
+
+
+def test_content_before_other_fields():
+    data = b'{"Content": [{"Id": "1", "Name": "a"}], "Success": true}'
+    assert list(_iter_groups(_chunks(data, 5))) == [{'Id': '1', 'Name': 'a'}]
+
+
+@pytest.mark.parametrize('data', [
+    b'{"Content": [{"Id": "1"}, {"Id": "2"',
+    b'{"Success": true}',
+    b'',
+])
+def test_truncated_or_malformed_responses_raise(data):
+    with pytest.raises(ValueError):
+        list(_iter_groups(_chunks(data, 4)))
@@ -0,0 +1,38 @@
+import pytest
+
+import pyketra
+from pyketra.testing import FakeN4Responder
+
+
+@pytest.fixture
+def responder():
+    server = FakeN4Responder([{'serial': 'A1'}, {'serial': 'B2'}], delay=0.05)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def discover_args(responder, tmp_path):
+    return dict(cache_file=str(tmp_path / 'discovery.json'), interface='127.0.0.1',
+                broadcast='127.0.0.1', port=responder.port)
+
+
+def _serials(devices):
+    return sorted(device['serial'] for device in devices)
+
+
+def test_full_scan_is_cached(responder, discover_args):
+    assert _serials(pyketra.discoverN4Devices(timeout=0.3, **discover_args)) == ['A1', 'B2']
+    assert _serials(pyketra.discoverN4Devices(timeout=0.3, **discover_args)) == ['A1', 'B2']
+    assert responder.queries == 1
+
+
+def test_scan_cut_short_for_a_serial_is_not_cached(responder, discover_args):
+    assert pyketra.discoverN4Device('A1', timeout=0.3, **discover_args) == '127.0.0.1'
+    assert _serials(pyketra.discoverN4Devices(timeout=0.3, **discover_args)) == ['A1', 'B2']
+    assert responder.queries == 2
+
+
+def test_unknown_serial_is_none(discover_args):
+    assert pyketra.discoverN4Device('ZZ', timeout=0.2, **discover_args) is None
@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+from pyketra.effects import ColorCycle, EffectScheduler, Fade, Sunrise
+
+
+@pytest.fixture
+def scheduler(ketra):
+    scheduler = EffectScheduler(ketra)
+    yield scheduler
+    scheduler.stop()
+
+
+def test_fade_is_one_command_from_its_start_state(ketra):
+    output = ketra.outputs[0]
+    frames = Fade(2.5, level=0.8, xy=(0.4, 0.4), start={'level': 0.1}).compile(output)
+    assert len(frames) == 1
+    state = frames[0].state
+    assert (frames[0].at, state['Brightness'], state['TransitionTime']) == (0.0, 0.8, 2500)
+    assert state['StartState'] == {'PowerOn': True, 'Brightness': 0.1}
+
+
+def test_color_cycle_and_sunrise_compile_to_few_keyframes(ketra):
+    output = ketra.outputs[0]
+    colors = [(0.68, 0.3), (0.3, 0.6), (0.155, 0.076)]
+    frames = ColorCycle(colors, period=3).compile(output)
+    assert [frame.at for frame in frames] == [0.0, 1.0, 2.0]
+    assert [frame.state['xChromaticity'] for frame in frames] == [0.3, 0.155, 0.68]
+    assert 'StartState' in frames[0].state and 'StartState' not in frames[1].state
+    frames = Sunrise(duration=40, segments=4, end_level=1.0).compile(output)
+    assert [frame.at for frame in frames] == [0.0, 10.0, 20.0, 30.0]
+    assert frames[0].state['StartState']['Brightness'] == 0.0
+    assert frames[-1].state['Brightness'] == 1.0
+
+
+def test_wait_returns_once_the_last_batch_is_sent(n4, ketra, scheduler):
+    n4.latency = 0.2
+    scheduler.play(Fade(1.0, level=0.55), ketra.outputs[:4])
+    assert scheduler.wait(2)
+    assert [group['State']['Brightness'] for group in n4.groups[:4]] == [0.55] * 4
+
+
+def test_keyframes_due_together_go_out_as_one_batch(n4, ketra, scheduler):
+    scheduler.play(ColorCycle([(0.68, 0.3), (0.3, 0.6)], period=0.2, cycles=2),
+                   ketra.outputs[:3])
+    scheduler.play(Fade(0.5, level=0.2), ketra.outputs[3:6])
+    assert scheduler.wait(2)
+    assert scheduler.batches == 4
+    assert scheduler.commands == 3 * 4 + 3
+
+
+def test_playing_on_an_output_takes_it_from_the_old_effect(ketra, scheduler):
+    first = scheduler.play(ColorCycle([(0.68, 0.3), (0.3, 0.6)], period=10, cycles=None),
+                           ketra.outputs[:2], delay=5)
+    scheduler.play(Fade(1, level=0.3), ketra.outputs[:1], delay=5)
+    assert first in scheduler.playing
+    scheduler.play(Fade(1, level=0.3), ketra.outputs[1:2], delay=5)
+    assert first not in scheduler.playing
+
+
+def test_cancel_stops_further_keyframes(n4, ketra, scheduler):
+    play = scheduler.play(ColorCycle([(0.68, 0.3), (0.3, 0.6)], period=0.4, cycles=None),
+                          ketra.outputs[:1])
+    time.sleep(0.1)
+    scheduler.cancel(play)
+    assert scheduler.wait(2)
+    sent = scheduler.commands
+    time.sleep(0.5)
+    assert scheduler.commands == sent
+
+
+def test_stop_cancels_batches_not_yet_sent(n4, ketra):
+    scheduler = EffectScheduler(ketra, senders=1)
+    n4.latency = 0.3
+    before = [group['State']['Brightness'] for group in n4.groups[4:]]
+    scheduler.play(Fade(1, level=0.5), ketra.outputs[:4])
+    scheduler.play(Fade(1, level=0.5), ketra.outputs[4:], delay=0.05)
+    time.sleep(0.15)            # the second batch waits for the only sender
+    scheduler.stop()
+    assert scheduler.wait(2)
+    time.sleep(0.5)
+    assert [group['State']['Brightness'] for group in n4.groups[4:]] == before
@@ -0,0 +1,86 @@
+import threading
+import time
+
+from pyketra import _EventBus
+
+
+class _Thing:
+    def __init__(self, name):
+        self.name = name
+
+
+def test_every_handler_of_an_object_is_called(ketra):
+    output = ketra.outputs[0]
+    calls = []
+    ketra.subscribe(output, lambda obj: calls.append(('first', obj)))
+    ketra.subscribe(output, lambda obj: calls.append(('second', obj)))
+    ketra.subscribe(None, lambda obj: calls.append(('all', obj)))
+    ketra.subscribe(ketra.area('Home'), lambda obj: calls.append(('area', obj)))
+    ketra._notify(output)
+    assert ketra._events.wait_idle(2)
+    assert sorted(name for name, _ in calls) == ['all', 'area', 'first', 'second']
+    assert all(obj is output for _, obj in calls)
+
+
+def test_unsubscribed_handler_is_not_called(ketra):
+    output = ketra.outputs[0]
+    calls = []
+    handler = calls.append
+    ketra.subscribe(output, handler)
+    ketra.unsubscribe(output, handler)
+    ketra._notify(output)
+    assert ketra._events.wait_idle(2)
+    assert calls == []
+    assert ketra._events.published == 0
+
+
+def test_slow_handler_does_not_hold_up_publishing():
+    bus = _EventBus(workers=2, depth=100)
+    release = threading.Event()
+    bus.subscribe(None, lambda obj: release.wait(2))
+    start = time.monotonic()
+    for i in range(50):
+        bus.publish(_Thing(i))
+    assert time.monotonic() - start < 0.5
+    release.set()
+    assert bus.wait_idle(2)
+    assert bus.delivered == 50
+
+
+def test_updates_to_an_object_waiting_for_delivery_are_folded():
+    bus = _EventBus(workers=1, depth=100)
+    release = threading.Event()
+    blocker, busy = _Thing('blocker'), _Thing('busy')
+    delivered = []
+
+    def handler(obj):
+        if obj is blocker:
+            release.wait(2)
+        delivered.append(obj)
+    bus.subscribe(None, handler)
+    bus.publish(blocker)
+    for _ in range(10):
+        bus.publish(busy)
+    release.set()
+    assert bus.wait_idle(2)
+    assert delivered == [blocker, busy]
+    assert bus.coalesced == 9
+
+
+def test_oldest_update_is_dropped_when_the_queue_is_full():
+    bus = _EventBus(workers=1, depth=2)
+    release = threading.Event()
+    things = [_Thing(i) for i in range(4)]
+    delivered = []
+
+    def handler(obj):
+        release.wait(2)
+        delivered.append(obj)
+    bus.subscribe(None, handler)
+    for thing in things:
+        bus.publish(thing)
+        time.sleep(0.01)    # let the worker take the first one
+    release.set()
+    assert bus.wait_idle(2)
+    assert delivered == [things[0], things[2], things[3]]
+    assert bus.dropped == 1
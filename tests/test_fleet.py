@@ -0,0 +1,89 @@
+import time
+
+import pytest
+
+from pyketra import Ketra, KetraFleet
+from pyketra.testing import FakeN4, make_groups
+
+
+@pytest.fixture
+def n4s(ssl_context):
+    """Two N4s, with distinct group ids and one name in common."""
+    servers = []
+    for building in ('A', 'B'):
+        groups = make_groups(4, prefix=building)
+        for group in groups:
+            group['Id'] = building + group['Id']
+        groups[0]['Name'] = 'Porch'
+        servers.append(FakeN4(groups, password='pw', ssl_context=ssl_context))
+    for server in servers:
+        server.start_in_thread()
+    yield servers
+    for server in servers:
+        server.stop_in_thread()
+
+
+@pytest.fixture
+def make_fleet(n4s):
+    fleets = []
+
+    def make(**kwargs):
+        fleet = KetraFleet([Ketra(n4.address, 'pw', 'Home') for n4 in n4s], **kwargs)
+        fleets.append(fleet)
+        return fleet
+    yield make
+    for fleet in fleets:
+        fleet.close()
+
+
+def test_controllers_load_in_parallel(n4s, make_fleet):
+    fleet = make_fleet()
+    for n4 in n4s:
+        n4.latency = 0.3
+    start = time.monotonic()
+    errors = fleet.load_json_db(disable_cache=True)
+    assert time.monotonic() - start < 0.55
+    assert list(errors.values()) == [None, None]
+    assert len(fleet.outputs) == 8
+
+
+def test_a_failing_controller_does_not_stop_the_others(n4s, make_fleet):
+    fleet = make_fleet()
+    n4s[0].password = 'changed'
+    errors = fleet.load_json_db(disable_cache=True)
+    first, second = fleet.controllers
+    assert errors[first] is not None and errors[second] is None
+    assert len(fleet.outputs) == 4
+
+
+def test_lookups_span_controllers(n4s, make_fleet):
+    fleet = make_fleet()
+    fleet.load_json_db(disable_cache=True)
+    assert fleet.output(n4s[1].groups[2]['Id']).uid == n4s[1].groups[2]['Id']
+    assert fleet.output('nowhere') is None
+    porches = fleet.outputs_named('Porch')
+    assert sorted(output._ketra._host for output in porches) == sorted(
+        n4.address for n4 in n4s)
+
+
+def test_commands_go_to_their_own_controller(n4s, make_fleet):
+    fleet = make_fleet()
+    fleet.load_json_db(disable_cache=True)
+    results = fleet.set_states({output: {'Brightness': 0.6}
+                                for output in fleet.outputs_named('Porch')})
+    assert all(result.ok for result in results.values())
+    assert [n4.groups[0]['State']['Brightness'] for n4 in n4s] == [0.6, 0.6]
+    assert [n4.groups[1]['State']['Brightness'] for n4 in n4s] != [0.6, 0.6]
+
+
+def test_connections_are_capped_across_the_fleet(n4s, make_fleet):
+    fleet = make_fleet(max_connections=2)
+    fleet.load_json_db(disable_cache=True)
+    for ketra in fleet.controllers:
+        ketra.admission.limit = 4
+    for n4 in n4s:
+        n4.latency = 0.1
+    start = time.monotonic()
+    fleet.set_states({output: {'Brightness': 0.1} for output in fleet.outputs})
+    # 8 requests two at a time, where each N4 alone would take four at once.
+    assert time.monotonic() - start >= 0.35
@@ -0,0 +1,43 @@
+import time
+
+
+def _group_reads(n4):
+    return sum(1 for method, path in n4.requests
+               if method == 'GET' and path.endswith('/groups'))
+
+
+def test_reads_refresh_everything_once_the_ttl_passes(n4, make_ketra):
+    ketra = make_ketra(state_ttl=0.2)
+    first, second = ketra.outputs[:2]
+    n4.group(first.uid)['State']['Brightness'] = 0.31
+    n4.group(second.uid)['State']['Brightness'] = 0.32
+    reads = _group_reads(n4)
+    assert first.level != 0.31              # still fresh
+    time.sleep(0.25)
+    assert first.level == 0.31
+    assert second.level == 0.32             # from the same request
+    assert _group_reads(n4) == reads + 1
+
+
+def test_reads_without_a_ttl_are_cached(n4, ketra):
+    reads = _group_reads(n4)
+    for output in ketra.outputs:
+        output.level
+        output.xy
+    assert _group_reads(n4) == reads
+
+
+def test_ensure_fresh_cached_within_and_forced(n4, ketra):
+    reads = _group_reads(n4)
+    assert ketra.ensure_fresh(None) is False
+    assert ketra.ensure_fresh(60) is False
+    assert _group_reads(n4) == reads
+    assert ketra.ensure_fresh(0) is True
+    assert _group_reads(n4) == reads + 1
+
+
+def test_query_refreshes_unless_recent(n4, ketra):
+    output = ketra.outputs[3]
+    n4.group(output.uid)['State']['Brightness'] = 0.88
+    assert output.query(60).level != 0.88
+    assert output.query().level == 0.88
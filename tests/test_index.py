@@ -0,0 +1,63 @@
+from pyketra import EntityIndex
+
+
+class _Entity:
+    def __init__(self, uid, area='Home'):
+        self.uid = uid
+        self.area = area
+
+
+def _index(names, area='Home'):
+    index = EntityIndex()
+    entities = [_Entity(i, area) for i in range(len(names))]
+    used = [index.add(entity, name) for entity, name in zip(entities, names)]
+    return index, entities, used
+
+
+def test_taken_names_are_numbered():
+    index, entities, used = _index(['Lamp', 'Lamp', 'Lamp', 'Lamp 2', 'Desk'])
+    assert used == ['Lamp', 'Lamp 2', 'Lamp 3', 'Lamp 2 2', 'Desk']
+    assert index.named('Lamp 3') is entities[2]
+    assert index.given_name(entities[2]) == 'Lamp'
+    assert index.given_name(entities[4]) == 'Desk'
+
+
+def test_a_removed_name_can_be_reused():
+    index, entities, _ = _index(['Lamp', 'Lamp'])
+    index.remove(entities[0])
+    assert index.named('Lamp') is None
+    assert index.add(_Entity(9), 'Lamp') == 'Lamp'
+    assert len(index) == 2
+
+
+def test_lookup_by_id_and_area():
+    index, entities, _ = _index(['A', 'B'])
+    other = _Entity('x', 'Home/Kitchen')
+    index.add(other, 'C')
+    assert index.get(1) is entities[1]
+    assert index.in_area('Home') == entities
+    assert index.in_area('Home/Kitchen') == [other]
+    index.set_area(other, 'Home', 'Home/Kitchen')
+    assert index.in_area('Home') == entities + [other]
+    assert 'Home/Kitchen' not in index.areas
+
+
+def test_prefix_and_search_ignore_case_and_follow_changes():
+    index, entities, _ = _index(['Kitchen Pendant', 'kitchen island', 'Den', 'Pendant'])
+    assert index.prefix('KITCHEN') == [entities[1], entities[0]]
+    assert index.search('pend') == [entities[0], entities[3]]
+    assert index.search('en') == [entities[2], entities[0], entities[3], entities[1]]
+    added = _Entity(7)
+    index.add(added, 'Kitchen Sconce')
+    index.remove(entities[1])
+    assert index.prefix('kitchen') == [entities[0], added]
+    assert index.search('sconce') == [added]
+    assert index.search('island') == []
+
+
+def test_ketra_indexes_its_outputs(ketra):
+    output = ketra.outputs[5]
+    assert ketra.index.get(output.uid) is output
+    assert ketra.index.named(output.name) is output
+    assert len(ketra.index.prefix('group')) == 8
+    assert ketra.index.search('oup 5') == [output]
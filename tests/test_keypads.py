@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from pyketra import Button, Keypad
+from pyketra.aio import AsyncKetra
+from pyketra.testing import make_keypads
+
+
+@pytest.fixture
+def keypads(n4):
+    """Two keypads; the second is a hybrid with a dimmer button named by the
+    N4 but not engraved, and shares its name with the first."""
+    keypads = make_keypads(2)
+    keypads[1]['Name'] = keypads[0]['Name']
+    keypads[1]['Room'] = 'Hall'
+    keypads[1]['Buttons'].append({'Id': 'dimmer', 'Name': 'Raise', 'Position': 5,
+                                  'ButtonType': 'SingleSceneRaiseLower',
+                                  'Direction': 'Up'})
+    n4.keypads = keypads
+    return keypads
+
+
+def test_keypads_and_buttons_are_loaded(keypads, ketra):
+    loaded = ketra.load_keypads()
+    assert all(isinstance(keypad, Keypad) for keypad in loaded)
+    assert [keypad.name for keypad in loaded] == ['Keypad 0', 'Keypad 0 2']
+    first, hybrid = loaded
+    assert [button.name for button in first.buttons] == ['Scene 0', 'Scene 1',
+                                                         'Scene 2', 'Scene 3']
+    assert all(isinstance(button, Button) for button in first.buttons)
+    assert [button.number for button in first.buttons] == [1, 2, 3, 4]
+    assert hybrid.area == 'Home/Hall'
+    assert ketra.area('Home/Hall').keypads == (hybrid,)
+    assert ketra.keypads == loaded
+
+
+def test_activate_sends_one_request_with_the_n4_names(n4, keypads, ketra):
+    _, hybrid = ketra.load_keypads()
+    sent = len(n4.requests)
+    hybrid.button('Scene 2').activate(1000)
+    assert n4.activations == [('Keypad 0', 'Scene 2', 1000)]
+    assert len(n4.requests) == sent + 1
+
+
+def test_dimmer_buttons_show_their_direction_but_activate_by_n4_name(n4, keypads,
+                                                                     ketra):
+    _, hybrid = ketra.load_keypads()
+    dimmer = hybrid.button('Dimmer Up')
+    assert dimmer is hybrid.button('Raise')
+    assert (dimmer.name, dimmer.n4_name) == ('Dimmer Up', 'Raise')
+    dimmer.activate()
+    assert n4.activations == [('Keypad 0', 'Raise', Button.MAX_LEVEL)]
+
+
+def test_reloading_replaces_the_keypads(n4, keypads, ketra):
+    old = ketra.load_keypads()
+    del n4.keypads[1]
+    new = ketra.load_keypads()
+    assert [keypad.name for keypad in new] == ['Keypad 0']
+    assert new[0] is not old[0]
+    assert ketra.area('Home/Hall').keypads == ()
+
+
+def test_async_activate(n4, keypads):
+    async def main():
+        async with AsyncKetra(n4.address, 'pw', 'Home') as ketra:
+            await ketra.load_json_db(disable_cache=True, keypads=True)
+            await ketra.keypads[1].button('Dimmer Up').activate(5)
+
+    asyncio.run(main())
+    assert n4.activations == [('Keypad 0', 'Raise', 5)]
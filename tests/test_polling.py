@@ -0,0 +1,66 @@
+import asyncio
+import threading
+import time
+
+from pyketra import Ketra
+from pyketra.aio import AsyncKetra
+
+
+def _group_reads(n4):
+    return sum(1 for method, path in n4.requests
+               if method == 'GET' and path.endswith('/groups'))
+
+
+def test_poll_updates_and_reports_only_changed_outputs(n4, ketra):
+    output = ketra.outputs[4]
+    n4.group(output.uid)['State']['Brightness'] = 0.01
+    changes = ketra.poll()
+    assert changes.changed == [output]
+    assert output.level == 0.01
+    assert ketra.poll() is None
+
+
+def test_refresh_after_poll_rewrites_the_cache(n4, ketra):
+    output = ketra.outputs[0]
+    n4.group(output.uid)['State']['Brightness'] = 0.77
+    ketra.poll()            # sees the change but leaves the cache alone
+    ketra.refresh()
+    cached = Ketra(n4.address, 'pw', 'Home')
+    cached.load_json_db(revalidate=False)
+    assert cached.outputs[0].level == 0.77
+    cached.close()
+
+
+def test_poller_notifies_subscribers_of_changes(n4, make_ketra):
+    ketra = make_ketra(poll_min_interval=0.05, poll_max_interval=0.2)
+    output = ketra.outputs[2]
+    seen = threading.Event()
+    ketra.subscribe(output, lambda changed: seen.set())
+    ketra.connect()
+    n4.group(output.uid)['State']['PowerOn'] = False
+    assert seen.wait(2)
+    assert output.power is False
+
+
+def test_poll_interval_backs_off_when_quiet_and_resets_on_activity(make_ketra):
+    ketra = make_ketra(poll_min_interval=0.02, poll_max_interval=0.1)
+    ketra.connect()
+    time.sleep(0.4)
+    assert ketra._conn.interval == 0.1
+    ketra.outputs[0].level = 0.5
+    assert ketra._conn.interval == 0.02
+
+
+def test_async_commands_do_not_each_cause_a_poll(n4):
+    async def main():
+        async with AsyncKetra(n4.address, 'pw', 'Home', poll_min_interval=0.3,
+                              poll_max_interval=1.0) as ketra:
+            await ketra.load_json_db(disable_cache=True)
+            ketra.connect()
+            before = _group_reads(n4)
+            for i in range(20):
+                await ketra.outputs[0].set_level(i / 20.0)
+            await asyncio.sleep(0.35)
+            return _group_reads(n4) - before
+
+    assert asyncio.run(main()) <= 2
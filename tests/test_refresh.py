@@ -0,0 +1,50 @@
+from pyketra import Ketra
+from pyketra.testing import make_groups
+
+
+def test_refresh_updates_outputs_in_place(n4, ketra):
+    outputs = list(ketra.outputs)
+    renamed, changed, removed = outputs[:3]
+    n4.group(renamed.uid)['Name'] = 'Porch'
+    n4.group(changed.uid)['State']['Brightness'] = 0.99
+    n4.groups.remove(n4.group(removed.uid))
+    added = make_groups(1, prefix='New')[0]
+    added['Id'] = 'new-group'
+    n4.groups.append(added)
+
+    changes = ketra.refresh()
+    assert changes.renamed == [renamed]
+    assert changes.changed == [changed]
+    assert changes.removed == [removed]
+    assert [output.uid for output in changes.added] == ['new-group']
+    assert ketra.outputs[:2] == outputs[:2]
+    assert removed not in ketra.outputs
+    assert renamed.name == 'Porch'
+    assert ketra.index.named('Porch') is renamed
+    assert ketra.index.get(removed.uid) is None
+    assert changed.level == 0.99
+
+
+def test_refresh_without_changes_returns_none(ketra):
+    assert ketra.refresh() is None
+
+
+def test_loading_twice_from_the_cache_keeps_outputs(n4, ketra):
+    first = Ketra(n4.address, 'pw', 'Home')
+    first.load_json_db(revalidate=False)
+    outputs = list(first.outputs)
+    first.load_json_db(revalidate=False)     # the same cache again
+    assert first.outputs == outputs
+
+    n4.group(outputs[0].uid)['Name'] = 'Renamed'
+    ketra.refresh()                          # writes a new cache
+    first.load_json_db(revalidate=False)
+    assert first.outputs == outputs
+    assert outputs[0].name == 'Renamed'
+    first.close()
+
+
+def test_loading_twice_from_the_n4_keeps_outputs(ketra):
+    outputs = list(ketra.outputs)
+    ketra.load_json_db(disable_cache=True)
+    assert ketra.outputs == outputs
@@ -0,0 +1,49 @@
+import time
+
+from pyketra import KetraRequestError
+
+
+def test_every_output_is_sent_and_cached(n4, ketra):
+    states = {output: {'Brightness': 0.3, 'PowerOn': True} for output in ketra.outputs}
+    results = ketra.set_states(states)
+    assert set(results) == set(ketra.outputs)
+    assert all(result.ok and result.error is None for result in results.values())
+    assert all(group['State']['Brightness'] == 0.3 for group in n4.groups)
+    assert all(output.level == 0.3 for output in ketra.outputs)
+
+
+def test_requests_run_concurrently_up_to_the_limit(n4, make_ketra):
+    ketra = make_ketra(pool_size=8)
+    ketra.admission.limit = 8
+    n4.latency = 0.1
+    start = time.monotonic()
+    ketra.set_states({output: {'Brightness': 0.2} for output in ketra.outputs},
+                     max_concurrency=4)
+    assert time.monotonic() - start < 0.5
+    assert n4.max_in_flight == 4
+
+
+def test_json_string_states_are_sent_as_is(n4, ketra):
+    output = ketra.outputs[1]
+    results = ketra.set_states({output: '{"Brightness": 0.45}'})
+    assert results[output].ok
+    assert n4.group(output.uid)['State']['Brightness'] == 0.45
+    assert output.level == 0.45
+
+
+def test_failures_are_reported_not_raised(n4, make_ketra):
+    ketra = make_ketra(retries=0)
+    missing, present = ketra.outputs[:2]
+    n4.groups.remove(n4.group(missing.uid))
+    results = ketra.set_states({missing: {'Brightness': 0.9},
+                                present: {'Brightness': 0.9}})
+    assert not results[missing].ok
+    assert isinstance(results[missing].error, KetraRequestError)
+    assert missing.level != 0.9
+    assert results[present].ok
+
+
+def test_no_states_sends_nothing(n4, ketra):
+    sent = len(n4.requests)
+    assert ketra.set_states({}) == {}
+    assert len(n4.requests) == sent
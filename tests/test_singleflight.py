@@ -0,0 +1,79 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from pyketra import KetraTimeoutError, _RequestHelper
+
+
+def _gather(count, call):
+    """Calls call() from count threads at once; returns results or errors."""
+    def run():
+        try:
+            return call()
+        except Exception as e:
+            return e
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        return list(pool.map(lambda _: run(), range(count)))
+
+
+def test_concurrent_callers_share_one_call():
+    helper = _RequestHelper()
+    calls = []
+
+    def action():
+        calls.append(1)
+        time.sleep(0.1)
+        return 'state'
+    assert _gather(5, lambda: helper.request(action)) == ['state'] * 5
+    assert len(calls) == 1
+    assert (helper.requests, helper.deduplicated) == (1, 4)
+
+
+def test_every_caller_gets_the_error():
+    helper = _RequestHelper()
+
+    def action():
+        time.sleep(0.1)
+        raise ValueError('boom')
+    results = _gather(3, lambda: helper.request(action))
+    assert all(isinstance(result, ValueError) for result in results)
+    assert helper.requests == 1
+
+
+def test_waiters_give_up_after_their_timeout():
+    helper = _RequestHelper()
+    started, release = threading.Event(), threading.Event()
+
+    def action():
+        started.set()
+        release.wait(2)
+        return 'late'
+    runner = threading.Thread(target=helper.request, args=(action,))
+    runner.start()
+    started.wait(2)
+    with pytest.raises(KetraTimeoutError):
+        helper.request(action, timeout=0.05)
+    release.set()
+    runner.join()
+    assert helper.request(lambda: 'next') == 'next'
+
+
+def test_concurrent_reads_of_one_output_share_a_request(n4, ketra):
+    output = ketra.outputs[0]
+    n4.latency = 0.1
+    before = ketra.request_stats
+    states = _gather(6, output.read_state)
+    assert all(state == states[0] for state in states)
+    after = ketra.request_stats
+    assert after['requests'] - before['requests'] <= 2
+    assert (after['requests'] - before['requests'] +
+            after['deduplicated'] - before['deduplicated']) == 6
+
+
+def test_concurrent_refreshes_share_a_groups_read(n4, ketra):
+    n4.latency = 0.1
+    sent = len(n4.requests)
+    _gather(5, lambda: ketra.ensure_fresh(0))
+    assert len(n4.requests) - sent <= 2
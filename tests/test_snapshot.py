@@ -0,0 +1,63 @@
+import asyncio
+
+from pyketra import Snapshot
+from pyketra.aio import AsyncKetra
+
+
+def _puts(n4):
+    return sum(1 for method, _ in n4.requests if method == 'PUT')
+
+
+def test_restore_sends_only_outputs_that_changed(n4, ketra):
+    snapshot = ketra.snapshot()
+    first, second = ketra.outputs[:2]
+    first.level = 0.11
+    second.xy = (0.6, 0.35)
+    sent = _puts(n4)
+    results = ketra.restore(snapshot)
+    assert set(results) == {first, second}
+    assert all(result.ok for result in results.values())
+    assert _puts(n4) == sent + 2
+    assert ketra.restore(snapshot) == {}
+
+
+def test_restore_puts_back_power_set_by_a_setter(n4, ketra):
+    output = ketra.outputs[0]
+    output.power = False
+    output.level = 0.8          # turns the output back on
+    snapshot = ketra.snapshot([output])
+    output.xy = (0.68, 0.3)
+    ketra.restore(snapshot)
+    state = n4.group(output.name)['State']
+    assert state['PowerOn'] is True
+    assert state['Brightness'] == 0.8
+    output.power = False
+    assert n4.group(output.name)['State']['PowerOn'] is False
+
+
+def test_snapshot_json_round_trip(ketra):
+    snapshot = ketra.snapshot()
+    copy = Snapshot.from_json(snapshot.to_json())
+    assert sorted(copy.uids) == sorted(snapshot.uids)
+    assert not any(copy.differs(output) for output in ketra.outputs)
+
+
+def test_xy_set_as_a_tuple_is_cached_as_read_back(n4, ketra):
+    output = ketra.outputs[0]
+    output.xy = (0.5, 0.41)
+    assert output.xy == [0.5, 0.41]
+    sent = _puts(n4)
+    output.xy = (0.5, 0.41)
+    assert _puts(n4) == sent
+    assert ketra.poll() is None          # no change the N4 didn't make
+    assert not ketra.snapshot().differs(output)
+
+
+def test_async_xy_set_as_a_tuple_is_cached_as_read_back(n4):
+    async def main():
+        async with AsyncKetra(n4.address, 'pw', 'Home') as ketra:
+            await ketra.load_json_db(disable_cache=True)
+            await ketra.outputs[0].set_xy((0.5, 0.41))
+            return await ketra.poll()
+
+    assert asyncio.run(main()) is None